@@ -0,0 +1,107 @@
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+def allocations(fn, device):
+    """ Number and total bytes of the allocations made by fn(), not the peak: every copy counts """
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_stats()
+        fn()
+        torch.cuda.synchronize()
+        after = torch.cuda.memory_stats()
+        return (after['allocation.all.allocated'] - before['allocation.all.allocated'],
+                after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated'])
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    # memory allocated by each op itself, frees are counted negative
+    sizes = [event.self_cpu_memory_usage for event in prof.events() if event.self_cpu_memory_usage > 0]
+    return len(sizes), sum(sizes)
+
+
+def measure(size, modes, device):
+    """ {mode: {part: (count, nbytes)}} of the encoders, the cost encoder and the forward of the tree on sys.path,
+        modes {mode: config overrides}. Trees from before encode_images / forward_features only report the forward.
+    """
+    from configs.submissions import get_cfg
+    from core.FlowFormer import build_flowformer
+
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False
+    torch.manual_seed(1234)
+    model = build_flowformer(cfg).to(device).eval()
+
+    ht, wd = size
+    image1 = 255 * torch.rand(1, 3, ht, wd, device=device)
+    image2 = 255 * torch.rand(1, 3, ht, wd, device=device)
+
+    results = {}
+    for mode, overrides in modes.items():
+        model.cfg.update(overrides)
+        parts = results[mode] = {}
+
+        with torch.no_grad():
+            model(image1, image2)
+            if hasattr(model, 'encode_images'):
+                context, feat_s, feat_t = model.encode_images(image1, image2)
+                parts['encoders'] = allocations(lambda: model.encode_images(image1, image2), device)
+                parts['cost encoder'] = allocations(lambda: model.memory_encoder.forward_features(feat_s, feat_t, {}, context), device)
+            parts['forward'] = allocations(lambda: model(image1, image2), device)
+
+    return results
+
+
+def measure_revision(revision, size, modes):
+    """ measure() of a git revision of this repository, in a subprocess on an exported copy of its tree """
+    root = os.path.dirname(os.path.abspath(__file__))
+    archive = subprocess.run(['git', 'archive', revision], cwd=root, check=True, stdout=subprocess.PIPE).stdout
+    with tempfile.TemporaryDirectory() as tree:
+        tarfile.open(fileobj=io.BytesIO(archive)).extractall(tree)
+        command = [sys.executable, os.path.abspath(__file__), '--tree', tree, '--size', *map(str, size), '--overrides', json.dumps(modes)]
+        output = subprocess.run(command, cwd=tree, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    # the model prints its configuration, the results are the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 512], help='image size')
+    parser.add_argument('--modes', nargs='+', default=['dense'], help='comma separated config overrides per mode, e.g. cost_chunk=1024')
+    parser.add_argument('--baseline', default=None, help='git revision to compare against, e.g. the commit before a layout change, printed as before -> after')
+    # measure the tree in this directory with the json {mode: overrides} and print json, see measure_revision
+    parser.add_argument('--tree', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--overrides', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    if args.tree is not None:
+        # before anything imports the configs and models of this tree
+        sys.path.insert(0, args.tree)
+        print(json.dumps(measure(args.size, json.loads(args.overrides), device)))
+        sys.exit()
+
+    from benchmark_cost_volume import parse_mode
+    modes = {mode: parse_mode(mode) for mode in args.modes}
+    before = measure_revision(args.baseline, args.size, modes) if args.baseline else None
+    after = measure(args.size, modes, device)
+
+    for mode, parts in after.items():
+        for part, (count, nbytes) in parts.items():
+            line = "%-24s %-13s" % (mode, part)
+            if before is not None and part in before[mode]:
+                count_before, nbytes_before = before[mode][part]
+                line += " %7d -> %7d allocations %9.1f -> %9.1f MB" % (count_before, count, nbytes_before / 2**20, nbytes / 2**20)
+            else:
+                line += " %7d allocations %9.1f MB" % (count, nbytes / 2**20)
+            print(line)
@@ -0,0 +1,63 @@
+import argparse
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer.PerCostFormer3.attention import BroadMultiHeadAttention, MultiHeadAttention, set_attention_backend
+from core.FlowFormer.PerCostFormer3.twins import LocallyGroupedAttnRPEContext, GlobalSubSampleAttnRPEContext
+from core.FlowFormer.PerCostFormer3.gma import Attention, Aggregate
+from core.utils.bench import timeit
+
+
+def cases(H, W, rows, device):
+    """ name -> (module, call) for every attention module at its shapes in the model at 1/8 resolution H x W """
+    cfg = get_cfg().percostformer3
+    dim, latent, heads = cfg.cost_latent_dim, cfg.cost_latent_token_num, 8
+    H3W3 = ((H + 7) // 8) * ((W + 7) // 8)
+
+    # latent tokens of the cost encoder attending to the patches of rows cost maps
+    broad = BroadMultiHeadAttention(dim, heads)
+    latents, patches = torch.randn(1, latent, dim, device=device), torch.randn(rows, H3W3, dim, device=device)
+    yield 'BroadMultiHeadAttention', broad, lambda: broad(latents, patches, patches)
+
+    # decoder query of every pixel attending to its cost memory
+    multi = MultiHeadAttention(dim, heads)
+    query, memory = torch.randn(rows, 1, dim, device=device), torch.randn(rows, latent, dim, device=device)
+    yield 'MultiHeadAttention', multi, lambda: multi(query, memory, memory)
+
+    # vertical attention of the cost encoder, over the source pixels of every latent token
+    x = torch.randn(latent, H*W, dim, device=device)
+    context = torch.randn(1, cfg.encoder_latent_dim, H, W, device=device)
+    local = LocallyGroupedAttnRPEContext(dim, heads, ws=7, vert_c_dim=cfg.vert_c_dim, encoder_latent_dim=cfg.encoder_latent_dim)
+    yield 'LocallyGroupedAttnRPEContext', local, lambda: local(x, (H, W), context)
+    glob = GlobalSubSampleAttnRPEContext(dim, heads, sr_ratio=4, vert_c_dim=cfg.vert_c_dim, encoder_latent_dim=cfg.encoder_latent_dim)
+    yield 'GlobalSubSampleAttnRPEContext', glob, lambda: glob(x, (H, W), context)
+
+    # GMA attention over the context and aggregation of the motion features
+    attention, aggregate = Attention(args=cfg, dim=128, heads=1, max_pos_size=160, dim_head=128), Aggregate(args=cfg, dim=128, dim_head=128, heads=1)
+    aggregate.gamma.data.fill_(1.)
+    fmap, motion = torch.randn(1, 128, H, W, device=device), torch.randn(1, 128, H, W, device=device)
+    yield 'GMA Attention + Aggregate', torch.nn.ModuleList([attention, aggregate]), lambda: aggregate(attention(fmap), motion)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[55, 128], help='1/8 resolution size, Sintel by default')
+    parser.add_argument('--rows', type=int, default=1024, help='source pixels per call of the cost attention, as with cost_chunk')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(1234)
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+    for device in devices:
+        cuda = device == 'cuda'
+        for name, module, call in cases(*args.size, args.rows, device):
+            module.to(device).eval()
+            with torch.no_grad():
+                set_attention_backend(module, 'einsum')
+                ref, einsum_ms = call(), timeit(call, args.runs, cuda)
+                set_attention_backend(module, 'sdpa')
+                out, sdpa_ms = call(), timeit(call, args.runs, cuda)
+            if isinstance(ref, tuple):
+                ref, out = ref[0], out[0]
+            print("%s: %-30s max abs diff %.2e  einsum %8.2f ms  sdpa %8.2f ms" % (device, name, (ref - out).abs().max().item(), einsum_ms, sdpa_ms))
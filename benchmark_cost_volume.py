@@ -0,0 +1,116 @@
+import argparse
+import ast
+
+import imageio
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from configs.submissions import get_cfg
+from core.FlowFormer import build_flowformer
+from core.utils import frame_utils
+from core.utils.utils import InputPadder
+from core.utils.bench import timeit
+
+
+def parse_mode(mode):
+    """ 'cost_topk=256,cost_dtype=float16' -> {'cost_topk': 256, 'cost_dtype': 'float16'}, 'dense' -> {} """
+    if mode == 'dense':
+        return {}
+    return {key: literal(value) for key, value in (item.split('=') for item in mode.split(','))}
+
+
+def literal(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def synthetic_pair(ht, wd, shift=(3, -2)):
+    """ Smooth random texture and a copy shifted by shift (x, y) pixels, the flow is -shift everywhere """
+    torch.manual_seed(1234)
+    image = F.interpolate(torch.rand(1, 3, ht // 8 + 2, wd // 8 + 2), size=(ht + 16, wd + 16), mode='bicubic', align_corners=False)
+    image = (255 * image.clamp(0, 1))
+    image1 = image[:, :, 8:8+ht, 8:8+wd]
+    image2 = image[:, :, 8+shift[1]:8+shift[1]+ht, 8+shift[0]:8+shift[0]+wd]
+    flow = torch.tensor([-shift[0], -shift[1]], dtype=torch.float32).view(1, 2, 1, 1).expand(1, 2, ht, wd)
+    return image1, image2, flow
+
+
+def cost_maps_bytes(cost_maps):
+    if torch.is_tensor(cost_maps):
+        return cost_maps.numel() * cost_maps.element_size()
+    return cost_maps.nbytes()
+
+
+@torch.no_grad()
+def run(model, image1, image2, runs):
+    padder = InputPadder(image1.shape)
+    image1, image2 = padder.pad(image1, image2)
+
+    # stored cost maps, measured on the encoder alone
+    context, feat_s, feat_t = model.encode_images(image1, image2)
+    data = {}
+    model.memory_encoder.forward_features(feat_s, feat_t, data, context)
+    stored = cost_maps_bytes(data['cost_maps'])
+    del data
+
+    out = {}
+    elapsed = timeit(lambda: out.update(flow=model(image1, image2)[0]), runs, image1.is_cuda, reset_peak=True)
+    flow = out['flow']
+    peak = torch.cuda.max_memory_allocated() if image1.is_cuda else None
+
+    return padder.unpad(flow), elapsed, stored, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='checkpoint to load, random weights if not given')
+    parser.add_argument('--image1')
+    parser.add_argument('--image2')
+    parser.add_argument('--flow', help='ground truth .flo for the EPE, the synthetic shift if no images are given')
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 512], help='synthetic image size')
+    parser.add_argument('--modes', nargs='+', default=['cost_topk=256', 'cost_topk=64'],
+                        help='comma separated config overrides per mode, compared against the dense cost volume')
+    parser.add_argument('--runs', type=int, default=1)
+    args = parser.parse_args()
+
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False     # the checkpoint, if any, holds the encoder weights
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(1234)
+    model = build_flowformer(cfg)
+    if args.model is not None:
+        model = torch.nn.DataParallel(model)
+        model.load_state_dict(torch.load(args.model, map_location=device))
+        model = model.module
+    model.to(device).eval()
+
+    flow_gt = None
+    if args.image1 is not None:
+        load = lambda path: torch.from_numpy(np.array(imageio.imread(path))[..., :3]).permute(2, 0, 1).float()[None]
+        image1, image2 = load(args.image1), load(args.image2)
+        if args.flow is not None:
+            flow_gt = torch.from_numpy(np.array(frame_utils.read_gen(args.flow))).permute(2, 0, 1).float()[None]
+    else:
+        image1, image2, flow_gt = synthetic_pair(*args.size)
+    image1, image2 = image1.to(device), image2.to(device)
+
+    defaults = {key: cfg.percostformer3[key] for mode in args.modes for key in parse_mode(mode)}
+    flow_dense = None
+    for mode in ['dense'] + args.modes:
+        model.cfg.update(defaults)
+        model.cfg.update(parse_mode(mode))
+        flow, elapsed, stored, peak = run(model, image1, image2, args.runs)
+        flow = flow.cpu()
+        if flow_dense is None:
+            flow_dense = flow
+
+        line = "%-32s %8.1f ms  cost maps %8.1f MB" % (mode, elapsed, stored / 2**20)
+        if peak is not None:
+            line += "  peak %8.1f MB" % (peak / 2**20)
+        line += "  EPE to dense %.3f" % (flow - flow_dense).norm(dim=1).mean().item()
+        if flow_gt is not None:
+            line += "  EPE %.3f" % (flow - flow_gt).norm(dim=1).mean().item()
+        print(line)
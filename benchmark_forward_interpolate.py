@@ -0,0 +1,53 @@
+import sys
+sys.path.append('core')
+
+import argparse
+import torch
+
+from utils.utils import forward_interpolate, forward_interpolate_griddata
+from utils.bench import timeit
+
+
+def synthetic_flow(ht, wd, kind='object'):
+    """ 'noise': independent random flow per pixel, 'object': smooth camera motion and a moving box """
+    if kind == 'noise':
+        return 3 * torch.randn(2, ht, wd)
+
+    y, x = torch.meshgrid(torch.linspace(-1, 1, ht), torch.linspace(-1, 1, wd))
+    flow = torch.stack([2 + 3 * x * y, -1 + 2 * x ** 2], dim=0)
+    flow[:, ht//4:ht//2, wd//4:wd//2] = torch.tensor([6., 3.])[:, None, None]
+    return flow
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[55, 128], help='1/8 resolution flow size, Sintel by default')
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(1234)
+    ht, wd = args.size
+
+    # agreement with the scipy griddata reference
+    for kind in ['object', 'noise']:
+        flow = synthetic_flow(ht, wd, kind)
+        ref = forward_interpolate_griddata(flow)
+        out = forward_interpolate(flow)
+        agree = ((out - ref).abs().sum(dim=0) < 1e-5).float().mean().item()
+        print("%-6s flow: %.2f%% pixels agree with griddata, mean abs diff %.4f" % (kind, 100 * agree, (out - ref).abs().mean().item()))
+
+    # batched calls match single calls
+    flows = torch.stack([synthetic_flow(ht, wd, 'noise') for _ in range(args.batch)])
+    batched = forward_interpolate(flows)
+    single = torch.stack([forward_interpolate(flow) for flow in flows])
+    print("batch of %d: max diff to single calls %.6f" % (args.batch, (batched - single).abs().max().item()))
+
+    flow = synthetic_flow(ht, wd)
+    print("griddata (cpu): %.2f ms" % timeit(lambda: forward_interpolate_griddata(flow), args.runs))
+    print("torch    (cpu): %.2f ms" % timeit(lambda: forward_interpolate(flow), args.runs))
+    if torch.cuda.is_available():
+        flow, flows = flow.cuda(), flows.cuda()
+        print("griddata (from cuda): %.2f ms" % timeit(lambda: forward_interpolate_griddata(flow), args.runs, cuda=True))
+        print("torch    (cuda): %.2f ms" % timeit(lambda: forward_interpolate(flow), args.runs, cuda=True))
+        print("torch    (cuda, batch %d): %.2f ms" % (args.batch, timeit(lambda: forward_interpolate(flows), args.runs, cuda=True)))
@@ -0,0 +1,45 @@
+import argparse
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer.PerCostFormer3.gma import Attention, Aggregate
+from core.utils.bench import timeit
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[55, 128], help='1/8 resolution context size, Sintel by default')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[-1, 2048, 512])
+    parser.add_argument('--iters', type=int, default=12, help='decoder iterations aggregating with one attention')
+    args = parser.parse_args()
+
+    cfg = get_cfg().percostformer3
+    torch.manual_seed(1234)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    cuda = device == 'cuda'
+    H, W = args.size
+
+    attention = Attention(args=cfg, dim=128, heads=1, max_pos_size=160, dim_head=128).to(device).eval()
+    aggregate = Aggregate(args=cfg, dim=128, dim_head=128, heads=1).to(device).eval()
+    aggregate.gamma.data.fill_(1.)
+    context = torch.randn(1, 128, H, W, device=device)
+    motion = [torch.randn(1, 128, H, W, device=device) for _ in range(args.iters)]
+
+    def decode():
+        attn = attention(context)
+        return [aggregate(attn, features) for features in motion]
+
+    ref = None
+    for chunk in args.chunks:
+        cfg.gma_chunk = chunk
+        with torch.no_grad():
+            out = decode()
+            elapsed = timeit(decode, 1, cuda, reset_peak=True)
+        if ref is None:
+            ref = out
+        rows = H*W if chunk <= 0 else min(chunk, H*W)
+        line = "gma_chunk %5d: %8.1f ms for %d iterations  max abs diff %.2e  attention held %7.1f MB" % (
+            chunk, elapsed, args.iters, max((o - r).abs().max().item() for o, r in zip(out, ref)), rows * H*W * 4 / 2**20)
+        if cuda:
+            line += "  peak %7.1f MB" % (torch.cuda.max_memory_allocated() / 2**20)
+        print(line)
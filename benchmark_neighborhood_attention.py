@@ -0,0 +1,68 @@
+import argparse
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer.PerCostFormer3.NA import natten_qkrpb, natten_av, selfattentionlayer_nat
+from core.FlowFormer.PerCostFormer3.encoder import VerticalSelfAttentionLayer
+from core.utils.bench import timeit
+
+
+def dense_reference(query, key, value, rpb):
+    """ Neighborhood attention as masked full attention over the frame, for small sizes only """
+    B, heads, H, W, d = query.shape
+    kernel_size = (rpb.shape[-1] + 1) // 2
+    y, x = torch.meshgrid(torch.arange(H), torch.arange(W), indexing='ij')
+    y, x = y.flatten(), x.flatten()
+    start_y = (y - kernel_size // 2).clamp(0, H - kernel_size)
+    start_x = (x - kernel_size // 2).clamp(0, W - kernel_size)
+
+    inside = (y[None] >= start_y[:, None]) & (y[None] < start_y[:, None] + kernel_size) & \
+             (x[None] >= start_x[:, None]) & (x[None] < start_x[:, None] + kernel_size)
+    rel_y = (y[None] - y[:, None] + kernel_size - 1).clamp(0, 2 * kernel_size - 2)
+    rel_x = (x[None] - x[:, None] + kernel_size - 1).clamp(0, 2 * kernel_size - 2)
+
+    logits = torch.einsum('bhnd, bhmd -> bhnm', query.flatten(2, 3), key.flatten(2, 3)) + rpb[:, rel_y, rel_x]
+    attn = logits.masked_fill(~inside, float('-inf')).softmax(dim=-1)
+    return torch.einsum('bhnm, bhmd -> bhnd', attn, value.flatten(2, 3)).view(B, heads, H, W, d)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', default=['32x64', '55x128', '110x256'], help='1/8 resolution frame sizes')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(1234)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    cuda = device == 'cuda'
+
+    # pytorch kernels against the masked full attention, values and gradients
+    shape = (2, 4, 19, 23, 16)
+    query, key, value = (torch.randn(shape, dtype=torch.float64, requires_grad=True) for _ in range(3))
+    rpb = torch.randn(4, 21, 21, dtype=torch.float64, requires_grad=True)
+    out = natten_av(natten_qkrpb(query, key, rpb).softmax(dim=-1), value)
+    ref = dense_reference(query, key, value, rpb)
+    grad = torch.randn_like(out)
+    grads = torch.autograd.grad((out * grad).sum(), [query, key, value, rpb])
+    grads_ref = torch.autograd.grad((ref * grad).sum(), [query, key, value, rpb])
+    print("max abs diff to masked full attention %.2e, of the gradients %.2e" % (
+        (out - ref).abs().max().item(), max((g - r).abs().max().item() for g, r in zip(grads, grads_ref))))
+
+    # vertical attention layer of the cost encoder, over the source pixels of every latent token
+    cfg = get_cfg().percostformer3
+    layers = {'twins': VerticalSelfAttentionLayer(cfg.cost_latent_dim, cfg), 'NA': selfattentionlayer_nat(cfg)}
+    for size in args.sizes:
+        H, W = map(int, size.split('x'))
+        x = torch.randn(cfg.cost_latent_token_num, H*W, cfg.cost_latent_dim, device=device)
+        context = torch.randn(1, cfg.encoder_latent_dim, H, W, device=device)
+        line = "%s %-8s" % (device, size)
+        for name, layer in layers.items():
+            layer.to(device).eval()
+            try:
+                with torch.no_grad():
+                    line += "  %s %8.1f ms" % (name, timeit(lambda: layer(x, (H, W), context), args.runs, cuda))
+            except RuntimeError as e:   # the scores of the global twins attention grow with (H*W)^2
+                if 'memory' not in str(e):
+                    raise
+                line += "  %s %11s" % (name, 'OOM')
+        print(line)
@@ -0,0 +1,41 @@
+import argparse
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer.PerCostFormer3.encoder import PatchEmbed
+from core.utils.bench import timeit
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[55, 128], help='1/8 resolution feature size, Sintel by default')
+    parser.add_argument('--rows', type=int, default=1024, help='source pixels embedded per call, as with cost_chunk')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    cfg = get_cfg().percostformer3
+    torch.manual_seed(1234)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    patch_embed = PatchEmbed(in_chans=cfg.cost_heads_num, patch_size=cfg.patch_size, embed_dim=cfg.cost_latent_input_dim, pe=cfg.pe, cfg=cfg).to(device).eval()
+
+    H, W = args.size
+    heads = cfg.cost_heads_num
+    fmap1 = torch.randn(1, 256, H, W, device=device) / 16
+    fmap2 = torch.randn(1, 256, H, W, device=device) / 16
+    rows = torch.arange(min(args.rows, H*W), device=device)
+    f1 = fmap1.view(heads, -1, H*W).permute(2, 0, 1)[rows]
+
+    def direct():
+        cost_maps = torch.einsum('nhd, hdj -> nhj', f1, fmap2.view(heads, -1, H*W)).view(len(rows), heads, H, W)
+        return patch_embed(cost_maps, rows=rows)
+
+    def factorized():
+        target = patch_embed.project_target(fmap2)
+        return patch_embed.forward_factorized(f1, target[0], (H, W), rows=rows)
+
+    with torch.no_grad():
+        (x, size), (y, size_f) = direct(), factorized()
+        assert size == size_f
+        print("max abs diff %.2e (max abs value %.2e)" % ((x - y).abs().max().item(), x.abs().max().item()))
+        print("cost maps + PatchEmbed: %.2f ms" % timeit(direct, args.runs, device == 'cuda'))
+        print("factorized PatchEmbed : %.2f ms" % timeit(factorized, args.runs, device == 'cuda'))
@@ -0,0 +1,49 @@
+import argparse
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer import build_flowformer
+from core.utils.bench import timeit
+from benchmark_cost_volume import parse_mode
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 512], help='image size')
+    parser.add_argument('--fractions', type=float, nargs='+', default=[1.0, 0.5, 0.25, 0.125], help='box side over frame side, one centred box each')
+    parser.add_argument('--dilation', type=int, default=16)
+    parser.add_argument('--modes', nargs='+', default=['dense'], help='comma separated config overrides per mode, e.g. cost_chunk=1024')
+    parser.add_argument('--runs', type=int, default=1)
+    args = parser.parse_args()
+
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    cuda = device == 'cuda'
+    torch.manual_seed(1234)
+    model = build_flowformer(cfg).to(device).eval()
+
+    ht, wd = args.size
+    image1 = 255 * torch.rand(1, 3, ht, wd, device=device)
+    image2 = 255 * torch.rand(1, 3, ht, wd, device=device)
+
+    for mode in args.modes:
+        model.cfg.update(parse_mode(mode))
+
+        with torch.no_grad():
+            context, feat_s, feat_t = model.encode_images(image1, image2)
+            flow, _ = model(image1, image2)
+            print("%-24s encoders %8.1f ms  full frame cost encoder + decoder %8.1f ms" % (
+                mode, timeit(lambda: model.encode_images(image1, image2), args.runs, cuda),
+                timeit(lambda: model.forward_features(context, feat_s, feat_t), args.runs, cuda)))
+
+            for fraction in args.fractions:
+                h, w = fraction * ht, fraction * wd
+                box = ((wd - w) / 2, (ht - h) / 2, (wd + w) / 2, (ht + h) / 2)
+                (flow_roi, _, (x0, y0, x1, y1)), = model.forward_roi(image1, image2, [box], args.dilation)
+                offset = (x0 // 8, y0 // 8)
+                crop = lambda x: x[:, :, y0//8:y1//8, x0//8:x1//8]
+                elapsed = timeit(lambda: model.forward_features(crop(context), crop(feat_s), feat_t, offset=offset), args.runs, cuda)
+                diff = (flow_roi - flow[:, :, y0:y1, x0:x1]).abs()
+                print("%-24s box %5.3f  region %4dx%-4d (%5.1f%% of the frame)  %8.1f ms  mean abs diff to full frame flow %.3f" % (
+                    mode, fraction, y1 - y0, x1 - x0, 100 * (y1 - y0) * (x1 - x0) / (ht * wd), elapsed, diff.mean().item()))
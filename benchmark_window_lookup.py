@@ -0,0 +1,41 @@
+import sys
+sys.path.append('core')
+
+import argparse
+import torch
+
+from utils.utils import bilinear_sampler, window_delta, window_lookup
+from utils.bench import timeit
+
+
+def grid_sample_lookup(cost_maps, centroid, r):
+    """ The previous encode_flow_token lookup: grid_sample at every sample of the window """
+    coords = centroid.view(-1, 1, 1, 2) + window_delta(r, centroid.device).view(1, 2*r+1, 2*r+1, 2)
+    return bilinear_sampler(cost_maps, coords)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[55, 128], help='1/8 resolution size, Sintel by default')
+    parser.add_argument('--radius', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(1234)
+    H, W = args.size
+    r = args.radius
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+    for device in devices:
+        cost_maps = torch.randn(H*W, 1, H, W, device=device)
+        centroid = torch.rand(H*W, 2, device=device) * torch.tensor([W + 8., H + 8.], device=device) - 4
+        active = torch.randperm(H*W, device=device)[:H*W // 4]
+
+        ref = grid_sample_lookup(cost_maps, centroid, r)
+        out = window_lookup(cost_maps, None, centroid, r)
+        print("%s: max abs diff to grid_sample %.2e" % (device, (ref - out).abs().max().item()))
+
+        cuda = device == 'cuda'
+        print("%s: grid_sample           %.2f ms" % (device, timeit(lambda: grid_sample_lookup(cost_maps, centroid, r), args.runs, cuda)))
+        print("%s: window_lookup         %.2f ms" % (device, timeit(lambda: window_lookup(cost_maps, None, centroid, r), args.runs, cuda)))
+        print("%s: window_lookup (1/4)   %.2f ms" % (device, timeit(lambda: window_lookup(cost_maps, active, centroid[active], r), args.runs, cuda)))
@@ -48,6 +48,15 @@ _CN.percostformer3.use_rpe = False
 _CN.percostformer3.detach_local = False
 _CN.percostformer3.no_sc = False
 _CN.percostformer3.quater_refine = False
+_CN.percostformer3.cost_chunk = -1 # source pixels per cost volume chunk, built, embedded and encoded one chunk at a time, -1 builds the whole volume at once
+_CN.percostformer3.factorized_embed = False # apply the first PatchEmbed conv to the target features and correlate, instead of convolving every cost map
+_CN.percostformer3.cost_topk = -1 # inference only, keep the k largest responses per source pixel instead of the dense cost maps, -1 keeps all
+_CN.percostformer3.cost_radius = -1 # maximum displacement (1/8 px), cost maps are the (2r+1)^2 target windows centred on each source pixel, -1 matches against the whole target frame
+_CN.percostformer3.cost_target_stride = 1 # 2: cost memory against a 1/16 target grid, decoder lookups in cost_radius windows at 1/8
+_CN.percostformer3.cost_dtype = 'float32' # inference only, storage of the cost maps for the decoder lookups: float32, float16, bfloat16 or int8 (scaled per row)
+_CN.percostformer3.local_corr = False # decoder recomputes its cost lookups from the features, the cost maps are freed after the cost encoder
+_CN.percostformer3.attention_backend = 'einsum' # 'sdpa': fused torch scaled_dot_product_attention in all attention layers
+_CN.percostformer3.gma_chunk = -1 # > 0: GMA aggregation over blocks of gma_chunk query pixels, the (h*w)^2 attention is never stored
 # pretrain config
 _CN.percostformer3.pretrain_mode = True
 _CN.percostformer3.pic_size = [368, 496, 368, 496]
@@ -60,6 +69,7 @@ _CN.percostformer3.fix_pe = False
 _CN.percostformer3.r_16 = -1
 # decoder
 _CN.percostformer3.decoder_depth = 12
+_CN.percostformer3.freeze_tol = -1 # inference only, pixels whose flow update falls below freeze_tol (1/8 px) stop being refined, -1 disables
 _CN.percostformer3.critical_params = ['vert_c_dim', 'encoder_depth', 'vertical_encoder_attn', "use_patch", "flow_or_pe", "use_rpe", "dropout", "detach_local", "expand_factor"]
 
 ### TRAINER
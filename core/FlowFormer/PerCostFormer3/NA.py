@@ -1,23 +1,92 @@
+import os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.models.layers import DropPath
 
 from timm.models.layers import trunc_normal_
 from torch.autograd import Function
 from torch.cuda.amp import custom_fwd, custom_bwd
 
-try:
-    from torch.utils.cpp_extension import load
-    print("[Start compiling NAT]")
-    nattenav_cuda = load(
-        'nattenav_cuda', ['core/cuda/nattenav_cuda.cpp', 'core/cuda/nattenav_cuda_kernel.cu'], verbose=True)
-    print("[Finished 1/2]")
-    nattenqkrpb_cuda = load(
-        'nattenqkrpb_cuda', ['core/cuda/nattenqkrpb_cuda.cpp', 'core/cuda/nattenqkrpb_cuda_kernel.cu'], verbose=False)
-    print("[Finished 2/2]")
-except:
-    print("Failed to load nat cuda")
-    exit()
+nattenav_cuda = nattenqkrpb_cuda = None
+if torch.cuda.is_available() and os.path.exists('core/cuda/nattenav_cuda.cpp'):
+    try:
+        from torch.utils.cpp_extension import load
+        print("[Start compiling NAT]")
+        nattenav_cuda = load(
+            'nattenav_cuda', ['core/cuda/nattenav_cuda.cpp', 'core/cuda/nattenav_cuda_kernel.cu'], verbose=True)
+        print("[Finished 1/2]")
+        nattenqkrpb_cuda = load(
+            'nattenqkrpb_cuda', ['core/cuda/nattenqkrpb_cuda.cpp', 'core/cuda/nattenqkrpb_cuda_kernel.cu'], verbose=False)
+        print("[Finished 2/2]")
+    except Exception as e:
+        print(f"Failed to load nat cuda ({e}), using the pytorch neighborhood attention")
+        nattenav_cuda = nattenqkrpb_cuda = None
+
+def neighborhood_start(length, kernel_size, queries, device):
+    """ First key of the neighborhood of the queries 0 .. queries-1 along an axis of length pixels. As in the
+        NAT kernels, the window is shifted at the borders to stay kernel_size wide inside the frame.
+    """
+    assert length >= kernel_size, f"neighborhood attention needs at least {kernel_size} pixels per axis, got {length}"
+    return (torch.arange(queries, device=device) - kernel_size // 2).clamp(0, length - kernel_size)
+
+def column_tiles(W, kernel_size, tile, device):
+    """ The queries of a row are split in tiles of tile columns, all neighborhoods of a tile lie in a span of
+        tile+kernel_size-1 key columns. Returns the key columns of each span [tiles, span] and the offset of
+        each query's neighborhood in the span of its tile [tiles, tile, kernel_size].
+    """
+    tiles = -(-W // tile)
+    span = min(tile + kernel_size - 1, W)
+    start = neighborhood_start(W, kernel_size, tiles * tile, device).view(tiles, tile)
+    span_start = start[:, 0].clamp(max=W - span)
+    columns = span_start[:, None] + torch.arange(span, device=device)
+    offset = start - span_start[:, None]
+    return columns, offset[:, :, None] + torch.arange(kernel_size, device=device)
+
+def natten_qkrpb(query, key, rpb, tile=16):
+    """ Pytorch NATTENQKRPBFunction: query, key [B, heads, H, W, d], rpb [heads, 2k-1, 2k-1] -> [B, heads, H, W, k*k]
+
+        One kernel row at a time, every query tile is multiplied with the keys of its span and the logits of
+        the neighborhoods are picked from the result, gathering the k*k keys of each query would move far more.
+    """
+    B, heads, H, W, d = query.shape
+    kernel_size = (rpb.shape[-1] + 1) // 2
+    rows = neighborhood_start(H, kernel_size, H, query.device)
+    columns, offset = column_tiles(W, kernel_size, tile, query.device)
+    tiles, span = columns.shape
+
+    query = F.pad(query, (0, 0, 0, tiles * tile - W)).view(B, heads, H, tiles, tile, d)
+    key_x = columns[:, None].expand(-1, tile, -1).gather(-1, offset).flatten(0, 1)[:W]
+    rel_x = key_x - torch.arange(W, device=query.device)[:, None]                 # W, k
+
+    attn = []
+    for ki in range(kernel_size):
+        keys = key.index_select(2, rows + ki)[:, :, :, columns]                  # B, heads, H, tiles, span, d
+        logits = (query @ keys.transpose(-2, -1)).gather(-1, offset.expand(B, heads, H, -1, -1, -1))
+        logits = logits.flatten(3, 4)[:, :, :, :W]                                # B, heads, H, W, k
+        rel_y = rows + ki - torch.arange(H, device=query.device)
+        bias = rpb[:, rel_y + kernel_size - 1][:, :, rel_x + kernel_size - 1]     # heads, H, W, k
+        attn.append(logits + bias)
+
+    return torch.cat(attn, dim=-1)
+
+def natten_av(attn, value, tile=16):
+    """ Pytorch NATTENAVFunction: attn [B, heads, H, W, k*k], value [B, heads, H, W, d] -> [B, heads, H, W, d] """
+    B, heads, H, W, d = value.shape
+    kernel_size = int(round(attn.shape[-1] ** 0.5))
+    rows = neighborhood_start(H, kernel_size, H, value.device)
+    columns, offset = column_tiles(W, kernel_size, tile, value.device)
+    tiles, span = columns.shape
+
+    attn = F.pad(attn, (0, 0, 0, tiles * tile - W)).view(B, heads, H, tiles, tile, kernel_size, kernel_size)
+    out = 0
+    for ki in range(kernel_size):
+        # the weights of the kernel row are spread over the span of their tile
+        weights = attn.new_zeros(B, heads, H, tiles, tile, span).scatter(-1, offset.expand(B, heads, H, -1, -1, -1), attn[..., ki, :])
+        values = value.index_select(2, rows + ki)[:, :, :, columns]                # B, heads, H, tiles, span, d
+        out = out + weights @ values
+
+    return out.flatten(3, 4)[:, :, :, :W]
 
 class NATTENAVFunction(Function):
     @staticmethod
@@ -62,13 +131,16 @@ class NATTENQKRPBFunction(Function):
         return d_query, d_key, d_rpb
 
 class selfattentionlayer_nat(nn.Module):
+    """ Vertical neighborhood attention over the H x W source pixels of each latent token, 11 x 11
+        neighborhoods: H and W (1/8 of the frame, or of the tile) have to be at least 11, i.e. 88 pixels
+    """
     def __init__(self, cfg):
         super(selfattentionlayer_nat, self).__init__()
         dropout = cfg.dropout
         droppath = cfg.droppath
 
         self.cfg = cfg
-        kernel_size = 11
+        self.kernel_size = kernel_size = 11
         qk_dim = cfg.attn_dim
         self.num_heads = qk_dim // 16
         self.expand_factor = cfg.expand_factor
@@ -100,6 +172,9 @@ class selfattentionlayer_nat(nn.Module):
         
         B, HW, C = x.shape
         B_context, C_context, H, W = context.shape
+        assert H >= self.kernel_size and W >= self.kernel_size, \
+            f"vertical_encoder_attn 'NA' needs at least {self.kernel_size} x {self.kernel_size} pixels at 1/8 resolution " \
+            f"({8 * self.kernel_size} x {8 * self.kernel_size} frames or tiles), got {H} x {W}"
         
         short_cut = x
         context = context.reshape(B_context, C_context, HW).permute(0, 2, 1)
@@ -113,9 +188,14 @@ class selfattentionlayer_nat(nn.Module):
         k = self.k(qk).reshape(B, H, W, self.num_heads, 16).permute(0, 3, 1, 2, 4)
         v = self.v(v).reshape(B, H, W, self.num_heads, 16).permute(0, 3, 1, 2, 4)
 
-        attn = NATTENQKRPBFunction.apply(q, k, self.rpb)
-        attn = attn.softmax(dim=-1)
-        x = NATTENAVFunction.apply(attn, v)
+        if nattenqkrpb_cuda is not None and q.is_cuda:
+            attn = NATTENQKRPBFunction.apply(q, k, self.rpb)
+            attn = attn.softmax(dim=-1)
+            x = NATTENAVFunction.apply(attn, v)
+        else:
+            attn = natten_qkrpb(q, k, self.rpb)
+            attn = attn.softmax(dim=-1)
+            x = natten_av(attn, v)
         x = x.permute(0,2,3,1,4).reshape(B, HW, -1)
         x = self.proj(torch.cat([x, short_cut],dim=2))
         x = short_cut + self.drop_path(x)
@@ -6,6 +6,31 @@ from torch import einsum
 from einops.layers.torch import Rearrange
 from einops import rearrange
 
+from ...utils.utils import cached, cached_coords_grid
+
+def set_attention_backend(model, backend):
+    """ Backend of the attention modules of model, the modules with a backend attribute, set from
+        cfg.attention_backend when the model is built. 'einsum' builds the score tensors explicitly,
+        'sdpa' runs torch.nn.functional.scaled_dot_product_attention, which picks a fused flash /
+        memory efficient kernel where one applies and never materializes the scores.
+    """
+    assert backend in ('einsum', 'sdpa'), f"unknown attention backend {backend}"
+    for module in model.modules():
+        if hasattr(module, 'backend'):
+            module.backend = backend
+
+def attend(q, k, v, scale, attn_drop=None, backend='einsum'):
+    """ softmax(q k^T * scale) v, q [..., i, d], k and v [..., j, d] """
+    if backend == 'sdpa':
+        dropout_p = attn_drop.p if attn_drop is not None and attn_drop.training else 0.
+        return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=scale)
+
+    attn = (q @ k.transpose(-2, -1)) * scale
+    attn = attn.softmax(dim=-1)
+    if attn_drop is not None:
+        attn = attn_drop(attn)
+    return attn @ v
+
 class BroadMultiHeadAttention(nn.Module):
     def __init__(self, dim, heads):
         super(BroadMultiHeadAttention, self).__init__()
@@ -13,6 +38,7 @@ class BroadMultiHeadAttention(nn.Module):
         self.heads = heads
         self.scale = (dim/heads) ** -0.5
         self.attend = nn.Softmax(dim=-1)
+        self.backend = 'einsum'
 
     def attend_with_rpe(self, Q, K):
         if Q.shape[0] == 1:
@@ -29,9 +55,16 @@ class BroadMultiHeadAttention(nn.Module):
         return self.attend(dots)
 
     def forward(self, Q, K, V):
-        attn = self.attend_with_rpe(Q, K)
         B, _, _ = K.shape
         _, N, _ = Q.shape
+        if self.backend == 'sdpa':
+            # queries shared by the batch are broadcast, not copied
+            Q = rearrange(Q, 'b i (heads d) -> b heads i d', heads=self.heads).expand(B, -1, -1, -1)
+            K, V = (rearrange(t, 'b j (heads d) -> b heads j d', heads=self.heads) for t in (K, V))
+            out = F.scaled_dot_product_attention(Q, K, V, scale=self.scale)
+            return rearrange(out, 'b heads n d -> b n (heads d)', b=B, n=N)
+
+        attn = self.attend_with_rpe(Q, K)
 
         V = rearrange(V, 'b j (heads d) -> b heads j d', heads=self.heads)
 
@@ -47,6 +80,7 @@ class MultiHeadAttention(nn.Module):
         self.heads = heads
         self.scale = (dim/heads) ** -0.5
         self.attend = nn.Softmax(dim=-1)
+        self.backend = 'einsum'
 
     def attend_with_rpe(self, Q, K):
         Q = rearrange(Q, 'b i (heads d) -> b heads i d', heads=self.heads)
@@ -57,8 +91,13 @@ class MultiHeadAttention(nn.Module):
         return self.attend(dots)
 
     def forward(self, Q, K, V):
-        attn = self.attend_with_rpe(Q, K)
         B, HW, _ = Q.shape
+        if self.backend == 'sdpa':
+            Q, K, V = (rearrange(t, 'b n (heads d) -> b heads n d', heads=self.heads) for t in (Q, K, V))
+            out = F.scaled_dot_product_attention(Q, K, V, scale=self.scale)
+            return rearrange(out, 'b heads hw d -> b hw (heads d)', b=B, hw=HW)
+
+        attn = self.attend_with_rpe(Q, K)
 
         V = rearrange(V, 'b j (heads d) -> b heads j d', heads=self.heads)
 
@@ -67,6 +106,19 @@ class MultiHeadAttention(nn.Module):
 
         return out
 
+    def forward_tokens(self, Q, K, V, tokens):
+        """ forward() across the tokens at every position n of Q, K, V [B*tokens, N, dim], the layout of the
+            vertical attention layers, instead of across N
+        """
+        Q, K, V = (rearrange(t, '(b i) n (heads d) -> b n heads i d', i=tokens, heads=self.heads) for t in (Q, K, V))
+        if self.backend == 'sdpa':
+            out = F.scaled_dot_product_attention(Q, K, V, scale=self.scale)
+        else:
+            attn = self.attend(einsum('bnhid, bnhjd -> bnhij', Q, K) * self.scale)
+            out = einsum('bnhij, bnhjd -> bnhid', attn, V)
+
+        return rearrange(out, 'b n heads i d -> (b i) n (heads d)')
+
 # class MultiHeadAttentionRelative_encoder(nn.Module):
 #     def __init__(self, dim, heads):
 #         super(MultiHeadAttentionRelative, self).__init__()
@@ -160,6 +212,16 @@ def LinearPositionEmbeddingSine(x, dim=128, NORMALIZE_FACOR=1/200):
     freq_bands = torch.linspace(0, dim//4-1, dim//4).to(x.device)
     return torch.cat([torch.sin(3.14*x[..., -2:-1]*freq_bands*NORMALIZE_FACOR), torch.cos(3.14*x[..., -2:-1]*freq_bands*NORMALIZE_FACOR), torch.sin(3.14*x[..., -1:]*freq_bands*NORMALIZE_FACOR), torch.cos(3.14*x[..., -1:]*freq_bands*NORMALIZE_FACOR)], dim=-1)
 
+def GridPositionEmbeddingSine(ht, wd, dim=128, stride=1, device='cpu'):
+    """ LinearPositionEmbeddingSine of the pixel coordinates of a ht x wd grid times stride, [1, ht*wd, dim]
+        from the cache, it broadcasts over the batch
+    """
+    def encode():
+        coords = cached_coords_grid(ht, wd, device).view(1, 2, -1).permute(0, 2, 1) * stride
+        return LinearPositionEmbeddingSine(coords, dim=dim)
+
+    return cached(('grid_pe', ht, wd, dim, stride, torch.device(device)), encode)
+
 def ExpPositionEmbeddingSine(x, dim=128, NORMALIZE_FACOR=1/200):
     # 200 should be enough for a 8x downsampled image
     # assume x to be [_, _, 2]
@@ -0,0 +1,139 @@
+import torch
+from torch import einsum
+from einops import rearrange
+
+from ...utils.utils import bilinear_lookup
+
+
+class WindowCostMaps:
+    """ Stand-in for data['cost_maps'] [N, heads, H2, W2] that only materializes the small window
+        of target pixels around each lookup, subclasses implement window()
+    """
+    def window(self, rows, x0, y0, size):
+        """ Dense [M, heads, h, w] crops of the rows at top left corners (x0, y0) [M] """
+        raise NotImplementedError
+
+    def lookup(self, rows, coords):
+        """ bilinear_lookup(cost_maps, rows, coords): rows [M], coords [M, K, 2] -> [M, heads, K] """
+        x, y = coords.unbind(dim=-1)
+        x0, y0 = x.min(dim=1).values.floor(), y.min(dim=1).values.floor()
+        w = int((x.max(dim=1).values.floor() - x0).max().item()) + 2
+        h = int((y.max(dim=1).values.floor() - y0).max().item()) + 2
+
+        window = self.window(rows, x0.long(), y0.long(), (h, w))
+        local = coords - torch.stack([x0, y0], dim=-1)[:, None]
+        return bilinear_lookup(window, torch.arange(len(rows), device=window.device), local)
+
+
+class TopKCostMaps(WindowCostMaps):
+    """ Sparse stand-in for data['cost_maps'] that keeps the k largest responses of every source pixel
+        and cost head, with their flat target index.
+
+        Rows are written chunk by chunk from dense cost maps (cost_maps[rows] = maps) and looked up
+        like bilinear_lookup. Dropped target pixels read as the smallest kept response of their row,
+        pixels outside the target frame as 0 like grid_sample.
+    """
+    def __init__(self, N, heads, size, k, device='cpu', dtype=torch.float32):
+        self.shape = (N, heads, *size)
+        self.k = min(k, size[0] * size[1])
+        self.values = torch.empty(N, heads, self.k, device=device, dtype=dtype)
+        self.indices = torch.empty(N, heads, self.k, device=device, dtype=torch.int32)
+
+    def __setitem__(self, rows, maps):
+        values, indices = maps.flatten(2).topk(self.k, dim=-1, sorted=False)
+        self.values[rows] = values.to(self.values.dtype)
+        self.indices[rows] = indices.int()
+
+    def nbytes(self):
+        return self.values.numel() * self.values.element_size() + self.indices.numel() * self.indices.element_size()
+
+    def window(self, rows, x0, y0, size):
+        M, (h, w) = len(rows), size
+        _, heads, H2, W2 = self.shape
+        values, indices = self.values[rows], self.indices[rows].long()
+
+        ys = torch.arange(h, device=x0.device)[:, None] + y0[:, None, None]
+        xs = torch.arange(w, device=x0.device)[None, :] + x0[:, None, None]
+        inside = (ys >= 0) & (ys < H2) & (xs >= 0) & (xs < W2)                 # M, h, w
+        floor = values.min(dim=-1).values                                       # M, heads
+        window = inside[:, None].to(values.dtype) * floor[:, :, None, None]
+
+        ty, tx = indices // W2 - y0[:, None, None], indices % W2 - x0[:, None, None]
+        hit = (ty >= 0) & (ty < h) & (tx >= 0) & (tx < w)
+        # responses outside the crop go to a trailing dummy slot
+        slot = torch.where(hit, ty * w + tx, torch.full_like(ty, h * w))
+        window = torch.cat([window.view(M, heads, h * w), window.new_zeros(M, heads, 1)], dim=-1)
+        window.scatter_(-1, slot, values)
+
+        return window[..., :h * w].view(M, heads, h, w)
+
+
+class FeatureCostMaps(WindowCostMaps):
+    """ Stand-in for data['cost_maps'] that recomputes the correlation of the looked up windows from
+        the features, like MemoryEncoder.corr, so the cost maps can be freed after the cost encoder.
+        Equals bilinear sampling of the dense cost maps, as the correlation is linear in fmap2.
+    """
+    def __init__(self, fmap1, fmap2, heads, chunk=256):
+        B, _, H1, W1 = fmap1.shape
+        self.chunk = chunk
+        H2, W2 = fmap2.shape[2:]
+        self.shape = (B*H1*W1, heads, H2, W2)
+        self.rows_per_frame = H1*W1
+        self.fmap1 = rearrange(fmap1, 'b (heads d) h w -> (b h w) heads d', heads=heads)
+        self.fmap2 = rearrange(fmap2, 'b (heads d) h w -> (b h w) heads d', heads=heads)
+
+    def nbytes(self):
+        return (self.fmap1.numel() + self.fmap2.numel()) * self.fmap1.element_size()
+
+    def window(self, rows, x0, y0, size):
+        h, w = size
+        _, heads, H2, W2 = self.shape
+        fmap1 = self.fmap1[rows]
+        base = rows // self.rows_per_frame * H2 * W2
+
+        ys = torch.arange(h, device=rows.device)[:, None] + y0[:, None, None]
+        xs = torch.arange(w, device=rows.device)[None, :] + x0[:, None, None]
+        inside = ((ys >= 0) & (ys < H2) & (xs >= 0) & (xs < W2)).view(len(rows), h*w)
+        index = base[:, None] + (ys.clamp(0, H2-1) * W2 + xs.clamp(0, W2-1)).view(len(rows), h*w)
+
+        # target features of the windows are gathered for chunk rows at a time
+        window = fmap1.new_empty(len(rows), heads, h*w)
+        for start in range(0, len(rows), self.chunk):
+            block = slice(start, start + self.chunk)
+            fmap2 = self.fmap2[index[block]]                                     # m, h*w, heads, d
+            window[block] = einsum('mhd, mkhd -> mhk', fmap1[block], fmap2) * inside[block, None]
+
+        return window.view(len(rows), heads, h, w)
+
+
+class CompactCostMaps:
+    """ data['cost_maps'] [N, heads, H2, W2] kept in float16, bfloat16 or int8 with one scale per row and
+        cost head. Written like a tensor (cost_maps[rows] = maps), only the looked up values are upcast.
+    """
+    dtypes = {'float16': torch.float16, 'bfloat16': torch.bfloat16, 'int8': torch.int8}
+
+    def __init__(self, N, heads, size, dtype='float16', device='cpu'):
+        self.shape = (N, heads, *size)
+        self.maps = torch.empty(self.shape, device=device, dtype=self.dtypes[dtype])
+        self.scale = torch.empty(N, heads, device=device) if dtype == 'int8' else None
+
+    def __setitem__(self, rows, maps):
+        if self.scale is None:
+            self.maps[rows] = maps.to(self.maps.dtype)
+        else:
+            scale = maps.abs().amax(dim=(2, 3)).clamp(min=1e-8) / 127
+            self.maps[rows] = (maps / scale[:, :, None, None]).round().to(torch.int8)
+            self.scale[rows] = scale
+
+    def nbytes(self):
+        nbytes = self.maps.numel() * self.maps.element_size()
+        if self.scale is not None:
+            nbytes += self.scale.numel() * self.scale.element_size()
+        return nbytes
+
+    def lookup(self, rows, coords):
+        """ bilinear_lookup(cost_maps, rows, coords): rows [M], coords [M, K, 2] -> [M, heads, K] """
+        corr = bilinear_lookup(self.maps, rows, coords)
+        if self.scale is not None:
+            corr = corr * self.scale[rows][:, :, None]
+        return corr
@@ -8,7 +8,7 @@ from torch import einsum
 from einops.layers.torch import Rearrange
 from einops import rearrange
 
-from ...utils.utils import coords_grid, bilinear_sampler, upflow8
+from ...utils.utils import cached_coords_grid, bilinear_sampler, window_delta, window_lookup, upflow8
 from .attention import MultiHeadAttention, LinearPositionEmbeddingSine, ExpPositionEmbeddingSine
 from typing import Optional, Tuple
 
@@ -19,10 +19,12 @@ from .gma import Attention
 from .sk import SKUpdateBlock6_Deep_nopoolres_AllDecoder
 
 def initialize_flow(img):
-    """ Flow is represented as difference between two means flow = mean1 - mean0"""
+    """ Flow is represented as difference between two means flow = mean1 - mean0,
+        both are views of one cached grid: update them out of place
+    """
     N, C, H, W = img.shape
-    mean = coords_grid(N, H, W).to(img.device)
-    mean_init = coords_grid(N, H, W).to(img.device)
+    mean = cached_coords_grid(H, W, img.device).expand(N, -1, -1, -1)
+    mean_init = mean
 
     # optical flow computed as difference: flow = mean1 - mean0
     return mean, mean_init
@@ -59,19 +61,21 @@ class CrossAttentionLayer(nn.Module):
         if self.no_sc:
             print("[No short cut in cost decoding]")
         self.dim = qk_dim
-    def forward(self, query, key, value, memory, query_coord, patch_size, size_h3w3):
+    def forward(self, query, key, value, memory, query_coord, patch_size, size_h3w3, query_hw=None):
         """
-            query_coord [B, 2, H1, W1]
+            query_coord [B, 2, H1, W1], or [N, 1, 2] for a subset of the queries of a H1 x W1 = query_hw map
         """
-        B, _, H1, W1 = query_coord.shape
-
         if key is None and value is None:
             key = self.k(memory)
             value = self.v(memory)
 
-        # [B, 2, H1, W1] -> [BH1W1, 1, 2]
-        query_coord = query_coord.contiguous()
-        query_coord = query_coord.view(B, 2, -1).permute(0, 2, 1)[:,:,None,:].contiguous().view(B*H1*W1, 1, 2)
+        if query_hw is None:
+            B, _, H1, W1 = query_coord.shape
+            # [B, 2, H1, W1] -> [BH1W1, 1, 2]
+            query_coord = query_coord.contiguous()
+            query_coord = query_coord.view(B, 2, -1).permute(0, 2, 1)[:,:,None,:].contiguous().view(B*H1*W1, 1, 2)
+        else:
+            H1, W1 = query_hw
         if self.pe == 'linear':
             query_coord_enc = LinearPositionEmbeddingSine(query_coord, dim=self.dim)
         elif self.pe == 'exp':
@@ -211,18 +215,30 @@ class MemoryDecoder(nn.Module):
             from .quater_upsampler import quater_upsampler
             self.quater_upsampler = quater_upsampler()
 
-    def upsample_flow(self, flow, mask):
-        """ Upsample flow field [H/8, W/8, 2] -> [H, W, 2] using convex combination """
+        # pixel-iterations of cost lookup and cross-attention run / skipped by convergence freezing in the last forward
+        self.freeze_stats = {'pixel_iters': 0, 'skipped': 0}
+
+    def upsample_flow(self, flow, mask, output_stride=1):
+        """ Upsample flow field [H/8, W/8, 2] -> [H, W, 2] using convex combination
+
+            With output_stride 2 or 4 the result is [H/s, W/s, 2] in units of that resolution, the
+            convex weights of each s x s block are averaged first, which equals average pooling the
+            full resolution flow without computing it.
+        """
         N, _, H, W = flow.shape
         mask = mask.view(N, 1, 9, 8, 8, H, W)
         mask = torch.softmax(mask, dim=2)
 
-        up_flow = F.unfold(8 * flow, [3,3], padding=1)
+        f = 8 // output_stride
+        if f < 8:
+            mask = mask.view(N, 1, 9, f, output_stride, f, output_stride, H, W).mean(dim=(4, 6))
+
+        up_flow = F.unfold(f * flow, [3,3], padding=1)
         up_flow = up_flow.view(N, 2, 9, 1, 1, H, W)
 
         up_flow = torch.sum(mask * up_flow, dim=2)
         up_flow = up_flow.permute(0, 1, 4, 2, 5, 3)
-        return up_flow.reshape(N, 2, 8*H, 8*W)
+        return up_flow.reshape(N, 2, f*H, f*W)
     
     def sample_feature_map(self, coords, feat_t_quater, r=1):
         H, W = feat_t_quater.shape[-2:]
@@ -241,31 +257,75 @@ class MemoryDecoder(nn.Module):
 
     def encode_flow_token(self, cost_maps, coords, r=4):
         """
-            cost_maps   -   B*H1*W1, cost_heads_num, H2, W2
+            cost_maps   -   B*H1*W1, cost_heads_num, H2, W2, or a sparse stand-in with lookup() like TopKCostMaps
             coords      -   B, 2, H1, W1
         """
         coords = coords.permute(0, 2, 3, 1)
         batch, h1, w1, _ = coords.shape
+        centroid = coords.reshape(batch*h1*w1, 2)
 
-        dx = torch.linspace(-r, r, 2*r+1)
-        dy = torch.linspace(-r, r, 2*r+1)
-        delta = torch.stack(torch.meshgrid(dy, dx), axis=-1).to(coords.device)
-
-        centroid = coords.reshape(batch*h1*w1, 1, 1, 2)
-        delta = delta.view(1, 2*r+1, 2*r+1, 2)
-        coords = centroid + delta
-        corr = bilinear_sampler(cost_maps, coords)
+        if torch.is_tensor(cost_maps):
+            corr = window_lookup(cost_maps, None, centroid, r)
+        else:
+            rows = torch.arange(batch*h1*w1, device=coords.device)
+            corr = cost_maps.lookup(rows, centroid[:, None] + window_delta(r, coords.device))
        
         corr = corr.view(batch, h1, w1, -1).permute(0, 3, 1, 2)
         return corr
 
-    def forward(self, cost_memory, context, context_quater, feat_s_quater, feat_t_quater, data={}, flow_init=None, cost_patches=None):
+    def cost_coords(self, coords0, coords1):
+        """ coords1 in the pixel coordinates of data['cost_maps']: the target frame, or with cost_radius
+            the window of 2*cost_radius+1 pixels centred on each source pixel coords0
+        """
+        if self.cfg.cost_radius > 0 and not self.cfg.local_corr:
+            return coords1 - coords0 + self.cfg.cost_radius
+        return coords1
+
+    def decode_active(self, active, cost_maps, cost_patches, key, value, coords0, coords1, size, size_h3w3):
+        """ Local cost lookup and cross-attention for the active pixels only.
+
+            active  -   M, flat indices into B*H1*W1 of the pixels that are still refined
+            returns -   cost_forward [M, heads*81] and cost_global [M, C] of the active pixels
         """
+        B, _, H1, W1 = size
+        coords = coords1.permute(0, 2, 3, 1).reshape(B*H1*W1, 2)[active]
+        lookup = self.cost_coords(coords0.permute(0, 2, 3, 1).reshape(B*H1*W1, 2)[active], coords)
+
+        r = 4
+        if torch.is_tensor(cost_maps):
+            cost_forward = window_lookup(cost_maps, active, lookup, r).flatten(1)
+        else:
+            cost_forward = cost_maps.lookup(active, lookup[:, None] + window_delta(r, coords.device)).flatten(1)
+
+        if self.cfg.use_patch:
+            query = self.flow_token_encoder(self.encode_flow_token(cost_patches, self.cost_coords(coords0, coords1)/8.0, r=0))
+            query = query.permute(0, 2, 3, 1).reshape(B*H1*W1, 1, self.dim)[active]
+        else:
+            query = self.flow_token_encoder(cost_forward[:, :, None, None]).view(-1, 1, self.dim)
+
+        if self.cfg.use_rpe:
+            query_coord = coords - coords0.permute(0, 2, 3, 1).reshape(B*H1*W1, 2)[active]
+        else:
+            query_coord = coords
+        cost_global, _, _ = self.decoder_layer.cross_attend(query, key[active], value[active], None, query_coord[:, None], self.decoder_layer.patch_size, size_h3w3, query_hw=(H1, W1))
+
+        return cost_forward, cost_global[:, 0]
+
+    def refine(self, cost_memory, context, data={}, flow_init=None, cost_patches=None, iters=None, upsample=True, offset=None):
+        """ Generator over the refinement iterations, yields coords0, coords1, net and up_mask
+            (None unless upsample) after each iteration.
+
             memory: [B*H1*W1, H2'*W2', C]
             context: [B, D, H1, W1]
+            iters: number of refinement iterations, defaults to decoder_depth
+            offset: (x, y) position of the context in the target frame if it is a crop of the source
+                    frame, coords0 and coords1 are then in target frame coordinates
         """
+        self.freeze_stats = {'pixel_iters': 0, 'skipped': 0}
         cost_maps = data['cost_maps']
         coords0, coords1 = initialize_flow(context)
+        if offset is not None:
+            coords0 = coords1 = coords0 + coords0.new_tensor(offset).view(1, 2, 1, 1)
 
         if flow_init is not None:
             #print("[Using warm start]")
@@ -273,8 +333,6 @@ class MemoryDecoder(nn.Module):
 
         #flow = coords1
 
-        flow_predictions = []
-
         context = self.proj(context)
         net, inp = torch.split(context, [128, 128], dim=1)
         net = torch.tanh(net)
@@ -285,31 +343,45 @@ class MemoryDecoder(nn.Module):
         size = net.shape
         key, value = None, None
 
-        for idx in range(self.depth):
+        # inference only: pixels whose update fell below freeze_tol keep their flow and their last
+        # cost_forward / cost_global, only the active ones go through cost lookup and cross-attention
+        freeze = not self.training and self.cfg.freeze_tol > 0
+        active = None
+        B, _, H1, W1 = size
+
+        depth = self.depth if iters is None else iters
+        for idx in range(depth):
             coords1 = coords1.detach()
 
-            cost_forward = self.encode_flow_token(cost_maps, coords1)
+            if active is None:
+                cost_forward = self.encode_flow_token(cost_maps, self.cost_coords(coords0, coords1))
 
-            if self.cfg.use_patch:
-                if self.cfg.detach_local:
-                    _local_cost = self.encode_flow_token(cost_patches, coords1/8.0, r=0)
-                    _local_cost = _local_cost.contiguous().detach()
-                    query = self.flow_token_encoder(_local_cost)
+                if self.cfg.use_patch:
+                    if self.cfg.detach_local:
+                        _local_cost = self.encode_flow_token(cost_patches, self.cost_coords(coords0, coords1)/8.0, r=0)
+                        _local_cost = _local_cost.contiguous().detach()
+                        query = self.flow_token_encoder(_local_cost)
+                    else:
+                        query = self.flow_token_encoder(self.encode_flow_token(cost_patches, self.cost_coords(coords0, coords1)/8.0, r=0))
                 else:
-                    query = self.flow_token_encoder(self.encode_flow_token(cost_patches, coords1/8.0, r=0))
-            else:
-                if self.cfg.detach_local:
-                    _local_cost = cost_forward.contiguous().detach()
-                    query = self.flow_token_encoder(_local_cost)
-                else:
-                    query = self.flow_token_encoder(cost_forward)
-            query = query.permute(0, 2, 3, 1).contiguous().view(size[0]*size[2]*size[3], 1, self.dim)
+                    if self.cfg.detach_local:
+                        _local_cost = cost_forward.contiguous().detach()
+                        query = self.flow_token_encoder(_local_cost)
+                    else:
+                        query = self.flow_token_encoder(cost_forward)
+                query = query.permute(0, 2, 3, 1).contiguous().view(size[0]*size[2]*size[3], 1, self.dim)
 
-            if self.cfg.use_rpe:
-                query_coord = coords1 - coords0
+                if self.cfg.use_rpe:
+                    query_coord = coords1 - coords0
+                else:
+                    query_coord = coords1
+                cost_global, key, value = self.decoder_layer(query, key, value, cost_memory, query_coord, size, data['H3W3'])
             else:
-                query_coord = coords1
-            cost_global, key, value = self.decoder_layer(query, key, value, cost_memory, query_coord, size, data['H3W3'])
+                active_cost_forward, active_cost_global = self.decode_active(active, cost_maps, cost_patches, key, value, coords0, coords1, size, data['H3W3'])
+                cost_forward_flat[active] = active_cost_forward
+                cost_global_flat[active] = active_cost_global
+                cost_forward = cost_forward_flat.view(B, H1, W1, -1).permute(0, 3, 1, 2)
+                cost_global = cost_global_flat.view(B, H1, W1, -1).permute(0, 3, 1, 2)
 
             if self.cfg.r_16 > 0:
                 cost_forward_16 = self.encode_flow_token(data["cost_maps_16"], coords1*2.0, r=(self.cfg.r_16-1)//2)
@@ -321,15 +393,50 @@ class MemoryDecoder(nn.Module):
             flow = coords1 - coords0
              
             if self.cfg.gma is not None:
-                net, up_mask, delta_flow = self.update_block(net, inp, corr, flow, attention)
+                net, up_mask, delta_flow = self.update_block(net, inp, corr, flow, attention, upsample=upsample)
             else:
-                net, up_mask, delta_flow = self.update_block(net, inp, corr, flow)
+                net, up_mask, delta_flow = self.update_block(net, inp, corr, flow, upsample=upsample)
+
+            if active is not None:
+                delta_flow = delta_flow * active_mask
 
             # flow = delta_flow
             coords1 = coords1 + delta_flow
 
-            flow_up = self.upsample_flow(coords1 - coords0, up_mask)
-            flow_predictions.append(flow_up)
+            yield coords0, coords1, net, up_mask
+
+            if freeze:
+                if active is None:
+                    active_mask = torch.ones_like(delta_flow[:, :1])
+                    cost_forward_flat = cost_forward.permute(0, 2, 3, 1).reshape(B*H1*W1, -1)
+                    cost_global_flat = cost_global.permute(0, 2, 3, 1).reshape(B*H1*W1, -1)
+                self.freeze_stats['pixel_iters'] += B*H1*W1
+                if active is not None:
+                    self.freeze_stats['skipped'] += B*H1*W1 - active.numel()
+
+                active_mask = active_mask * (delta_flow.norm(dim=1, keepdim=True) >= self.cfg.freeze_tol)
+                active = torch.nonzero(active_mask.view(-1)).squeeze(1)
+                if active.numel() == 0:
+                    self.freeze_stats['pixel_iters'] += B*H1*W1 * (depth - idx - 1)
+                    self.freeze_stats['skipped'] += B*H1*W1 * (depth - idx - 1)
+                    break
+
+    def forward(self, cost_memory, context, context_quater, feat_s_quater, feat_t_quater, data={}, flow_init=None, cost_patches=None, iters=None, output_stride=1, offset=None):
+        """
+            memory: [B*H1*W1, H2'*W2', C]
+            context: [B, D, H1, W1]
+            iters: number of refinement iterations, defaults to decoder_depth
+            output_stride: inference only, 1 (full), 4 or 8 (the 1/8 flow, no upsampling) resolution
+                           of the returned flow, in pixels of that resolution
+            offset: (x, y) position of the context in the target frame, see refine
+        """
+        flow_predictions = []
+
+        for coords0, coords1, net, up_mask in self.refine(cost_memory, context, data, flow_init, cost_patches, iters, upsample=self.training, offset=offset):
+            # at inference only the final flow is upsampled, after the loop
+            if self.training:
+                flow_up = self.upsample_flow(coords1 - coords0, up_mask)
+                flow_predictions.append(flow_up)
         
         if self.cfg.quater_refine:
             coords1 = coords1.detach()
@@ -337,11 +444,16 @@ class MemoryDecoder(nn.Module):
             flow = 2 * F.interpolate(coords1-coords0, size=new_size, mode='bilinear', align_corners=True)
             flow_up = self.quater_upsampler(flow, context_quater, feat_s_quater, feat_t_quater, r=1)
             flow_predictions.append(flow_up)
+        elif not self.training and output_stride == 8:
+            flow_up = coords1 - coords0
+        elif not self.training:
+            # same up mask as the update block computes from the final hidden state
+            flow_up = self.upsample_flow(coords1 - coords0, .25 * self.update_block.mask(net), output_stride)
 
         if self.training:
             return flow_predictions
         else:
-            return flow_predictions[-1], coords1-coords0
+            return flow_up, coords1-coords0
     
     def pretrain_forward(self, cost_memory, context, data={}, flow_init=None, cost_patches=None, mask_for_patch1=None):
         
@@ -8,12 +8,13 @@ from torch import einsum
 from einops.layers.torch import Rearrange
 from einops import rearrange
 
-from ...utils.utils import coords_grid, bilinear_sampler, upflow8
+from ...utils.utils import cached, cached_coords_grid, bilinear_sampler, upflow8
 from .attention import BroadMultiHeadAttention, MultiHeadAttention, LinearPositionEmbeddingSine, ExpPositionEmbeddingSine
 from ..encoders import twins_svt_large, convnext_large
 from typing import Optional, Tuple
 from .twins import Size_, PosConv
 from .cnn import TwinsSelfAttentionLayer, TwinsCrossAttentionLayer, BasicEncoder
+from .cost_maps import TopKCostMaps, CompactCostMaps, FeatureCostMaps
 
 from timm.models.layers import Mlp, DropPath, activations, to_2tuple, trunc_normal_
 
@@ -57,7 +58,12 @@ class PatchEmbed(nn.Module):
         )
         self.norm = nn.LayerNorm(embed_dim+64)
 
-    def forward(self, x, mask_for_patch1=None, mask_for_patch2=None, mask_for_patch3=None):
+    def forward(self, x, mask_for_patch1=None, mask_for_patch2=None, mask_for_patch3=None, rows=None, origin=None, scale=1):
+        """ rows: source pixel indices of the cost maps in x if they are a chunk of one frame
+            origin: [B, 2] target frame position (x, y) of the top left pixel of each cost map if they
+                    are windows centred on their source pixel, see MemoryEncoder.corr_local
+            scale: target frame pixels per cost map pixel if the cost maps are on a coarser grid
+        """
         B, C, H, W = x.shape    # C == 1
 
         pad_l = pad_t = 0
@@ -72,19 +78,68 @@ class PatchEmbed(nn.Module):
                     x = x*(1-masks[idx//2])
             x = layer(x)
 
+        return self.embed(x, (H, W), rows, origin, scale)
+
+    def project_target(self, fmap2):
+        """ First conv of proj applied to the target features: [B, heads*d, H2, W2] -> [B, heads, d, C, H2', W2'].
+
+            The conv is linear and the cost maps are linear in fmap2, so the first layer output of the
+            cost maps <fmap1_p, fmap2> is <fmap1_p, project_target(fmap2)> plus the bias, see forward_factorized.
+        """
+        conv = self.proj[0]
+        heads, C = conv.in_channels, conv.out_channels
+        B, _, H, W = fmap2.shape
+
+        pad_r = (self.patch_size - W % self.patch_size) % self.patch_size
+        pad_b = (self.patch_size - H % self.patch_size) % self.patch_size
+        fmap2 = F.pad(fmap2, (0, pad_r, 0, pad_b))
+
+        fmap2 = rearrange(fmap2, 'b (heads d) h w -> (b d) heads h w', heads=heads)
+        weight = conv.weight.transpose(0, 1).reshape(heads*C, 1, *conv.kernel_size)
+        target = F.conv2d(fmap2, weight, stride=conv.stride, padding=conv.padding, groups=heads)
+
+        return rearrange(target, '(b d) (heads c) h w -> b heads d c h w', b=B, heads=heads)
+
+    def forward_factorized(self, fmap1, target, size, rows=None):
+        """ forward() of the cost maps of the source features fmap1 [N, heads, d] without building them:
+            target is project_target() of one target frame [heads, d, C, H2', W2'], size its size (H2, W2)
+        """
+        x = einsum('nhd, hdcij -> ncij', fmap1, target) + self.proj[0].bias[:, None, None]
+        for layer in self.proj[1:]:
+            x = layer(x)
+
+        return self.embed(x, size, rows)
+
+    def embed(self, x, size, rows=None, origin=None, scale=1):
+        """ Coordinate encoding, ffn and norm of the projected patches x [B, C, H3, W3] of cost maps of size (H, W) """
+        B = x.shape[0]
+        H, W = size
         out_size = x.shape[2:]
 
-        patch_coord = coords_grid(B, out_size[0], out_size[1]).to(x.device) * self.patch_size + self.patch_size/2 # in feature coordinate space
-        if self.cfg.use_rpe:
-            center_coord = coords_grid(1, H, W).to(x.device)
-            center_coord = center_coord.permute(2, 3, 1, 0).reshape(H*W, 2, 1, 1).repeat(B//(H*W), 1, 1, 1)
+        if origin is None and not self.cfg.use_rpe:
+            # same for every cost map: one cached encoding, its part of the first ffn layer broadcasts over B
+            conv = self.ffn_with_coord[0]
+            patch_coord_enc = self.patch_coord_enc(out_size, scale, x.device)
+            x = F.conv2d(x, conv.weight[:, :x.shape[1]]) + F.conv2d(patch_coord_enc, conv.weight[:, x.shape[1]:], conv.bias)
+            x = self.ffn_with_coord[1:](x)
+            x = self.norm(x.flatten(2).transpose(1, 2))
+            return x, out_size
+
+        patch_coord = cached_coords_grid(out_size[0], out_size[1], x.device) * self.patch_size + self.patch_size/2 # in feature coordinate space
+        patch_coord = patch_coord * scale
+        if origin is not None:
+            # windows: relative to their centre pixel, else in target frame coordinates
+            if self.cfg.use_rpe:
+                origin = -x.new_tensor([(W-1)/2, (H-1)/2]).expand(B, 2)
+            patch_coord = patch_coord + origin[:, :, None, None]
+        else:
+            center_coord = cached_coords_grid(H, W, x.device)
+            center_coord = center_coord.permute(2, 3, 1, 0).reshape(H*W, 2, 1, 1)
+            center_coord = center_coord.repeat(B//(H*W), 1, 1, 1) if rows is None else center_coord[rows]
             patch_coord = patch_coord - center_coord
         
         patch_coord = patch_coord.view(B, 2, -1).permute(0, 2, 1)
-        if self.pe == 'linear':
-            patch_coord_enc = LinearPositionEmbeddingSine(patch_coord, dim=64)
-        elif self.pe == 'exp':
-            patch_coord_enc = ExpPositionEmbeddingSine(patch_coord, dim=64)
+        patch_coord_enc = self.encode_coords(patch_coord)
         patch_coord_enc = patch_coord_enc.permute(0, 2, 1).view(B, -1, out_size[0], out_size[1])
 
         x_pe = torch.cat([x, patch_coord_enc], dim=1)
@@ -94,6 +149,21 @@ class PatchEmbed(nn.Module):
 
         return x, out_size
 
+    def encode_coords(self, patch_coord):
+        if self.pe == 'linear':
+            return LinearPositionEmbeddingSine(patch_coord, dim=64)
+        elif self.pe == 'exp':
+            return ExpPositionEmbeddingSine(patch_coord, dim=64)
+
+    def patch_coord_enc(self, out_size, scale, device):
+        """ [1, 64, H3, W3] encoding of the patch centres in target frame coordinates, from the cache """
+        def encode():
+            patch_coord = cached_coords_grid(out_size[0], out_size[1], device) * self.patch_size + self.patch_size/2
+            patch_coord = (patch_coord * scale).view(1, 2, -1).permute(0, 2, 1)
+            return self.encode_coords(patch_coord).permute(0, 2, 1).reshape(1, -1, out_size[0], out_size[1])
+
+        return cached(('patch_coord_enc', tuple(out_size), self.patch_size, scale, self.pe, torch.device(device)), encode)
+
 from .twins import Block, CrossBlock
 
 class VerticalSelfAttentionLayer(nn.Module):
@@ -153,16 +223,19 @@ class SelfAttentionLayer(nn.Module):
             nn.Dropout(dropout)
         )
 
-    def forward(self, x):
+    def forward(self, x, tokens=None):
         """
-            x: [BH1W1, H3W3, D]
+            x: [BH1W1, H3W3, D], or [B*tokens, H1W1, D] to attend across the tokens of every source pixel
         """
         short_cut = x
         x = self.norm1(x)
 
         q, k, v = self.q(x), self.k(x), self.v(x)
 
-        x = self.multi_head_attn(q, k, v)
+        if tokens is None:
+            x = self.multi_head_attn(q, k, v)
+        else:
+            x = self.multi_head_attn.forward_tokens(q, k, v, tokens)
 
         x = self.proj(x)
         x = short_cut + self.proj_drop(x)
@@ -255,12 +328,15 @@ class CostPerceiverEncoder(nn.Module):
 
         return ids_keep, mask_for_keys, mask_for_patch1, mask_for_patch2, mask_for_patch3, ids_restore
 
-    def forward(self, cost_volume, data, context=None):
+    def forward(self, cost_volume, data, context=None, origin=None, scale=1):
+        """ origin: [B*H1*W1, 2] top left target pixel of each cost map if cost_volume holds windows
+            scale: target pixels per cost map pixel if cost_volume is on a coarser target grid
+        """
         B, heads, H1, W1, H2, W2 = cost_volume.shape
         cost_maps = cost_volume.permute(0, 2, 3, 1, 4, 5).contiguous().view(B*H1*W1, self.cfg.cost_heads_num, H2, W2)
-        data['cost_maps'] = cost_maps
+        data['cost_maps'] = self.store_cost_maps(cost_maps)
        
-        x, size = self.patch_embed(cost_maps)   # B*H1*W1, size[0]*size[1], C
+        x, size = self.patch_embed(cost_maps, origin=origin, scale=scale)   # B*H1*W1, size[0]*size[1], C
         data['H3W3'] = size
         H3, W3 = size
 
@@ -268,24 +344,108 @@ class CostPerceiverEncoder(nn.Module):
 
         x = self.input_layer(self.latent_tokens, x, size)
 
-        short_cut = x
+        x = self.encode_latents(x, (B, H1, W1), context)
 
-        for idx, layer in enumerate(self.encoder_layers):
+        _B, _HW, _C = cost_patches.shape
+        cost_patches = cost_patches.reshape(_B, H3, W3, _C).permute(0, 3, 1, 2)
 
-            x = layer(x)
-            if self.cfg.vertical_encoder_attn is not None:
-                x = x.view(B, H1*W1, self.cfg.cost_latent_token_num, -1).permute(0, 2, 1, 3).reshape(B*self.cfg.cost_latent_token_num, H1*W1, -1)
-                x = self.vertical_encoder_layers[idx](x, (H1, W1), context)
-                x = x.view(B, self.cfg.cost_latent_token_num, H1*W1, -1).permute(0, 2, 1, 3).reshape(B*H1*W1, self.cfg.cost_latent_token_num, -1)
+        return x, cost_patches
 
-        if self.cfg.cost_encoder_res is True:
-            x = x + short_cut
+    def forward_chunked(self, corr_rows, shape, data, context=None, chunk=1024, embed_rows=None):
+        """ forward() without the full cost volume and patch embeddings in memory.
 
-        _B, _HW, _C = cost_patches.shape
-        cost_patches = cost_patches.reshape(_B, H3, W3, _C).permute(0, 3, 1, 2)
+            corr_rows(b, rows) returns the cost maps [len(rows), heads, H2, W2] of the source pixels rows of
+            frame b. They are embedded and encoded to latent tokens chunk source pixels at a time, so
+            the PatchEmbed and input_layer activations scale with the chunk instead of B*H1*W1, and
+            written into data['cost_maps'] for the decoder lookups, see empty_cost_maps. Cost patches
+            are only kept if use_patch.
+            embed_rows(b, rows), if given, replaces the patch_embed call on the cost maps of the block.
+        """
+        B, H1, W1, H2, W2 = shape
+        cost_maps = x = cost_patches = None
+        for b in range(B):
+            for start in range(0, H1*W1, chunk):
+                rows = torch.arange(start, min(start + chunk, H1*W1))
+                maps = corr_rows(b, rows)
+                if embed_rows is not None:
+                    patches, size = embed_rows(b, rows)
+                else:
+                    patches, size = self.patch_embed(maps, rows=rows if self.cfg.use_rpe else None)
+                latents = self.input_layer(self.latent_tokens, patches, size)
+
+                if x is None:
+                    cost_maps = self.empty_cost_maps(maps, B*H1*W1)
+                    x = latents.new_empty(B*H1*W1, *latents.shape[1:])
+                    if self.cfg.use_patch:
+                        cost_patches = patches.new_empty(B*H1*W1, *patches.shape[1:])
+                if cost_maps is not None:
+                    cost_maps[b*H1*W1 + rows] = maps
+                x[b*H1*W1 + rows] = latents
+                if cost_patches is not None:
+                    cost_patches[b*H1*W1 + rows] = patches
+
+        data['cost_maps'] = cost_maps
+        data['H3W3'] = size
+        H3, W3 = size
+
+        x = self.encode_latents(x, (B, H1, W1), context)
+
+        if cost_patches is not None:
+            _B, _HW, _C = cost_patches.shape
+            cost_patches = cost_patches.reshape(_B, H3, W3, _C).permute(0, 3, 1, 2)
 
         return x, cost_patches
 
+    def empty_cost_maps(self, maps, N):
+        """ Storage for the cost maps of N source pixels, like the cost maps of one chunk maps.
+
+            None if the decoder recomputes its lookups from the features (FeatureCostMaps): with
+            local_corr, and with cost_chunk unless cost_topk or cost_dtype select a storage, as dense
+            cost maps of the whole frame would bring back the quadratic memory the chunks avoid.
+        """
+        if self.cfg.local_corr:
+            return None
+        if self.cfg.cost_topk > 0:
+            dtype = CompactCostMaps.dtypes.get(self.cfg.cost_dtype, maps.dtype)
+            return TopKCostMaps(N, maps.shape[1], maps.shape[2:], self.cfg.cost_topk, device=maps.device, dtype=dtype)
+        if self.cfg.cost_dtype != 'float32':
+            return CompactCostMaps(N, maps.shape[1], maps.shape[2:], self.cfg.cost_dtype, device=maps.device)
+        if self.cfg.cost_chunk > 0:
+            return None
+        return maps.new_empty(N, *maps.shape[1:])
+
+    def store_cost_maps(self, cost_maps):
+        """ cost_maps [N, heads, H2, W2] as kept for the decoder lookups, in cost_dtype """
+        if self.cfg.local_corr:
+            return None
+        if self.cfg.cost_dtype == 'float32':
+            return cost_maps
+        stored = CompactCostMaps(len(cost_maps), cost_maps.shape[1], cost_maps.shape[2:], self.cfg.cost_dtype, device=cost_maps.device)
+        stored[:] = cost_maps
+        return stored
+
+    def encode_latents(self, x, shape, context=None):
+        """ Self-attention and vertical layers over the latent tokens x [B*H1*W1, K, C] """
+        B, H1, W1 = shape
+        K = self.cfg.cost_latent_token_num
+        short_cut = x
+
+        if self.cfg.vertical_encoder_attn is not None:
+            # one layout [B*K, H1*W1, C] for the whole loop, the self-attention layers attend across its rows
+            x = x.view(B, H1*W1, K, -1).transpose(1, 2).reshape(B*K, H1*W1, -1)
+            for layer, vertical_layer in zip(self.encoder_layers, self.vertical_encoder_layers):
+                x = layer(x, tokens=K)
+                x = vertical_layer(x, (H1, W1), context)
+            x = x.view(B, K, H1*W1, -1).transpose(1, 2).reshape(B*H1*W1, K, -1)
+        else:
+            for layer in self.encoder_layers:
+                x = layer(x)
+
+        if self.cfg.cost_encoder_res is True:
+            x = x + short_cut
+
+        return x
+
     def pretrain_forward(self, cost_volume_outter, cost_volume, data, context=None, mask=None):
         B, heads, H1, W1, H2, W2 = cost_volume_outter.shape
         cost_maps = cost_volume_outter.permute(0, 2, 3, 1, 4, 5).contiguous().view(B*H1*W1, self.cfg.cost_heads_num, H2, W2)
@@ -307,18 +467,7 @@ class CostPerceiverEncoder(nn.Module):
 
         x = self.input_layer(self.latent_tokens, x, size, ids_keep)
 
-        short_cut = x
-
-        for idx, layer in enumerate(self.encoder_layers):
-
-            x = layer(x)
-            if self.cfg.vertical_encoder_attn is not None:
-                x = x.view(B, H1*W1, self.cfg.cost_latent_token_num, -1).permute(0, 2, 1, 3).reshape(B*self.cfg.cost_latent_token_num, H1*W1, -1)
-                x = self.vertical_encoder_layers[idx](x, (H1, W1), context)
-                x = x.view(B, self.cfg.cost_latent_token_num, H1*W1, -1).permute(0, 2, 1, 3).reshape(B*H1*W1, self.cfg.cost_latent_token_num, -1)
-
-        if self.cfg.cost_encoder_res is True:
-            x = x + short_cut
+        x = self.encode_latents(x, (B, H1, W1), context)
 
         _B, _HW, _C = cost_patches.shape
         cost_patches = cost_patches.reshape(_B, H3, W3, _C).permute(0, 3, 1, 2)
@@ -353,6 +502,11 @@ class MemoryEncoder(nn.Module):
 
         self.cost_perceiver_encoder = CostPerceiverEncoder(cfg)
 
+        if cfg.cost_target_stride > 1:
+            assert cfg.cost_radius > 0 or cfg.local_corr, "cost_target_stride > 1 needs cost_radius > 0 or local_corr for the fine decoder lookups"
+            assert not cfg.use_rpe and not cfg.use_patch, "cost_target_stride > 1 does not support use_rpe or use_patch"
+        assert not (cfg.cost_topk > 0 and cfg.cost_dtype == 'int8'), "cost_topk keeps float values, use cost_dtype float16 or bfloat16"
+
         if self.cfg.pretrain_mode and self.cfg.crop_cost_volume:
             print("[H_offset is {}, W_offset is {}, and crop_cost_volume to get inner cost volume]".format(self.cfg.H_offset, self.cfg.W_offset))
 
@@ -368,6 +522,54 @@ class MemoryEncoder(nn.Module):
 
         return corr
     
+    def corr_local(self, fmap1, fmap2, r, offset=(0, 0)):
+        """ corr() restricted to the (2r+1) x (2r+1) target window centred on each source pixel:
+            [B, heads, H1, W1, 2r+1, 2r+1], zero outside the target frame. O(H1*W1*r^2) instead of O((H1*W1)^2).
+            offset: (x, y) position of fmap1 in the frame of fmap2 if fmap1 is a crop of the source frame
+        """
+        batch, dim, ht, wd = fmap1.shape
+        heads = self.cfg.cost_heads_num
+        ox, oy = offset
+
+        fmap1 = fmap1.view(batch, heads, dim // heads, ht, wd)
+        fmap2 = F.pad(fmap2, (r, r, r, r))
+        fmap2 = fmap2.view(batch, heads, dim // heads, *fmap2.shape[2:])
+
+        corr = fmap1.new_empty(batch, ht, wd, heads, 2*r+1, 2*r+1)
+        for i in range(2*r+1):
+            for j in range(2*r+1):
+                corr[..., i, j] = (fmap1 * fmap2[..., oy+i:oy+i+ht, ox+j:ox+j+wd]).sum(dim=2).permute(0, 2, 3, 1)
+
+        return corr.permute(0, 3, 1, 2, 4, 5)
+
+    def corr_rows(self, fmap1, fmap2):
+        """ corr() one block of source pixels at a time: returns corr_rows(b, rows) -> [len(rows), heads, H2, W2] """
+        _, _, ht2, wd2 = fmap2.shape
+
+        fmap1 = rearrange(fmap1, 'b (heads d) h w -> b (h w) heads d', heads=self.cfg.cost_heads_num)
+        fmap2 = rearrange(fmap2, 'b (heads d) h w -> b heads (h w) d', heads=self.cfg.cost_heads_num)
+
+        def corr_rows(b, rows):
+            corr = einsum('ihd, hjd -> ihj', fmap1[b, rows], fmap2[b])
+            return corr.view(len(rows), self.cfg.cost_heads_num, ht2, wd2)
+
+        return corr_rows
+
+    def embed_rows(self, fmap1, fmap2):
+        """ patch_embed of the cost maps of corr_rows(b, rows), with the first conv applied once to fmap2
+            instead of to every cost map: returns embed_rows(b, rows) -> (patches, size)
+        """
+        patch_embed = self.cost_perceiver_encoder.patch_embed
+        size = fmap2.shape[2:]
+        target = patch_embed.project_target(fmap2)
+
+        fmap1 = rearrange(fmap1, 'b (heads d) h w -> b (h w) heads d', heads=self.cfg.cost_heads_num)
+
+        def embed_rows(b, rows):
+            return patch_embed.forward_factorized(fmap1[b, rows], target[b], size, rows=rows if self.cfg.use_rpe else None)
+
+        return embed_rows
+
     def corr_16(self, fmap1, fmap2):
 
         batch, dim, ht, wd = fmap1.shape
@@ -383,29 +585,85 @@ class MemoryEncoder(nn.Module):
 
         return corr
 
-    def forward(self, img1, img2, data, context=None):
+    def encode_features(self, img, stage1=False):
+        """ 1/8 resolution features of a stack of frames, each frame is encoded independently.
+            With stage1 also returns the 1/4 resolution stage-1 map of the feature encoder, see r_16.
+        """
+        feat, feat_16 = self.feat_encoder(img)
 
-        feat_s, _ = self.feat_encoder(img1)
-        feat_t, _ = self.feat_encoder(img2)
+        if self.cfg.use_convertor:
+            feat = self.channel_convertor(feat)
 
-        feat_s_16 = None
-        feat_t_16 = None
+        if stage1:
+            return feat, feat_16
+        return feat
 
-        B, C, H, W = feat_s.shape
-        size = (H, W)
+    def forward(self, img1, img2, data, context=None):
 
-        if self.cfg.use_convertor:
-            feat_s = self.channel_convertor(feat_s)
-            feat_t = self.channel_convertor(feat_t)
+        feat_s, feat_s_16 = self.encode_features(img1, stage1=True)
+        feat_t, feat_t_16 = self.encode_features(img2, stage1=True)
+
+        return self.forward_features(feat_s, feat_t, data, context, feat_s_16=feat_s_16, feat_t_16=feat_t_16)
+
+    def encode_cost(self, feat_s, feat_t, data, context=None, offset=(0, 0)):
+        """ Cost memory of the modes that do not build the dense cost volume at once, see the cost_* options """
+        if self.cfg.cost_target_stride > 1:
+            # global cost memory on the coarse target grid, fine windows for the decoder lookups
+            s = self.cfg.cost_target_stride
+            cost_volume = self.corr(feat_s, F.avg_pool2d(feat_t, s, ceil_mode=True))
+            x, cost_patches = self.cost_perceiver_encoder(cost_volume, data, context, scale=s)
+            del cost_volume
+
+            if not self.cfg.local_corr:
+                B, _, H1, W1 = feat_s.shape
+                r = self.cfg.cost_radius
+                cost_maps = self.corr_local(feat_s, feat_t, r, offset)
+                cost_maps = cost_maps.permute(0, 2, 3, 1, 4, 5).reshape(B*H1*W1, self.cfg.cost_heads_num, 2*r+1, 2*r+1)
+                data['cost_maps'] = self.cost_perceiver_encoder.store_cost_maps(cost_maps)
+            return x, cost_patches
+
+        if self.cfg.cost_radius > 0:
+            r = self.cfg.cost_radius
+            cost_volume = self.corr_local(feat_s, feat_t, r, offset)
+            B, _, H1, W1 = feat_s.shape
+            origin = cached_coords_grid(H1, W1, feat_s.device).expand(B, -1, -1, -1).permute(0, 2, 3, 1).reshape(B*H1*W1, 2) - r
+            origin = origin + origin.new_tensor(offset)
+            return self.cost_perceiver_encoder(cost_volume, data, context, origin=origin)
+
+        corr_rows = self.corr_rows(feat_s, feat_t)
+        embed_rows = self.embed_rows(feat_s, feat_t) if self.cfg.factorized_embed else None
+        shape = (feat_s.shape[0], *feat_s.shape[2:], *feat_t.shape[2:])
+        chunk = self.cfg.cost_chunk if self.cfg.cost_chunk > 0 else shape[1]*shape[2]
+        return self.cost_perceiver_encoder.forward_chunked(corr_rows, shape, data, context, chunk=chunk, embed_rows=embed_rows)
+
+    def forward_features(self, feat_s, feat_t, data, context=None, offset=None, feat_s_16=None, feat_t_16=None):
+        """ offset: (x, y) position of feat_s and context in the frame of feat_t, at 1/8 resolution,
+                    if only a region of the source frame is matched against the whole target frame
+            feat_s_16, feat_t_16: 1/4 resolution stage-1 maps of encode_features(img, stage1=True), needed if r_16 > 0
+        """
+        if offset is not None:
+            assert not self.cfg.use_rpe, "a source region (offset) does not support use_rpe"
 
-        cost_volume = self.corr(feat_s, feat_t)
         if self.cfg.r_16 > 0:
+            # every 1/8 source pixel against the 1/4 target map, the decoder samples r_16 x r_16 windows of it
+            assert feat_s_16 is not None and feat_t_16 is not None, "r_16 > 0 needs the stage-1 maps of encode_features(img, stage1=True)"
+            assert offset is None, "r_16 > 0 does not support a source region (offset)"
             cost_volume_16 = self.corr_16(feat_s_16, feat_t_16)
             B, heads, H1, W1, H2, W2 = cost_volume_16.shape
             cost_maps = cost_volume_16.permute(0, 2, 3, 1, 4, 5).contiguous().view(B*H1*W1, self.cfg.cost_heads_num, H2, W2)
             data['cost_maps_16'] = cost_maps
+            del cost_volume_16
+
+        if self.cfg.cost_target_stride > 1 or self.cfg.cost_radius > 0 or self.cfg.cost_chunk > 0 or self.cfg.factorized_embed or self.cfg.cost_topk > 0:
+            x, cost_patches = self.encode_cost(feat_s, feat_t, data, context, offset if offset is not None else (0, 0))
+        else:
+            cost_volume = self.corr(feat_s, feat_t)
+            x, cost_patches = self.cost_perceiver_encoder(cost_volume, data, context)
 
-        x, cost_patches = self.cost_perceiver_encoder(cost_volume, data, context)
+        if data.get('cost_maps') is None:
+            # local_corr or cost_chunk: the decoder recomputes its cost lookups from the features, no
+            # cost maps are kept beyond the cost encoder
+            data['cost_maps'] = FeatureCostMaps(feat_s, feat_t, self.cfg.cost_heads_num)
 
         return x, cost_patches, feat_s_16, feat_t_16
 
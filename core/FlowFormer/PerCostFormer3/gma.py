@@ -1,5 +1,7 @@
 import torch
+import torch.nn.functional as F
 from torch import nn, einsum
+from torch.utils.checkpoint import checkpoint
 from einops import rearrange
 
 
@@ -31,6 +33,26 @@ class RelPosEmb(nn.Module):
         return height_score + width_score
 
 
+def attend_rows(q, k, v):
+    """ The Attention softmax and the Aggregate product for a block of query rows q """
+    attn = einsum('b h i d, b h j d -> b h i j', q, k).softmax(dim=-1)
+    return einsum('b h i j, b h j d -> b h i d', attn, v)
+
+
+def attend_chunked(q, k, v, chunk):
+    """ attend_rows over blocks of chunk query rows: only a chunk x (h*w) block of the attention exists at a
+        time, when training it is recomputed in the backward pass rather than kept
+    """
+    out = []
+    for start in range(0, q.shape[2], chunk):
+        block = q[:, :, start:start+chunk]
+        if torch.is_grad_enabled() and any(t.requires_grad for t in (q, k, v)):
+            out.append(checkpoint(attend_rows, block, k, v, use_reentrant=False))
+        else:
+            out.append(attend_rows(block, k, v))
+    return torch.cat(out, dim=2)
+
+
 class Attention(nn.Module):
     def __init__(
         self,
@@ -50,6 +72,7 @@ class Attention(nn.Module):
         self.to_qk = nn.Conv2d(dim, inner_dim * 2, 1, bias=False)
 
         self.pos_emb = RelPosEmb(max_pos_size, dim_head)
+        self.backend = 'einsum'
 
     def forward(self, fmap):
         heads, b, c, h, w = self.heads, *fmap.shape
@@ -68,6 +91,10 @@ class Attention(nn.Module):
         #     sim = sim_content + sim_pos
 
         # else:
+        if self.backend == 'sdpa' or self.args.gma_chunk > 0:
+            # the scores are not built here, Aggregate attends with the queries and keys
+            return tuple(rearrange(t, 'b h x y d -> b h (x y) d') for t in (q, k))
+
         sim = einsum('b h x y d, b h u v d -> b h x y u v', q, k)
 
         sim = rearrange(sim, 'b h x y u v -> b h (x y) (u v)')
@@ -100,11 +127,18 @@ class Aggregate(nn.Module):
             self.project = None
 
     def forward(self, attn, fmap):
+        """ attn: output of Attention, the attention weights or with the sdpa backend or gma_chunk its (scaled) queries and keys """
         heads, b, c, h, w = self.heads, *fmap.shape
 
         v = self.to_v(fmap)
         v = rearrange(v, 'b (h d) x y -> b h (x y) d', h=heads)
-        out = einsum('b h i j, b h j d -> b h i d', attn, v)
+        if isinstance(attn, tuple) and self.args.gma_chunk > 0:
+            out = attend_chunked(*attn, v, self.args.gma_chunk)
+        elif isinstance(attn, tuple):
+            q, k = attn
+            out = F.scaled_dot_product_attention(q, k, v, scale=1.)
+        else:
+            out = einsum('b h i j, b h j d -> b h i d', attn, v)
         out = rearrange(out, 'b h (x y) d -> b (h d) x y', x=h, y=w)
 
         if self.project is not None:
@@ -2,13 +2,15 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 
-from ...utils.utils import coords_grid
+from ...utils.utils import cached_coords_grid
 
 def initialize_flow(img):
-    """ Flow is represented as difference between two means flow = mean1 - mean0"""
+    """ Flow is represented as difference between two means flow = mean1 - mean0,
+        both are views of one cached grid: update them out of place
+    """
     N, C, H, W = img.shape
-    mean = coords_grid(N, H, W).to(img.device)
-    mean_init = coords_grid(N, H, W).to(img.device)
+    mean = cached_coords_grid(H, W, img.device).expand(N, -1, -1, -1)
+    mean_init = mean
 
     # optical flow computed as difference: flow = mean1 - mean0
     return mean, mean_init
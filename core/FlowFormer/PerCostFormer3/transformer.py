@@ -1,4 +1,6 @@
 import loguru
+import math
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -12,6 +14,29 @@ from .twins import PosConv
 from .encoder import MemoryEncoder
 from .decoder import MemoryDecoder
 from .cnn import BasicEncoder
+from .attention import set_attention_backend
+from ...utils.utils import forward_interpolate
+
+def _frame_chunks(frames, frame_batch):
+    chunk = []
+    for frame in frames:
+        chunk.append(frame if frame.dim() == 4 else frame[None])
+        if len(chunk) == frame_batch:
+            yield torch.cat(chunk)
+            chunk = []
+    if chunk:
+        yield torch.cat(chunk)
+
+def _roi_regions(boxes, size, dilation):
+    """ 1/8 resolution regions (x0, y0, x1, y1) of the source image boxes (x0, y0, x1, y1) in pixels,
+        grown by dilation pixels on every side and clipped to the H1 x W1 = size frame
+    """
+    H1, W1 = size
+    for x0, y0, x1, y1 in boxes:
+        x0, y0 = max(math.floor((x0 - dilation) / 8), 0), max(math.floor((y0 - dilation) / 8), 0)
+        x1, y1 = min(math.ceil((x1 + dilation) / 8), W1), min(math.ceil((y1 + dilation) / 8), H1)
+        assert x0 < x1 and y0 < y1, "empty region of interest"
+        yield x0, y0, x1, y1
 
 class FlowFormer(nn.Module):
     def __init__(self, cfg):
@@ -43,26 +68,161 @@ class FlowFormer(nn.Module):
             for param in self.context_encoder.parameters():
                 param.requires_grad = False
 
+        set_attention_backend(self, cfg.attention_backend)
+
 
-    def forward(self, image1, image2, mask=None, output=None, flow_init=None):
+    def forward(self, image1, image2, mask=None, output=None, flow_init=None, iters=None, output_stride=1):
         if self.cfg.pretrain_mode:
             loss = self.pretrain_forward(image1, image2, mask=mask, output=output)
             return loss
         else:
-            # Following https://github.com/princeton-vl/RAFT/
-            image1 = 2 * (image1 / 255.0) - 1.0
-            image2 = 2 * (image2 / 255.0) - 1.0
+            if self.cfg.r_16 > 0:
+                context, feat_s, feat_t, feat_s_16, feat_t_16 = self.encode_images(image1, image2, stage1=True)
+                return self.forward_features(context, feat_s, feat_t, flow_init=flow_init, iters=iters, output_stride=output_stride, feat_s_16=feat_s_16, feat_t_16=feat_t_16)
 
-            data = {}
-            
-            context, _ = self.context_encoder(image1)
-            context_quater = None
+            context, feat_s, feat_t = self.encode_images(image1, image2)
+
+            return self.forward_features(context, feat_s, feat_t, flow_init=flow_init, iters=iters, output_stride=output_stride)
+
+    def encode_images(self, image1, image2, stage1=False):
+        """ Run the context and feature encoders, returns 1/8 resolution context, feat_s and feat_t,
+            with stage1 also the 1/4 resolution stage-1 maps feat_s_16 and feat_t_16 for r_16
+        """
+        # Following https://github.com/princeton-vl/RAFT/
+        image1 = 2 * (image1 / 255.0) - 1.0
+        image2 = 2 * (image2 / 255.0) - 1.0
+
+        context, _ = self.context_encoder(image1)
+        if stage1:
+            feat_s, feat_s_16 = self.memory_encoder.encode_features(image1, stage1=True)
+            feat_t, feat_t_16 = self.memory_encoder.encode_features(image2, stage1=True)
+            return context, feat_s, feat_t, feat_s_16, feat_t_16
+
+        feat_s = self.memory_encoder.encode_features(image1)
+        feat_t = self.memory_encoder.encode_features(image2)
+
+        return context, feat_s, feat_t
+
+    def forward_anytime(self, image1, image2, deadline=None, iters=None, flow_init=None, output_stride=1):
+        """ Anytime inference, yields (flow_up, flow_low, elapsed) after every refinement iteration.
+
+            deadline    -   wall-clock budget in seconds from the call, including the encoders. The
+                            generator stops once the next iteration would not finish in time, so the
+                            last yielded flow is the latest estimate available by the deadline.
+            output_stride - 1, 4 or 8, resolution of flow_up as in forward
+            elapsed     -   wall-clock seconds since the call when the flow was ready
+
+            quater_refine upsamples only the final flow and is not supported.
+        """
+        if self.cfg.quater_refine:
+            raise NotImplementedError("forward_anytime does not support quater_refine, which only refines the final flow")
+
+        start = time.time()
+        data = {}
+        if self.cfg.r_16 > 0:
+            context, feat_s, feat_t, feat_s_16, feat_t_16 = self.encode_images(image1, image2, stage1=True)
+            cost_memory, cost_patches, _, _ = self.memory_encoder.forward_features(feat_s, feat_t, data, context, feat_s_16=feat_s_16, feat_t_16=feat_t_16)
+        else:
+            context, feat_s, feat_t = self.encode_images(image1, image2)
+            cost_memory, cost_patches, _, _ = self.memory_encoder.forward_features(feat_s, feat_t, data, context)
+
+        # the duration of the last iteration estimates the next one, the first is measured from here
+        if cost_memory.is_cuda:
+            torch.cuda.synchronize(cost_memory.device)
+        last = time.time() - start
+        for coords0, coords1, net, up_mask in self.memory_decoder.refine(cost_memory, context, data, flow_init, cost_patches, iters, upsample=output_stride != 8):
+            flow_low = coords1 - coords0
+            flow_up = flow_low if output_stride == 8 else self.memory_decoder.upsample_flow(flow_low, up_mask, output_stride)
+            if flow_up.is_cuda:
+                torch.cuda.synchronize(flow_up.device)
+
+            elapsed = time.time() - start
+            yield flow_up, flow_low, elapsed
+
+            step = elapsed - last
+            last = elapsed
+            if deadline is not None and time.time() - start + step > deadline:
+                return
+
+    def encode_frames(self, frames):
+        """ Run the context and feature encoders once on a stack of frames [N, 3, H, W], returns context and feat """
+        frames = 2 * (frames / 255.0) - 1.0
+
+        context, _ = self.context_encoder(frames)
+        feat = self.memory_encoder.encode_features(frames)
+
+        return context, feat
+
+    def forward_sequence(self, frames, frame_batch=4, warm_start=False, iters=None, output_stride=1):
+        """ Flow of the consecutive pairs (t, t+1) of an ordered stream of frames.
+
+            frames      -   iterable of equally sized [1, 3, H, W] or [3, H, W] frames, consumed lazily
+            frame_batch -   number of frames run through the encoders at once
+            warm_start  -   initialize pair (t, t+1) with the forward-splatted 1/8 flow of pair (t-1, t)
+            iters       -   decoder iterations per pair, defaults to decoder_depth
+            output_stride - 1, 4 or 8, resolution of the yielded flow
+
+            Every frame is encoded once, its features are reused as feat_t of pair (t-1, t) and
+            as feat_s of pair (t, t+1). Yields the output of forward() for each pair in order.
+        """
+        prev = None     # context and feat of the last frame of the previous chunk
+        flow_init = None
+        for chunk in _frame_chunks(frames, frame_batch):
+            context, feat = self.encode_frames(chunk)
+            if prev is not None:
+                context, feat = torch.cat([prev[0], context]), torch.cat([prev[1], feat])
+
+            for t in range(feat.shape[0] - 1):
+                flow_pre, flow_low = self.forward_features(context[t:t+1], feat[t:t+1], feat[t+1:t+2], flow_init=flow_init, iters=iters, output_stride=output_stride)
+                if warm_start:
+                    flow_init = forward_interpolate(flow_low)
+                yield flow_pre, flow_low
+
+            prev = context[-1:], feat[-1:]
+
+    def forward_roi(self, image1, image2, boxes, dilation=16, flow_init=None, iters=None, output_stride=1):
+        """ Flow of regions of interest of image1 only, matched against the whole of image2.
+
+            boxes       -   source image boxes (x0, y0, x1, y1) in pixels, e.g. from a detector
+            dilation    -   pixels added on every side of a box, the flow near the border of a
+                            region lacks the context outside of it
+            flow_init   -   B, 2, H/8, W/8 initial flow of the full frame, cropped per region
+            returns     -   list of (flow_up, flow_low, region) per box, region (x0, y0, x1, y1) is the
+                            dilated box in image pixels, aligned to 8, that flow_up [B, 2, y1-y0, x1-x0]
+                            covers at output_stride 1
+
+            The encoders run on the full frames. The cost maps, cost memory and decoder iterations
+            are computed for the source pixels of each region only, so their time and memory scale
+            with the area of the regions instead of the frame. Regions are processed one by one,
+            overlapping boxes are computed twice.
+        """
+        context, feat_s, feat_t = self.encode_images(image1, image2)
+
+        results = []
+        for x0, y0, x1, y1 in _roi_regions(boxes, feat_s.shape[2:], dilation):
+            crop = lambda x: x[:, :, y0:y1, x0:x1]
+            flow_init_roi = crop(flow_init) if flow_init is not None else None
+            flow_up, flow_low = self.forward_features(crop(context), crop(feat_s), feat_t, flow_init=flow_init_roi, iters=iters, output_stride=output_stride, offset=(x0, y0))
+            results.append((flow_up, flow_low, (8*x0, 8*y0, 8*x1, 8*y1)))
+
+        return results
+
+    def forward_features(self, context, feat_s, feat_t, flow_init=None, iters=None, output_stride=1, offset=None, feat_s_16=None, feat_t_16=None):
+        """ Cost memory encoding and iterative decoding from precomputed encoder outputs.
+            context, feat_s and feat_t may be crops of full frame features, e.g. for tiling.
+            output_stride 1, 4 or 8 selects the resolution of the returned flow at inference.
+            offset (x, y) places context and feat_s, a crop of the source frame, in the frame of
+            feat_t at 1/8 resolution, see forward_roi. feat_s_16 and feat_t_16 are the stage-1 maps
+            of encode_images(stage1=True), needed if r_16 > 0.
+        """
+        data = {}
+        context_quater = None
 
-            cost_memory, cost_patches, feat_s_quater, feat_t_quater = self.memory_encoder(image1, image2, data, context)
+        cost_memory, cost_patches, feat_s_quater, feat_t_quater = self.memory_encoder.forward_features(feat_s, feat_t, data, context, offset=offset, feat_s_16=feat_s_16, feat_t_16=feat_t_16)
 
-            flow_predictions = self.memory_decoder(cost_memory, context, context_quater, feat_s_quater, feat_t_quater, data, flow_init=flow_init, cost_patches=cost_patches)
+        flow_predictions = self.memory_decoder(cost_memory, context, context_quater, feat_s_quater, feat_t_quater, data, flow_init=flow_init, cost_patches=cost_patches, iters=iters, output_stride=output_stride, offset=offset)
 
-            return flow_predictions
+        return flow_predictions
     
     def pretrain_forward(self, image1, image2, mask=None, output=None, flow_init=None):
         image1 = 2 * (image1 / 255.0) - 1.0
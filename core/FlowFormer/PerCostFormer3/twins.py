@@ -23,8 +23,8 @@ from timm.models.layers import Mlp, DropPath, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
 from timm.models.vision_transformer import Attention
 from timm.models.helpers import build_model_with_cfg, overlay_external_default_cfg
-from .attention import MultiHeadAttention, LinearPositionEmbeddingSine
-from ...utils.utils import coords_grid, bilinear_sampler, upflow8
+from .attention import MultiHeadAttention, LinearPositionEmbeddingSine, GridPositionEmbeddingSine, attend
+from ...utils.utils import bilinear_sampler, upflow8
 
 
 def _cfg(url='', **kwargs):
@@ -61,6 +61,22 @@ default_cfgs = {
 
 Size_ = Tuple[int, int]
 
+def linear_with_context(linear, x, context):
+    """ linear(cat([x, context], -1)) without building the concatenation: the context [Bc, ..., C_c] of a
+        frame is shared by the B // Bc consecutive x [B, ..., C] of that frame, it is projected once and broadcast
+    """
+    C = x.shape[-1]
+    out = F.linear(x, linear.weight[:, :C])
+    shared = F.linear(context, linear.weight[:, C:], linear.bias)
+    return (out.reshape(len(shared), -1, *out.shape[1:]) + shared[:, None]).flatten(0, 1)
+
+def conv_with_context(conv, x, context):
+    """ conv(cat([x, context], 1)) of a conv without padding, like linear_with_context """
+    C = x.shape[1]
+    out = F.conv2d(x, conv.weight[:, :C], stride=conv.stride)
+    shared = F.conv2d(context, conv.weight[:, C:], conv.bias, stride=conv.stride)
+    return (out.reshape(len(shared), -1, *out.shape[1:]) + shared[:, None]).flatten(0, 1)
+
 class GroupAttnRPEContext(nn.Module):
     """ Latent cost tokens attend to different group
     """
@@ -85,6 +101,7 @@ class GroupAttnRPEContext(nn.Module):
         self.k = nn.Linear(dim+vert_c_dim, dim, bias=True)
         self.v = nn.Linear(dim, dim, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.ws = ws
@@ -112,10 +129,7 @@ class GroupAttnRPEContext(nn.Module):
         _h, _w = Hp // self.ws, Wp // self.ws
         padded_N = Hp*Wp
 
-        coords = coords_grid(B, Hp, Wp).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1)
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C_qk)
-        coords_enc = coords_enc.reshape(B, Hp, Wp, C_qk)
+        coords_enc = GridPositionEmbeddingSine(Hp, Wp, dim=C_qk, device=x.device).reshape(1, Hp, Wp, C_qk)
 
         q = self.q(x_qk + coords_enc).reshape(B, _h, self.ws, _w, self.ws, self.num_heads, C // self.num_heads).transpose(2, 3)
         q = q.reshape(B, _h * _w, self.ws * self.ws, self.num_heads, C // self.num_heads).permute(0, 1, 3, 2, 4)
@@ -138,10 +152,7 @@ class GroupAttnRPEContext(nn.Module):
         v = v.reshape(B, _h, self.ws, _w, self.ws, self.num_heads, C // self.num_heads).transpose(2, 3)
         v = v.reshape(B, _h * _w, self.ws * self.ws, self.num_heads, C // self.num_heads).permute(0, 1, 3, 2, 4)
         
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        attn = (attn @ v).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
+        attn = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
         x = attn.transpose(2, 3).reshape(B, _h * self.ws, _w * self.ws, C)
         if pad_r > 0 or pad_b > 0:
             x = x[:, :H, :W, :].contiguous()
@@ -171,6 +182,7 @@ class GroupAttnRPE(nn.Module):
         self.k = nn.Linear(dim, dim, bias=True)
         self.v = nn.Linear(dim, dim, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.ws = ws
@@ -188,10 +200,7 @@ class GroupAttnRPE(nn.Module):
         _h, _w = Hp // self.ws, Wp // self.ws
         padded_N = Hp*Wp
 
-        coords = coords_grid(B, Hp, Wp).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1)
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C)
-        coords_enc = coords_enc.reshape(B, Hp, Wp, C)
+        coords_enc = GridPositionEmbeddingSine(Hp, Wp, dim=C, device=x.device).reshape(1, Hp, Wp, C)
 
         q = self.q(x + coords_enc).reshape(B, _h, self.ws, _w, self.ws, self.num_heads, C // self.num_heads).transpose(2, 3)
         q = q.reshape(B, _h * _w, self.ws * self.ws, self.num_heads, C // self.num_heads).permute(0, 1, 3, 2, 4)
@@ -214,10 +223,7 @@ class GroupAttnRPE(nn.Module):
         v = v.reshape(B, _h, self.ws, _w, self.ws, self.num_heads, C // self.num_heads).transpose(2, 3)
         v = v.reshape(B, _h * _w, self.ws * self.ws, self.num_heads, C // self.num_heads).permute(0, 1, 3, 2, 4)
         
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        attn = (attn @ v).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
+        attn = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
         x = attn.transpose(2, 3).reshape(B, _h * self.ws, _w * self.ws, C)
         if pad_r > 0 or pad_b > 0:
             x = x[:, :H, :W, :].contiguous()
@@ -246,6 +252,7 @@ class LocallyGroupedAttnRPEContext(nn.Module):
         self.k = nn.Linear(dim+vert_c_dim, dim, bias=True)
         self.v = nn.Linear(dim, dim, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.ws = ws
@@ -258,44 +265,36 @@ class LocallyGroupedAttnRPEContext(nn.Module):
         H, W = size
         C_qk = C+self.vert_c_dim
 
-        context = context.unsqueeze(1)
-        context = context.repeat(1, B//context.shape[0], 1, 1, 1)
-        context = context.reshape(B, -1, H*W).permute(0, 2, 1)
-        context = self.context_proj(context)
-        context = context.view(B, H, W, -1)
+        # the context is shared by the latent tokens of its frame: projected once, broadcast in q and k
+        context = self.context_proj(context.flatten(2).transpose(1, 2))
+        context = context.view(-1, H, W, self.vert_c_dim)
 
         x = x.view(B, H, W, C)
-        x_qk = torch.cat([x, context], dim=-1)
 
         pad_l = pad_t = 0
         pad_r = (self.ws - W % self.ws) % self.ws
         pad_b = (self.ws - H % self.ws) % self.ws
         x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b))
-        x_qk = F.pad(x_qk, (0, 0, pad_l, pad_r, pad_t, pad_b))
+        context = F.pad(context, (0, 0, pad_l, pad_r, pad_t, pad_b))
 
         _, Hp, Wp, _ = x.shape
         _h, _w = Hp // self.ws, Wp // self.ws
         x = x.reshape(B, _h, self.ws, _w, self.ws, C).transpose(2, 3)
-        x_qk = x_qk.reshape(B, _h, self.ws, _w, self.ws, C_qk).transpose(2, 3)
+        context = context.reshape(-1, _h, self.ws, _w, self.ws, self.vert_c_dim).transpose(2, 3)
 
         v = self.v(x).reshape(
             B, _h * _w, self.ws * self.ws, 1, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)[0]
 
-        coords = coords_grid(B, self.ws, self.ws).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1)
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C_qk).view(B, self.ws, self.ws, C_qk)   
-        # coords_enc:   B, ws, ws, C
+        coords_enc = GridPositionEmbeddingSine(self.ws, self.ws, dim=C_qk, device=x.device).view(1, 1, 1, self.ws, self.ws, C_qk)
+        # coords_enc:   1, 1, 1, ws, ws, C_qk
         # x:            B, _h, _w, self.ws, self.ws, C
-        x_qk = x_qk + coords_enc[:, None, None, :, :, :]
+        x_qk, context = x + coords_enc[..., :C], context + coords_enc[..., C:]
 
-        q = self.q(x_qk).reshape(
+        q = linear_with_context(self.q, x_qk, context).reshape(
             B, _h * _w, self.ws * self.ws, 1, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)[0]
-        k = self.k(x_qk).reshape(
+        k = linear_with_context(self.k, x_qk, context).reshape(
             B, _h * _w, self.ws * self.ws, 1, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)[0]
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        attn = (attn @ v).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
+        attn = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
         x = attn.transpose(2, 3).reshape(B, _h * self.ws, _w * self.ws, C)
         if pad_r > 0 or pad_b > 0:
             x = x[:, :H, :W, :].contiguous()
@@ -322,6 +321,7 @@ class GlobalSubSampleAttnRPEContext(nn.Module):
         self.k = nn.Linear(dim, dim, bias=True)
         self.v = nn.Linear(dim, dim, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
@@ -339,53 +339,43 @@ class GlobalSubSampleAttnRPEContext(nn.Module):
         C_qk = C + self.vert_c_dim
         H, W = size
 
-        context = context.unsqueeze(1)
-        context = context.repeat(1, B//context.shape[0], 1, 1, 1)
-        context = context.reshape(B, -1, H*W).permute(0, 2, 1)
-        context = self.context_proj(context)
-        context = context.view(B, H, W, -1)
+        # the context is shared by the latent tokens of its frame: projected once, broadcast in q and k
+        context = self.context_proj(context.flatten(2).transpose(1, 2))
+        context = context.view(-1, H, W, self.vert_c_dim)
 
         x = x.view(B, H, W, C)
-        x_qk = torch.cat([x, context], dim=-1)
         pad_l = pad_t = 0
         pad_r = (self.sr_ratio - W % self.sr_ratio) % self.sr_ratio
         pad_b = (self.sr_ratio - H % self.sr_ratio) % self.sr_ratio
         x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b))
-        x_qk = F.pad(x_qk, (0, 0, pad_l, pad_r, pad_t, pad_b))
+        context = F.pad(context, (0, 0, pad_l, pad_r, pad_t, pad_b))
         
         _, Hp, Wp, _ = x.shape
         padded_size = (Hp, Wp)
         padded_N = Hp*Wp
         x = x.view(B, -1, C)
-        x_qk = x_qk.view(B, -1, C_qk)
+        context = context.view(-1, padded_N, self.vert_c_dim)
 
-        coords = coords_grid(B, *padded_size).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1)
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C_qk)   
-        # coords_enc:   B, Hp*Wp, C
+        coords_enc = GridPositionEmbeddingSine(*padded_size, dim=C_qk, device=x.device)
+        # coords_enc:   1, Hp*Wp, C_qk
         # x:            B, Hp*Wp, C
-        q = self.q(x_qk + coords_enc).reshape(B, padded_N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+        q = linear_with_context(self.q, x + coords_enc[..., :C], context + coords_enc[..., C:])
+        q = q.reshape(B, padded_N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
         if self.sr_key is not None:
             x = x.permute(0, 2, 1).reshape(B, C, *padded_size)
-            x_qk = x_qk.permute(0, 2, 1).reshape(B, C_qk, *padded_size)
+            context = context.permute(0, 2, 1).reshape(-1, self.vert_c_dim, *padded_size)
+            x_qk = conv_with_context(self.sr_key, x, context).reshape(B, C, -1).permute(0, 2, 1)
             x = self.sr_value(x).reshape(B, C, -1).permute(0, 2, 1)
-            x_qk = self.sr_key(x_qk).reshape(B, C, -1).permute(0, 2, 1)
             x = self.norm(x)
             x_qk = self.norm(x_qk)
 
-        coords = coords_grid(B, padded_size[0] // self.sr_ratio, padded_size[1] // self.sr_ratio).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1) * self.sr_ratio
         # align the coordinate of local and global
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C)
+        coords_enc = GridPositionEmbeddingSine(padded_size[0] // self.sr_ratio, padded_size[1] // self.sr_ratio, dim=C, stride=self.sr_ratio, device=x.device)
         k = self.k(x_qk + coords_enc).reshape(B, (padded_size[0] // self.sr_ratio)*(padded_size[1] // self.sr_ratio), self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         v = self.v(x).reshape(B, (padded_size[0] // self.sr_ratio)*(padded_size[1] // self.sr_ratio), self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, Hp, Wp, C)
+        x = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(1, 2).reshape(B, Hp, Wp, C)
         if pad_r > 0 or pad_b > 0:
             x = x[:, :H, :W, :].contiguous()
 
@@ -412,6 +402,7 @@ class LocallyGroupedAttnRPE(nn.Module):
         self.k = nn.Linear(dim, dim, bias=True)
         self.v = nn.Linear(dim, dim, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.ws = ws
@@ -433,10 +424,8 @@ class LocallyGroupedAttnRPE(nn.Module):
         v = self.v(x).reshape(
             B, _h * _w, self.ws * self.ws, 1, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)[0]
 
-        coords = coords_grid(B, self.ws, self.ws).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1)
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C).view(B, self.ws, self.ws, C)   
-        # coords_enc:   B, ws, ws, C
+        coords_enc = GridPositionEmbeddingSine(self.ws, self.ws, dim=C, device=x.device).view(1, self.ws, self.ws, C)
+        # coords_enc:   1, ws, ws, C
         # x:            B, _h, _w, self.ws, self.ws, C
         x = x + coords_enc[:, None, None, :, :, :]
 
@@ -444,10 +433,7 @@ class LocallyGroupedAttnRPE(nn.Module):
             B, _h * _w, self.ws * self.ws, 1, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)[0]
         k = self.k(x).reshape(
             B, _h * _w, self.ws * self.ws, 1, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)[0]
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        attn = (attn @ v).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
+        attn = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
         x = attn.transpose(2, 3).reshape(B, _h * self.ws, _w * self.ws, C)
         if pad_r > 0 or pad_b > 0:
             x = x[:, :H, :W, :].contiguous()
@@ -472,6 +458,7 @@ class GlobalSubSampleAttnRPE(nn.Module):
         self.k = nn.Linear(dim, dim, bias=True)
         self.v = nn.Linear(dim, dim, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
@@ -496,10 +483,8 @@ class GlobalSubSampleAttnRPE(nn.Module):
         padded_N = Hp*Wp
         x = x.view(B, -1, C)
 
-        coords = coords_grid(B, *padded_size).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1)
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C)   
-        # coords_enc:   B, Hp*Wp, C
+        coords_enc = GridPositionEmbeddingSine(*padded_size, dim=C, device=x.device)
+        # coords_enc:   1, Hp*Wp, C
         # x:            B, Hp*Wp, C
         q = self.q(x + coords_enc).reshape(B, padded_N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         #q = self.q(x).reshape(B, padded_N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
@@ -509,19 +494,13 @@ class GlobalSubSampleAttnRPE(nn.Module):
             x = self.sr(x).reshape(B, C, -1).permute(0, 2, 1)
             x = self.norm(x)
 
-        coords = coords_grid(B, padded_size[0] // self.sr_ratio, padded_size[1] // self.sr_ratio).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1) * self.sr_ratio
         # align the coordinate of local and global
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C)
+        coords_enc = GridPositionEmbeddingSine(padded_size[0] // self.sr_ratio, padded_size[1] // self.sr_ratio, dim=C, stride=self.sr_ratio, device=x.device)
         #k = self.k(x + coords_enc).reshape(B, (padded_size[0] // self.sr_ratio)*(padded_size[1] // self.sr_ratio), self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         k = self.k(x).reshape(B, (padded_size[0] // self.sr_ratio)*(padded_size[1] // self.sr_ratio), self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         v = self.v(x).reshape(B, (padded_size[0] // self.sr_ratio)*(padded_size[1] // self.sr_ratio), self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, Hp, Wp, C)
+        x = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(1, 2).reshape(B, Hp, Wp, C)
         if pad_r > 0 or pad_b > 0:
             x = x[:, :H, :W, :].contiguous()
 
@@ -547,6 +526,7 @@ class CrossGlobalSubSampleAttnRPE(nn.Module):
         self.k = nn.Linear(dim, dim, bias=True)
         self.v = nn.Linear(dim, dim, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
@@ -560,10 +540,8 @@ class CrossGlobalSubSampleAttnRPE(nn.Module):
 
     def forward(self, x, tgt, size: Size_):
         B, N, C = x.shape
-        coords = coords_grid(B, *size).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1)
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C)   
-        # coords_enc:   B, H*W, C
+        coords_enc = GridPositionEmbeddingSine(*size, dim=C, device=x.device)
+        # coords_enc:   1, H*W, C
         # x:            B, H*W, C
         q = self.q(x + coords_enc).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
@@ -571,18 +549,12 @@ class CrossGlobalSubSampleAttnRPE(nn.Module):
             tgt = tgt.permute(0, 2, 1).reshape(B, C, *size)
             tgt = self.sr(tgt).reshape(B, C, -1).permute(0, 2, 1)
             tgt = self.norm(tgt)
-        coords = coords_grid(B, size[0] // self.sr_ratio, size[1] // self.sr_ratio).to(x.device) 
-        coords = coords.view(B, 2, -1).permute(0, 2, 1) * self.sr_ratio
         # align the coordinate of local and global
-        coords_enc = LinearPositionEmbeddingSine(coords, dim=C)
+        coords_enc = GridPositionEmbeddingSine(size[0] // self.sr_ratio, size[1] // self.sr_ratio, dim=C, stride=self.sr_ratio, device=x.device)
         k = self.k(tgt + coords_enc).reshape(B, (size[0] // self.sr_ratio)*(size[1] // self.sr_ratio), self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         v = self.v(tgt).reshape(B, (size[0] // self.sr_ratio)*(size[1] // self.sr_ratio), self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -603,6 +575,7 @@ class LocallyGroupedAttn(nn.Module):
 
         self.qkv = nn.Linear(dim, dim * 3, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.ws = ws
@@ -624,10 +597,7 @@ class LocallyGroupedAttn(nn.Module):
         qkv = self.qkv(x).reshape(
             B, _h * _w, self.ws * self.ws, 3, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)
         q, k, v = qkv[0], qkv[1], qkv[2]
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        attn = (attn @ v).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
+        attn = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(2, 3).reshape(B, _h, _w, self.ws, self.ws, C)
         x = attn.transpose(2, 3).reshape(B, _h * self.ws, _w * self.ws, C)
         if pad_r > 0 or pad_b > 0:
             x = x[:, :H, :W, :].contiguous()
@@ -651,6 +621,7 @@ class GlobalSubSampleAttn(nn.Module):
         self.q = nn.Linear(dim, dim, bias=True)
         self.kv = nn.Linear(dim, dim * 2, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
@@ -673,11 +644,7 @@ class GlobalSubSampleAttn(nn.Module):
         kv = self.kv(x).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         k, v = kv[0], kv[1]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -698,6 +665,7 @@ class CrossGlobalSubSampleAttn(nn.Module):
         self.q = nn.Linear(dim, dim, bias=True)
         self.kv = nn.Linear(dim, dim * 2, bias=True)
         self.attn_drop = nn.Dropout(attn_drop)
+        self.backend = 'einsum'
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
@@ -720,11 +688,7 @@ class CrossGlobalSubSampleAttn(nn.Module):
         kv = self.kv(tgt).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         k, v = kv[0], kv[1]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = attend(q, k, v, self.scale, self.attn_drop, self.backend).transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
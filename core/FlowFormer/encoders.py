@@ -33,7 +33,7 @@ class twins_svt_large(nn.Module):
                 x = x.reshape(B, *size, -1).permute(0, 3, 1, 2).contiguous()
             
             if i == 0:
-                x_16 = x.clone()
+                x_16 = x
             if i == layer-1:
                 break
         
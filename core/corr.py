@@ -1,6 +1,6 @@
 import torch
 import torch.nn.functional as F
-from utils.utils import bilinear_sampler, coords_grid
+from utils.utils import bilinear_sampler, coords_grid, window_lookup
 
 try:
     import alt_cuda_corr
@@ -34,14 +34,8 @@ class CorrBlock:
         out_pyramid = []
         for i in range(self.num_levels):
             corr = self.corr_pyramid[i]
-            dx = torch.linspace(-r, r, 2*r+1)
-            dy = torch.linspace(-r, r, 2*r+1)
-            delta = torch.stack(torch.meshgrid(dy, dx), axis=-1).to(coords.device)
-
-            centroid_lvl = coords.reshape(batch*h1*w1, 1, 1, 2) / 2**i
-            delta_lvl = delta.view(1, 2*r+1, 2*r+1, 2)
-            coords_lvl = centroid_lvl + delta_lvl
-            corr = bilinear_sampler(corr, coords_lvl)
+            centroid_lvl = coords.reshape(batch*h1*w1, 2) / 2**i
+            corr = window_lookup(corr, None, centroid_lvl, r)
             corr = corr.view(batch, h1, w1, -1)
             out_pyramid.append(corr)
 
@@ -0,0 +1,22 @@
+import time
+import torch
+
+
+def timeit(fn, runs, cuda=False, reset_peak=False):
+    """ Average wall-clock milliseconds of fn() over runs calls, after one warm-up call.
+
+        cuda        -   synchronize before starting and stopping the clock
+        reset_peak  -   reset the CUDA peak memory statistics after the warm-up, so that
+                        torch.cuda.max_memory_allocated() afterwards covers the timed calls
+    """
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+        if reset_peak:
+            torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(runs):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return 1000 * (time.time() - start) / runs
@@ -0,0 +1,207 @@
+import math
+from collections import namedtuple
+from functools import lru_cache
+
+import torch
+import torch.nn.functional as F
+
+# tile_size and offsets (hws) are in the padded image_shape, which is a multiple of 8
+TilePlan = namedtuple('TilePlan', ['image_shape', 'patch_size', 'hws'])
+
+# weight of the quadratic all-pairs cost volume term relative to the per-pixel term
+COST_VOLUME_WEIGHT = 1 / 4096.
+
+
+def tile_cost(patch_size):
+    """ Rough relative cost of one forward pass on a tile: the encoders and the decoder are
+        linear in the number of 1/8 pixels, the cost volume and cost encoder are quadratic.
+    """
+    n = (patch_size[0] // 8) * (patch_size[1] // 8)
+    return n + COST_VOLUME_WEIGHT * n * n
+
+
+def _round_up(x, multiple):
+    return int(math.ceil(x / multiple)) * multiple
+
+
+def _axis_layouts(length, max_len, min_len, min_overlap, multiple):
+    """ Candidate (tile_len, offsets) along one axis, from the fewest to the smallest tiles """
+    if length <= max_len:
+        yield length, [0]
+
+    n = 2
+    while True:
+        tile = max(_round_up((length + (n-1) * min_overlap) / n, multiple), min_len)
+        if tile >= length:
+            break
+        while tile <= max_len:
+            offsets = [int(round(i * (length - tile) / (n-1) / multiple)) * multiple for i in range(n)]
+            if all(b - a <= tile - min_overlap for a, b in zip(offsets, offsets[1:])):
+                yield tile, offsets
+                break
+            tile += multiple
+        if tile <= min_len:
+            break
+        n += 1
+
+
+def plan_tiles(image_shape, max_size, min_size=None, min_overlap=20, multiple=8, max_stretch=0.05, cost_fn=tile_cost):
+    """ Choose tile size, count and overlap for an image of image_shape.
+
+        The image is padded to a multiple of `multiple`. Tiles are multiples of `multiple`, at
+        most max_size (the training crop) stretched by max_stretch, at least min_size (the
+        quality floor, defaults to max_size) and overlap by at least min_overlap pixels. Among
+        the layouts that satisfy these constraints the one with the lowest total cost_fn is
+        chosen. If the padded frame fits into a single tile, the plan is one untiled pass.
+    """
+    padded = [_round_up(l, multiple) for l in image_shape[-2:]]
+    max_len = [max((int(m * (1 + max_stretch)) // multiple) * multiple, multiple) for m in max_size]
+    if min_size is None:
+        min_size = max_size
+    min_len = [min(_round_up(m, multiple), l) for m, l in zip(min_size, max_len)]
+
+    if padded[0] <= max_len[0] and padded[1] <= max_len[1]:
+        return TilePlan(tuple(padded), tuple(padded), ((0, 0),))
+
+    best = None
+    for th, hs in _axis_layouts(padded[0], max_len[0], min_len[0], min_overlap, multiple):
+        for tw, ws in _axis_layouts(padded[1], max_len[1], min_len[1], min_overlap, multiple):
+            cost = len(hs) * len(ws) * cost_fn((th, tw))
+            if best is None or cost < best[0]:
+                best = (cost, (th, tw), tuple((h, w) for h in hs for w in ws))
+
+    if best is None:
+        raise ValueError(f"No tiling of {image_shape} with tiles up to {max_size} and overlap {min_overlap}")
+
+    return TilePlan(tuple(padded), best[1], best[2])
+
+
+def gaussian_log_weight(patch_size, sigma=0.05):
+    """ Log of the gaussian blending weight of a patch, centered on the patch [ph, pw] """
+    h, w = torch.meshgrid(torch.arange(patch_size[0]), torch.arange(patch_size[1]))
+    h, w = h / float(patch_size[0]) - 0.5, w / float(patch_size[1]) - 0.5
+    dist = (h ** 2 + w ** 2) ** 0.5 / sigma
+    return math.log(1 / (sigma * math.sqrt(2 * math.pi))) - 0.5 * dist.double() ** 2
+
+
+@lru_cache(maxsize=8)
+def blend_weights(image_shape, patch_size, hws, sigma=0.05, device='cpu'):
+    """ Normalized blending weights for the tiles at hws, cached per layout.
+
+        Only the patch weight [ph, pw] and the per-pixel normalizer [H, W] are kept, in log space,
+        so that memory scales with one image and tiny gaussian tails neither underflow nor
+        overflow in float32. The weight of tile idx at a pixel is exp(log_patch - log_norm).
+    """
+    log_patch = gaussian_log_weight(patch_size, sigma)
+
+    log_norm = torch.full(image_shape, -math.inf, dtype=torch.float64)
+    for h, w in hws:
+        window = log_norm[h:h+patch_size[0], w:w+patch_size[1]]
+        window.copy_(torch.logaddexp(window, log_patch))
+
+    return log_patch.float().to(device), log_norm.float().to(device)
+
+
+class TileStitcher:
+    """ Accumulates tile flows into a preallocated full-size buffer with normalized gaussian weights
+
+        stitcher = TileStitcher(image_shape, patch_size, hws, sigma)
+        stitcher.reset(batch, device=device)
+        stitcher.add(n, idx, flow_tile)     # tile idx of pair n
+        flow = stitcher.result()
+    """
+    def __init__(self, image_shape, patch_size, hws, sigma=0.05):
+        self.image_shape = tuple(image_shape)
+        self.patch_size = tuple(patch_size)
+        self.hws = tuple(tuple(hw) for hw in hws)
+        self.sigma = sigma
+        self.flows = None
+
+    def reset(self, batch, channels=2, device='cpu'):
+        shape = (batch, channels, *self.image_shape)
+        if self.flows is None or self.flows.shape != shape or self.flows.device != torch.device(device):
+            self.flows = torch.zeros(shape, device=device)
+        else:
+            self.flows.zero_()
+        self.log_patch, self.log_norm = blend_weights(self.image_shape, self.patch_size, self.hws, self.sigma, str(self.flows.device))
+        return self.flows
+
+    def weight(self, idx):
+        h, w = self.hws[idx]
+        return torch.exp(self.log_patch - self.log_norm[h:h+self.patch_size[0], w:w+self.patch_size[1]])
+
+    def add(self, n, idx, flow_tile):
+        """ flow_tile: [C, ph, pw] or [1, C, ph, pw] """
+        h, w = self.hws[idx]
+        window = self.flows[n, :, h:h+self.patch_size[0], w:w+self.patch_size[1]]
+        window.add_(flow_tile.reshape(window.shape) * self.weight(idx))
+
+    def result(self):
+        return self.flows
+
+
+@lru_cache(maxsize=4)
+def _plan_stitcher(plan, sigma):
+    return TileStitcher(plan.image_shape, plan.patch_size, plan.hws, sigma)
+
+
+def _pad_to_plan(plan, *images):
+    H, W = images[0].shape[-2:]
+    pad = (0, plan.image_shape[1] - W, 0, plan.image_shape[0] - H)
+    return [F.pad(x, pad, mode='replicate') for x in images]
+
+
+def downsample_flow(flow, plan):
+    """ Full resolution flow [N, 2, H, W] -> 1/8 resolution flow of the padded plan frame, e.g. for warm start """
+    flow, = _pad_to_plan(plan, flow)
+    return F.avg_pool2d(flow, 8) / 8
+
+
+def forward_tiles(model, image1, image2, plan, sigma=0.05, tile_batch=1, shared_backbone=False, flow_init=None, iters=None, out=None):
+    """ Run the model on the tiles of plan for a stack of equally sized pairs and blend the tile flows.
+
+        image1, image2  -   N, 3, H, W, replicate padded at the bottom/right to plan.image_shape
+        tile_batch      -   number of tiles stacked into one forward pass, tiles of
+                            different pairs are mixed in the same batch
+        shared_backbone -   run the context and feature encoders once on the full frames and
+                            only the cost volume, cost encoder and decoder per tile on 1/8 crops
+        flow_init       -   N, 2, H/8, W/8 initial flow of the padded plan frame, cropped per tile
+        iters           -   decoder iterations, defaults to decoder_depth
+        out             -   optional N, 2, H, W tensor the stitched flow is written to
+        returns         -   N, 2, H, W, out or a new tensor, never the stitcher buffer reused by the next call
+    """
+    N, _, H, W = image1.shape
+    image1, image2 = _pad_to_plan(plan, image1, image2)
+    stitcher = _plan_stitcher(plan, sigma)
+    stitcher.reset(N, device=image1.device)
+    (th, tw), hws = plan.patch_size, plan.hws
+
+    if shared_backbone:
+        context, feat_s, feat_t = model.encode_images(image1, image2)
+        crop = lambda feat, n, h, w: feat[n:n+1, :, h//8:(h+th)//8, w//8:(w+tw)//8]
+    else:
+        crop = lambda image, n, h, w: image[n:n+1, :, h:h+th, w:w+tw]
+
+    crop_low = lambda flow, n, h, w: flow[n:n+1, :, h//8:(h+th)//8, w//8:(w+tw)//8]
+
+    tiles = [(n, idx) for n in range(N) for idx in range(len(hws))]
+    for start in range(0, len(tiles), tile_batch):
+        chunk = tiles[start:start+tile_batch]
+        flow_init_tile = None
+        if flow_init is not None:
+            flow_init_tile = torch.cat([crop_low(flow_init, n, *hws[idx]) for n, idx in chunk])
+
+        if shared_backbone:
+            context_tile, feat_s_tile, feat_t_tile = [torch.cat([crop(x, n, *hws[idx]) for n, idx in chunk]) for x in (context, feat_s, feat_t)]
+            flow_pre, _ = model.forward_features(context_tile, feat_s_tile, feat_t_tile, flow_init=flow_init_tile, iters=iters)
+        else:
+            image1_tile, image2_tile = [torch.cat([crop(x, n, *hws[idx]) for n, idx in chunk]) for x in (image1, image2)]
+            flow_pre, _ = model(image1_tile, image2_tile, flow_init=flow_init_tile, iters=iters)
+
+        for k, (n, idx) in enumerate(chunk):
+            stitcher.add(n, idx, flow_pre[k])
+
+    flow = stitcher.result()[:, :, :H, :W]
+    if out is None:
+        return flow.clone()
+    return out.copy_(flow)
@@ -2,6 +2,8 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 from scipy import interpolate
+from collections import OrderedDict
+import threading
 
 
 class InputPadder:
@@ -13,7 +15,7 @@ class InputPadder:
         self.mode = mode
         if mode == 'sintel':
             self._pad = [pad_wd//2, pad_wd - pad_wd//2, pad_ht//2, pad_ht - pad_ht//2]
-        elif mode == "downzero":
+        elif mode in ["downzero", "downreplicate"]:
             self._pad = [0, pad_wd, 0, pad_ht]
         else:
             self._pad = [pad_wd//2, pad_wd - pad_wd//2, 0, pad_ht]
@@ -24,12 +26,21 @@ class InputPadder:
         else:
             return [F.pad(x, self._pad, mode='replicate') for x in inputs]
 
-    def unpad(self,x):
+    def unpad(self, x, stride=1):
+        """ stride > 1 unpads an output at 1/stride of the input resolution, this needs a
+            mode that pads at the bottom/right only (downzero, downreplicate)
+        """
+        if stride > 1:
+            if self._pad[0] or self._pad[2]:
+                raise ValueError(f"unpad with stride {stride} needs a bottom/right padding mode, got {self.mode}")
+            return x[..., :-(-self.ht // stride), :-(-self.wd // stride)]
+
         ht, wd = x.shape[-2:]
         c = [self._pad[2], ht-self._pad[3], self._pad[0], wd-self._pad[1]]
         return x[..., c[0]:c[1], c[2]:c[3]]
 
-def forward_interpolate(flow):
+def forward_interpolate_griddata(flow):
+    """ scipy reference of forward_interpolate for a single flow [2, H, W], returns a cpu tensor """
     flow = flow.detach().cpu().numpy()
     dx, dy = flow[0], flow[1]
 
@@ -59,6 +70,66 @@ def forward_interpolate(flow):
     flow = np.stack([flow_x, flow_y], axis=0)
     return torch.from_numpy(flow).float()
 
+def _nearest_seed(x1, y1, x0, y0, candidates):
+    """ Among the candidate seeds [K, P] of every pixel keep the one whose splatted point is closest """
+    index = candidates.clamp(min=0).view(-1)
+    dist = (x1.index_select(0, index).view_as(candidates) - x0) ** 2 + (y1.index_select(0, index).view_as(candidates) - y0) ** 2
+    dist = dist.masked_fill(candidates < 0, float('inf'))
+    return candidates.gather(0, dist.min(dim=0, keepdim=True).indices)[0]
+
+def _shifted_seeds(seed, N, H, W, step):
+    """ seed maps [K, P] of the 3x3 neighbourhood at distance step, padded with -1 (no seed) """
+    padded = F.pad(seed.view(-1, N, H, W), (step, step, step, step), value=-1)
+    return torch.cat([padded[:, :, step+dy:step+dy+H, step+dx:step+dx+W].reshape(-1, N*H*W)
+        for dy in (-step, 0, step) for dx in (-step, 0, step)])
+
+def forward_interpolate(flow, layers=4):
+    """ Forward splat flow [2, H, W] or [N, 2, H, W] to the next frame, on flow's device.
+
+        Every pixel moves to x + flow and takes the flow of the splatted point nearest to it, like
+        forward_interpolate_griddata. Points are scattered to their nearest pixel, keeping up to
+        `layers` points per pixel ordered by distance to the pixel center. Holes are filled by jump
+        flooding over the closest points, log2(max(H, W)) passes of 3x3 neighbour checks with halving
+        strides, and a final pass checks all kept points of the 3x3 neighbourhood.
+    """
+    flow = flow.detach().float()
+    single = flow.dim() == 3
+    if single:
+        flow = flow[None]
+
+    N, _, H, W = flow.shape
+    coords0 = coords_grid(N, H, W).to(flow.device)
+    x0, y0 = coords0[:, 0].reshape(-1), coords0[:, 1].reshape(-1)
+    x1, y1 = x0 + flow[:, 0].reshape(-1), y0 + flow[:, 1].reshape(-1)
+    valid = (x1 > 0) & (x1 < W) & (y1 > 0) & (y1 < H)
+
+    # scatter the valid points to their nearest pixel, layer k keeps the k-th closest point of each pixel
+    source = torch.nonzero(valid).squeeze(1)
+    xi, yi = x1[source].round().clamp(0, W-1), y1[source].round().clamp(0, H-1)
+    target = (source // (H*W)) * H*W + (yi * W + xi).long()
+    dist = (x1[source] - xi) ** 2 + (y1[source] - yi) ** 2
+    seeds = []
+    for _ in range(layers):
+        best = torch.full((N*H*W,), float('inf'), device=flow.device).scatter_reduce(0, target, dist, 'amin')
+        winner = dist == best[target]
+        seed = torch.full((N*H*W,), -1, dtype=torch.long, device=flow.device)
+        seeds.append(seed.scatter_reduce(0, target[winner], source[winner], 'amax'))
+        winner = torch.zeros_like(winner).index_fill_(0, torch.nonzero(seeds[-1][target] == source).squeeze(1), True)
+        source, target, dist = source[~winner], target[~winner], dist[~winner]
+        if source.numel() == 0:
+            break
+
+    # jump flooding, seeds of other images in the batch are never reached since shifts are padded with -1
+    seed = seeds[0]
+    for step in [2 ** k for k in reversed(range(max(H, W).bit_length()))]:
+        seed = _nearest_seed(x1, y1, x0, y0, _shifted_seeds(seed, N, H, W, step))
+    candidates = torch.cat([seed[None], _shifted_seeds(torch.stack(seeds), N, H, W, 1)])
+    seed = _nearest_seed(x1, y1, x0, y0, candidates)
+
+    flow = flow.permute(1, 0, 2, 3).reshape(2, -1)[:, seed.clamp(min=0)]
+    flow = flow.masked_fill(seed < 0, 0).view(2, N, H, W).permute(1, 0, 2, 3)
+    return flow[0] if single else flow
+
 def bilinear_sampler(img, coords, mode='bilinear', mask=False):
     """ Wrapper for grid_sample, uses pixel coordinates """
     H, W = img.shape[-2:]
@@ -75,6 +146,71 @@ def bilinear_sampler(img, coords, mode='bilinear', mask=False):
 
     return img
 
+def bilinear_lookup(img, rows, coords):
+    """ bilinear_sampler on a subset of the images without copying them
+
+        img     -   R, C, H, W
+        rows    -   M, indices into R
+        coords  -   M, K, 2 pixel coordinates (x, y) sampled in img[rows]
+        returns -   M, C, K, zero outside the image like grid_sample
+    """
+    R, C, H, W = img.shape
+    img = img.reshape(R*C, H*W)
+    x, y = coords.unbind(dim=-1)
+    x0, y0 = x.floor(), y.floor()
+
+    out = 0
+    for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        xi, yi = x0 + dx, y0 + dy
+        weight = (1 - (x - xi).abs()) * (1 - (y - yi).abs())
+        weight = weight * ((xi >= 0) & (xi <= W-1) & (yi >= 0) & (yi <= H-1))
+        index = (yi.clamp(0, H-1) * W + xi.clamp(0, W-1)).long()                     # M, K
+        channels = rows[:, None] * C + torch.arange(C, device=rows.device)           # M, C
+        values = img[channels[:, :, None], index[:, None, :]]                       # M, C, K
+        out = out + values * weight[:, None, :]
+
+    return out
+
+def window_delta(r, device='cpu'):
+    """ (2r+1)^2, 2 offsets (x, y) of the window_lookup samples, in the same order """
+    d = torch.arange(-r, r+1, device=device, dtype=torch.float32)
+    return torch.stack(torch.meshgrid(d, d), dim=-1).view(-1, 2)
+
+def window_lookup(img, rows, centroid, r):
+    """ Bilinear (2r+1) x (2r+1) window around each centroid, the encode_flow_token / CorrBlock lookup.
+
+        All samples of a window share their bilinear weights, so the (2r+2)^2 integer corners are
+        gathered once and blended, instead of grid_sample interpolating every sample on its own.
+
+        img      -   R, C, H, W
+        rows     -   M, indices into R, or None for all R rows with M = R
+        centroid -   M, 2 pixel coordinates (x, y)
+        returns  -   M, C, 2r+1, 2r+1, sample [i, j] at centroid + (i-r, j-r) like bilinear_sampler
+                     with the meshgrid(dy, dx) delta grid, zero outside the image like grid_sample
+    """
+    R, C, H, W = img.shape
+    M = R if rows is None else len(rows)
+    x, y = centroid.unbind(dim=-1)
+    x0, y0 = x.floor(), y.floor()
+    fx, fy = (x - x0)[:, None, None, None], (y - y0)[:, None, None, None]
+
+    offsets = torch.arange(-r, r+2, device=img.device)
+    xi = x0.long()[:, None, None] + offsets[:, None]                                # M, 2r+2, 1
+    yi = y0.long()[:, None, None] + offsets[None, :]                                # M, 1, 2r+2
+    inside = (xi >= 0) & (xi <= W-1) & (yi >= 0) & (yi <= H-1)                      # M, 2r+2, 2r+2
+    index = (yi.clamp(0, H-1) * W + xi.clamp(0, W-1)).view(M, 1, -1)
+
+    if rows is None:
+        corners = img.reshape(R, C, H*W).gather(2, index.expand(M, C, -1))
+    else:
+        channels = rows[:, None] * C + torch.arange(C, device=rows.device)          # M, C
+        corners = img.reshape(R*C, H*W)[channels[:, :, None], index]
+    corners = corners.view(M, C, 2*r+2, 2*r+2) * inside[:, None]
+
+    # separable blend, along x then along y
+    corners = torch.lerp(corners[:, :, :-1], corners[:, :, 1:], fx)
+    return torch.lerp(corners[:, :, :, :-1], corners[:, :, :, 1:], fy)
+
 def indexing(img, coords, mask=False):
     """ Wrapper for grid_sample, uses pixel coordinates """
     """
@@ -100,6 +236,44 @@ def coords_grid(batch, ht, wd):
     return coords[None].repeat(batch, 1, 1, 1)
 
 
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_SIZE = 64
+
+def cached(key, fn):
+    """ fn() memoized under key in a small LRU cache, for grids and coordinate encodings that only depend
+        on their shape. key has to hold everything the result depends on, the device included, the least
+        recently used entry is evicted beyond CACHE_SIZE entries. Results are shared, do not modify them in place.
+        Safe to call from the replica threads of DataParallel, fn() runs outside the lock and may call cached.
+    """
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    with torch.no_grad():
+        value = fn()
+
+    with _cache_lock:
+        value = _cache.setdefault(key, value)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return value
+
+def clear_cache(device=None):
+    """ Drop the cached tensors on device, or all of them, e.g. to release GPU memory after moving a model """
+    device = torch.device(device) if device is not None else None
+    with _cache_lock:
+        for key in [key for key in _cache if device is None or device in key]:
+            del _cache[key]
+
+def cached_coords_grid(ht, wd, device='cpu'):
+    """ coords_grid(1, ht, wd) on device from the cache, expand it over the batch instead of repeating """
+    device = torch.device(device)
+    return cached(('coords_grid', ht, wd, device), lambda: coords_grid(1, ht, wd).to(device))
+
+
 def upflow8(flow, mode='bilinear'):
     new_size = (8 * flow.shape[2], 8 * flow.shape[3])
     return  8 * F.interpolate(flow, size=new_size, mode=mode, align_corners=True)
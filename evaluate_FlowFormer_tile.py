@@ -21,6 +21,7 @@ from core.FlowFormer import build_flowformer
 from raft import RAFT
 
 from utils.utils import InputPadder, forward_interpolate
+from utils.tiling import plan_tiles, forward_tiles, downsample_flow
 import imageio
 import itertools
 
@@ -54,257 +55,183 @@ class InputPadder:
         c = [self._pad[2], ht-self._pad[3], self._pad[0], wd-self._pad[1]]
         return x[..., c[0]:c[1], c[2]:c[3]]
 
-def compute_grid_indices(image_shape, patch_size=TRAIN_SIZE, min_overlap=20):
-    if min_overlap >= patch_size[0] or min_overlap >= patch_size[1]:
-        raise ValueError("!!")
-    hs = list(range(0, image_shape[0], patch_size[0] - min_overlap))
-    ws = list(range(0, image_shape[1], patch_size[1] - min_overlap))
-    # Make sure the final patch is flush with the image boundary
-    hs[-1] = image_shape[0] - patch_size[0]
-    ws[-1] = image_shape[1] - patch_size[1]
-    return [(h, w) for h in hs for w in ws]
-
-import math
-def compute_weight(hws, image_shape, patch_size=TRAIN_SIZE, sigma=1.0, wtype='gaussian'):
-    patch_num = len(hws)
-    h, w = torch.meshgrid(torch.arange(patch_size[0]), torch.arange(patch_size[1]))
-    h, w = h / float(patch_size[0]), w / float(patch_size[1])
-    c_h, c_w = 0.5, 0.5
-    h, w = h - c_h, w - c_w
-    weights_hw = (h ** 2 + w ** 2) ** 0.5 / sigma
-    denorm = 1 / (sigma * math.sqrt(2 * math.pi))
-    weights_hw = denorm * torch.exp(-0.5 * (weights_hw) ** 2)
-
-    weights = torch.zeros(1, patch_num, *image_shape)
-    for idx, (h, w) in enumerate(hws):
-        weights[:, idx, h:h+patch_size[0], w:w+patch_size[1]] = weights_hw
-    weights = weights.cuda()
-    patch_weights = []
-    for idx, (h, w) in enumerate(hws):
-        patch_weights.append(weights[:, idx:idx+1, h:h+patch_size[0], w:w+patch_size[1]])
-
-    return patch_weights
+def batched_pairs(dataset, pair_batch=1):
+    """ Group consecutive dataset items into lists of at most pair_batch items with the same image size """
+    batch = []
+    for idx in range(len(dataset)):
+        item = dataset[idx]
+        if batch and (len(batch) == pair_batch or item[0].shape != batch[0][1][0].shape):
+            yield batch
+            batch = []
+        batch.append((idx, item))
+    if batch:
+        yield batch
+
+def warm_start_init(flow_prev, plan):
+    """ Forward-splatted 1/8 flow of the previous pairs [N, 2, H, W] as flow_init of the next pairs """
+    flow_low = downsample_flow(flow_prev, plan)
+    return forward_interpolate(flow_low)
 
 @torch.no_grad()
-def create_sintel_submission(model, output_path='sintel_submission_multi8_768', sigma=0.05):
+def create_sintel_submission(model, output_path='sintel_submission_multi8_768', sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=False, iters=None, warm_start=False):
     """ Create submission for the Sintel leaderboard """
-    print("no warm start")
+    if warm_start:
+        print(f"warm start, {iters or 'all'} decoder iterations")
+        pair_batch = 1      # pairs of a scene are processed in order
+    else:
+        print("no warm start")
     #print(f"output path: {output_path}")
-    IMAGE_SIZE = [436, 1024]
-
-    hws = compute_grid_indices(IMAGE_SIZE)
-    weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
 
     model.eval()
     for dstype in ['final', "clean"]:
         test_dataset = datasets.MpiSintel_submission(split='test', aug_params=None, dstype=dstype, root="./dataset/Sintel/test")
         epe_list = []
-        for test_id in range(len(test_dataset)):
-            if (test_id+1) % 100 == 0:
-                print(f"{test_id} / {len(test_dataset)}")
-                # break
-            image1, image2, (sequence, frame) = test_dataset[test_id]
-            image1, image2 = image1[None].cuda(), image2[None].cuda()
+        flow_prev, sequence_prev = None, None
+        for batch in batched_pairs(test_dataset, pair_batch):
+            image1 = torch.stack([item[0] for _, item in batch]).cuda()
+            image2 = torch.stack([item[1] for _, item in batch]).cuda()
+            plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
 
-            flows = 0
-            flow_count = 0
+            flow_init = None
+            if warm_start:
+                sequence = batch[0][1][2][0]
+                if sequence == sequence_prev and flow_prev is not None:
+                    flow_init = warm_start_init(flow_prev, plan)
+                sequence_prev = sequence
 
-            for idx, (h, w) in enumerate(hws):
-                image1_tile = image1[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-                image2_tile = image2[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-                flow_pre, flow_low = model(image1_tile, image2_tile)
+            flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone, flow_init, iters)
+            if warm_start:
+                flow_prev = flow_pre
 
-                padding = (w, IMAGE_SIZE[1]-w-TRAIN_SIZE[1], h, IMAGE_SIZE[0]-h-TRAIN_SIZE[0], 0, 0)
-                flows += F.pad(flow_pre * weights[idx], padding)
-                flow_count += F.pad(weights[idx], padding)
+            for k, (test_id, (_, _, (sequence, frame))) in enumerate(batch):
+                if (test_id+1) % 100 == 0:
+                    print(f"{test_id} / {len(test_dataset)}")
+                flow = flow_pre[k].permute(1, 2, 0).cpu().numpy()
 
-            flow_pre = flows / flow_count
-            flow = flow_pre[0].permute(1, 2, 0).cpu().numpy()
+                output_dir = os.path.join(output_path, dstype, sequence)
+                output_file = os.path.join(output_dir, 'frame%04d.flo' % (frame+1))
 
-            output_dir = os.path.join(output_path, dstype, sequence)
-            output_file = os.path.join(output_dir, 'frame%04d.flo' % (frame+1))
+                if not os.path.exists(output_dir):
+                    os.makedirs(output_dir)
 
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            frame_utils.writeFlow(output_file, flow)
+                frame_utils.writeFlow(output_file, flow)
 
 @torch.no_grad()
-def create_kitti_submission(model, output_path='kitti_submission', sigma=0.05):
+def create_kitti_submission(model, output_path='kitti_submission', sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=False, iters=None):
     """ Create submission for the Sintel leaderboard """
 
-    IMAGE_SIZE = [432, 1242]
-
     print(f"output path: {output_path}")
-    print(f"image size: {IMAGE_SIZE}")
     print(f"training size: {TRAIN_SIZE}")
 
-    hws = compute_grid_indices(IMAGE_SIZE)
-    weights = compute_weight(hws, (432, 1242), TRAIN_SIZE, sigma)
     model.eval()
     test_dataset = datasets.KITTI(split='testing', aug_params=None)
 
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    for test_id in range(len(test_dataset)):
-        image1, image2, (frame_id, ) = test_dataset[test_id]
-        new_shape = image1.shape[1:]
-        if new_shape[1] != IMAGE_SIZE[1]:   # fix the height=432, adaptive ajust the width
-            print(f"replace {IMAGE_SIZE} with {new_shape}")
-            IMAGE_SIZE[0] = 432
-            IMAGE_SIZE[1] = new_shape[1]
-            hws = compute_grid_indices(IMAGE_SIZE)
-            weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
+    for batch in batched_pairs(test_dataset, pair_batch):
+        image1 = torch.stack([item[0] for _, item in batch])
+        image2 = torch.stack([item[1] for _, item in batch])
 
         padder = InputPadder(image1.shape, mode='kitti432') # padding the image to height of 432
-        image1, image2 = padder.pad(image1[None].cuda(), image2[None].cuda())
+        image1, image2 = padder.pad(image1.cuda(), image2.cuda())
+        plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
 
-        flows = 0
-        flow_count = 0
+        flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone, iters=iters)
 
-        for idx, (h, w) in enumerate(hws):
-            image1_tile = image1[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-            image2_tile = image2[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-            flow_pre, _ = model(image1_tile, image2_tile)
+        for k, (test_id, (_, _, (frame_id, ))) in enumerate(batch):
+            flow = padder.unpad(flow_pre[k]).permute(1, 2, 0).cpu().numpy()
 
-            padding = (w, IMAGE_SIZE[1]-w-TRAIN_SIZE[1], h, IMAGE_SIZE[0]-h-TRAIN_SIZE[0], 0, 0)
-            flows += F.pad(flow_pre * weights[idx], padding)
-            flow_count += F.pad(weights[idx], padding)
+            output_filename = os.path.join(output_path, frame_id)
+            frame_utils.writeFlowKITTI(output_filename, flow)
 
-        flow_pre = flows / flow_count
-        flow = padder.unpad(flow_pre[0]).permute(1, 2, 0).cpu().numpy()
+            flow_img = flow_viz.flow_to_image(flow)
+            image = Image.fromarray(flow_img)
+            if not os.path.exists(f'vis_kitti_3patch'):
+                os.makedirs(f'vis_kitti_3patch/flow')
+                os.makedirs(f'vis_kitti_3patch/image')
 
-        output_filename = os.path.join(output_path, frame_id)
-        frame_utils.writeFlowKITTI(output_filename, flow)
-
-        flow_img = flow_viz.flow_to_image(flow)
-        image = Image.fromarray(flow_img)
-        if not os.path.exists(f'vis_kitti_3patch'):
-            os.makedirs(f'vis_kitti_3patch/flow')
-            os.makedirs(f'vis_kitti_3patch/image')
-
-        image.save(f'vis_kitti_3patch/flow/{test_id}.png')
-        imageio.imwrite(f'vis_kitti_3patch/image/{test_id}_0.png', image1[0].cpu().permute(1, 2, 0).numpy())
-        imageio.imwrite(f'vis_kitti_3patch/image/{test_id}_1.png', image2[0].cpu().permute(1, 2, 0).numpy())
+            image.save(f'vis_kitti_3patch/flow/{test_id}.png')
+            imageio.imwrite(f'vis_kitti_3patch/image/{test_id}_0.png', image1[k].cpu().permute(1, 2, 0).numpy())
+            imageio.imwrite(f'vis_kitti_3patch/image/{test_id}_1.png', image2[k].cpu().permute(1, 2, 0).numpy())
 
 @torch.no_grad()
-def create_things_submission(model, output_path='things_submission', sigma=0.05):
+def create_things_submission(model, output_path='things_submission', sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=False, iters=None):
     """ Create submission for the FlyingThings3D dataset """
 
-    IMAGE_SIZE = [540, 960]  # Things数据集的默认尺寸
     TRAIN_SIZE = [432, 960]  # 与其他数据集的尺寸一致
 
     print(f"output path: {output_path}")
-    print(f"image size: {IMAGE_SIZE}")
     print(f"training size: {TRAIN_SIZE}")
 
-    # 计算网格索引和权重
-    hws = compute_grid_indices(IMAGE_SIZE, TRAIN_SIZE)
-    weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
-
     model.eval()
     test_dataset = datasets.FlyingThings3D(split='test')  # 获取Things3D数据集
 
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    for test_id in range(len(test_dataset)):
-        image1, image2, (sequence, frame) = test_dataset[test_id]
-        new_shape = image1.shape[1:]
-        if new_shape[1] != IMAGE_SIZE[1]:  # 如果宽度不一致，调整图像尺寸
-            print(f"replace {IMAGE_SIZE} with {new_shape}")
-            IMAGE_SIZE[0] = new_shape[0]
-            IMAGE_SIZE[1] = new_shape[1]
-            hws = compute_grid_indices(IMAGE_SIZE, TRAIN_SIZE)
-            weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
+    for batch in batched_pairs(test_dataset, pair_batch):
+        image1 = torch.stack([item[0] for _, item in batch])
+        image2 = torch.stack([item[1] for _, item in batch])
 
         # Padding和图像处理
         padder = InputPadder(image1.shape)
-        image1, image2 = padder.pad(image1[None].cuda(), image2[None].cuda())
-
-        flows = 0
-        flow_count = 0
+        image1, image2 = padder.pad(image1.cuda(), image2.cuda())
 
-        # 按照网格进行处理
-        for idx, (h, w) in enumerate(hws):
-            image1_tile = image1[:, :, h:h + TRAIN_SIZE[0], w:w + TRAIN_SIZE[1]]
-            image2_tile = image2[:, :, h:h + TRAIN_SIZE[0], w:w + TRAIN_SIZE[1]]
-            flow_pre, _ = model(image1_tile, image2_tile)
+        # 按图像尺寸规划分块并处理
+        plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
+        flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone, iters=iters)
 
-            padding = (w, IMAGE_SIZE[1] - w - TRAIN_SIZE[1], h, IMAGE_SIZE[0] - h - TRAIN_SIZE[0], 0, 0)
-            flows += F.pad(flow_pre * weights[idx], padding)
-            flow_count += F.pad(weights[idx], padding)
+        for k, (test_id, (_, _, (sequence, frame))) in enumerate(batch):
+            flow = padder.unpad(flow_pre[k]).cpu().numpy()
 
-        flow_pre = flows / flow_count
-        flow_pre = padder.unpad(flow_pre[0]).cpu().numpy()
+            # 将结果保存为 .npy 文件
+            output_filename = os.path.join(output_path, f'{sequence}_frame{frame:04d}.npy')
+            if not os.path.exists(os.path.dirname(output_filename)):
+                os.makedirs(os.path.dirname(output_filename))
 
-        # 将结果保存为 .npy 文件
-        output_filename = os.path.join(output_path, f'{sequence}_frame{frame:04d}.npy')
-        if not os.path.exists(os.path.dirname(output_filename)):
-            os.makedirs(os.path.dirname(output_filename))
+            np.save(output_filename, flow)  # 保存为 .npy 文件
 
-        np.save(output_filename, flow_pre)  # 保存为 .npy 文件
+            # 生成光流图像用于可视化
+            flow_img = flow_viz.flow_to_image(flow)
+            image = Image.fromarray(flow_img)
+            if not os.path.exists(f'vis_things_3d/flow'):
+                os.makedirs(f'vis_things_3d/flow')
+                os.makedirs(f'vis_things_3d/image')
 
-        # 生成光流图像用于可视化
-        flow_img = flow_viz.flow_to_image(flow_pre)
-        image = Image.fromarray(flow_img)
-        if not os.path.exists(f'vis_things_3d/flow'):
-            os.makedirs(f'vis_things_3d/flow')
-            os.makedirs(f'vis_things_3d/image')
-
-        image.save(f'vis_things_3d/flow/{test_id}.png')
-        imageio.imwrite(f'vis_things_3d/image/{test_id}_0.png', image1[0].cpu().permute(1, 2, 0).numpy())
-        imageio.imwrite(f'vis_things_3d/image/{test_id}_1.png', image2[0].cpu().permute(1, 2, 0).numpy())
+            image.save(f'vis_things_3d/flow/{test_id}.png')
+            imageio.imwrite(f'vis_things_3d/image/{test_id}_0.png', image1[k].cpu().permute(1, 2, 0).numpy())
+            imageio.imwrite(f'vis_things_3d/image/{test_id}_1.png', image2[k].cpu().permute(1, 2, 0).numpy())
 
 
 @torch.no_grad()
-def validate_kitti(model, sigma=0.05):
-    IMAGE_SIZE = [376, 1242]
+def validate_kitti(model, sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=False, iters=None):
     TRAIN_SIZE = [288, 960]
 
-    hws = compute_grid_indices(IMAGE_SIZE, TRAIN_SIZE)
-    weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
     model.eval()
     val_dataset = datasets.KITTI(split='training')
 
     out_list, epe_list = [], []
-    for val_id in range(len(val_dataset)):
-        image1, image2, flow_gt, valid_gt = val_dataset[val_id]
-        new_shape = image1.shape[1:]
-        if new_shape[1] != IMAGE_SIZE[1] or new_shape[0] != IMAGE_SIZE[0]:
-            print(f"replace {IMAGE_SIZE} with {new_shape}")
-            IMAGE_SIZE[0] = new_shape[0]
-            IMAGE_SIZE[1] = new_shape[1]
-            hws = compute_grid_indices(IMAGE_SIZE, TRAIN_SIZE)
-            weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
-
-        image1, image2 = image1[None].cuda(), image2[None].cuda()
-
-        flows = 0
-        flow_count = 0
-
-        for idx, (h, w) in enumerate(hws):
-            image1_tile = image1[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-            image2_tile = image2[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-            flow_pre, flow_low = model(image1_tile, image2_tile)
-
-            padding = (w, IMAGE_SIZE[1]-w-TRAIN_SIZE[1], h, IMAGE_SIZE[0]-h-TRAIN_SIZE[0], 0, 0)
-            flows += F.pad(flow_pre * weights[idx], padding)
-            flow_count += F.pad(weights[idx], padding)
-
-        flow_pre = flows / flow_count
-        flow = flow_pre[0].cpu()
-        epe = torch.sum((flow - flow_gt)**2, dim=0).sqrt()
-        mag = torch.sum(flow_gt**2, dim=0).sqrt()
-
-        epe = epe.view(-1)
-        mag = mag.view(-1)
-        val = valid_gt.view(-1) >= 0.5
-
-        out = ((epe > 3.0) & ((epe/mag) > 0.05)).float()
-        epe_list.append(epe[val].mean().item())
-        out_list.append(out[val].cpu().numpy())
+    for batch in batched_pairs(val_dataset, pair_batch):
+        image1 = torch.stack([item[0] for _, item in batch])
+        image2 = torch.stack([item[1] for _, item in batch])
+        image1, image2 = image1.cuda(), image2.cuda()
+        plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
+
+        flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone, iters=iters)
+
+        for k, (val_id, (_, _, flow_gt, valid_gt)) in enumerate(batch):
+            flow = flow_pre[k].cpu()
+            epe = torch.sum((flow - flow_gt)**2, dim=0).sqrt()
+            mag = torch.sum(flow_gt**2, dim=0).sqrt()
+
+            epe = epe.view(-1)
+            mag = mag.view(-1)
+            val = valid_gt.view(-1) >= 0.5
+
+            out = ((epe > 3.0) & ((epe/mag) > 0.05)).float()
+            epe_list.append(epe[val].mean().item())
+            out_list.append(out[val].cpu().numpy())
 
     epe_list = np.array(epe_list)
     out_list = np.concatenate(out_list)
@@ -316,14 +243,9 @@ def validate_kitti(model, sigma=0.05):
     return {'kitti-epe': epe, 'kitti-f1': f1}
 
 @torch.no_grad()
-def validate_sintel(model, sigma=0.05):
+def validate_sintel(model, sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=False, iters=None):
     """ Peform validation using the Sintel (train) split """
 
-    IMAGE_SIZE = [436, 1024]
-
-    hws = compute_grid_indices(IMAGE_SIZE)
-    weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
-
     model.eval()
     results = {}
     for dstype in ['final', "clean"]:
@@ -331,32 +253,19 @@ def validate_sintel(model, sigma=0.05):
 
         epe_list = []
 
-        for val_id in range(len(val_dataset)):
-            if val_id % 50 == 0:
-                print(val_id)
-
-            image1, image2, flow_gt, _ = val_dataset[val_id]
-            image1 = image1[None].cuda()
-            image2 = image2[None].cuda()
+        for batch in batched_pairs(val_dataset, pair_batch):
+            image1 = torch.stack([item[0] for _, item in batch]).cuda()
+            image2 = torch.stack([item[1] for _, item in batch]).cuda()
+            plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
 
-            flows = 0
-            flow_count = 0
+            flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone, iters=iters)
 
-            for idx, (h, w) in enumerate(hws):
-                image1_tile = image1[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-                image2_tile = image2[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
+            for k, (val_id, (_, _, flow_gt, _)) in enumerate(batch):
+                if val_id % 50 == 0:
+                    print(val_id)
 
-                flow_pre, _ = model(image1_tile, image2_tile, flow_init=None)
-
-                padding = (w, IMAGE_SIZE[1]-w-TRAIN_SIZE[1], h, IMAGE_SIZE[0]-h-TRAIN_SIZE[0], 0, 0)
-                flows += F.pad(flow_pre * weights[idx], padding)
-                flow_count += F.pad(weights[idx], padding)
-
-            flow_pre = flows / flow_count
-            flow_pre = flow_pre[0].cpu()
-
-            epe = torch.sum((flow_pre - flow_gt)**2, dim=0).sqrt()
-            epe_list.append(epe.view(-1).numpy())
+                epe = torch.sum((flow_pre[k].cpu() - flow_gt)**2, dim=0).sqrt()
+                epe_list.append(epe.view(-1).numpy())
 
         epe_all = np.concatenate(epe_list)
         epe = np.mean(epe_all)
@@ -370,42 +279,25 @@ def validate_sintel(model, sigma=0.05):
     return results
 
 @torch.no_grad()
-def validate_things(model, sigma=0.05):
+def validate_things(model, sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=False, iters=None):
     """ Perform validation using the FlyingThings3D (train) split """
 
-    IMAGE_SIZE = [540, 960]  # Things' default size
     TRAIN_SIZE = [432, 960]  # change to the same size as others
 
-    hws = compute_grid_indices(IMAGE_SIZE, TRAIN_SIZE)
-    weights = compute_weight(hws, IMAGE_SIZE, TRAIN_SIZE, sigma)
-
     model.eval()
     val_dataset = datasets.FlyingThings3D(split='training')  #
 
     epe_list = []
-    for val_id in range(len(val_dataset)):
-        image1, image2, flow_gt, _ = val_dataset[val_id]
-        image1 = image1[None].cuda()
-        image2 = image2[None].cuda()
-
-        flows = 0
-        flow_count = 0
-
-        for idx, (h, w) in enumerate(hws):
-            image1_tile = image1[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-            image2_tile = image2[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-
-            flow_pre, _ = model(image1_tile, image2_tile)
+    for batch in batched_pairs(val_dataset, pair_batch):
+        image1 = torch.stack([item[0] for _, item in batch]).cuda()
+        image2 = torch.stack([item[1] for _, item in batch]).cuda()
+        plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
 
-            padding = (w, IMAGE_SIZE[1]-w-TRAIN_SIZE[1], h, IMAGE_SIZE[0]-h-TRAIN_SIZE[0], 0, 0)
-            flows += F.pad(flow_pre * weights[idx], padding)
-            flow_count += F.pad(weights[idx], padding)
+        flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone, iters=iters)
 
-        flow_pre = flows / flow_count
-        flow_pre = flow_pre[0].cpu()
-
-        epe = torch.sum((flow_pre - flow_gt)**2, dim=0).sqrt()
-        epe_list.append(epe.view(-1).numpy())
+        for k, (val_id, (_, _, flow_gt, _)) in enumerate(batch):
+            epe = torch.sum((flow_pre[k].cpu() - flow_gt)**2, dim=0).sqrt()
+            epe_list.append(epe.view(-1).numpy())
 
     epe_all = np.concatenate(epe_list)
     epe = np.mean(epe_all)
@@ -417,14 +309,116 @@ def validate_things(model, sigma=0.05):
     return {'things-epe': epe}
 
 
+@torch.no_grad()
+def validate_sintel_shared_backbone(model, sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=True, iters=None):
+    """ Compare shared-backbone tiling against per-tile encoding on the Sintel (train) split """
+
+    model.eval()
+    results = {}
+    for dstype in ['final', "clean"]:
+        val_dataset = datasets.MpiSintel(split='training', dstype=dstype)
+
+        epe_list, epe_shared_list, diff_list = [], [], []
+        time_tile, time_shared = 0, 0
+
+        for batch in batched_pairs(val_dataset, pair_batch):
+            image1 = torch.stack([item[0] for _, item in batch]).cuda()
+            image2 = torch.stack([item[1] for _, item in batch]).cuda()
+            plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
+
+            torch.cuda.synchronize()
+            start = time.time()
+            flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, iters=iters).cpu()
+            torch.cuda.synchronize()
+            time_tile += time.time() - start
+
+            start = time.time()
+            flow_shared = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone=True, iters=iters).cpu()
+            torch.cuda.synchronize()
+            time_shared += time.time() - start
+
+            for k, (val_id, (_, _, flow_gt, _)) in enumerate(batch):
+                epe_list.append(torch.sum((flow_pre[k] - flow_gt)**2, dim=0).sqrt().view(-1).numpy())
+                epe_shared_list.append(torch.sum((flow_shared[k] - flow_gt)**2, dim=0).sqrt().view(-1).numpy())
+                diff_list.append(torch.sum((flow_shared[k] - flow_pre[k])**2, dim=0).sqrt().view(-1).numpy())
+
+        epe = np.mean(np.concatenate(epe_list))
+        epe_shared = np.mean(np.concatenate(epe_shared_list))
+        diff = np.mean(np.concatenate(diff_list))
+
+        print("Validation (%s) EPE tile: %f (%.1fs), shared backbone: %f (%.1fs), EPE between the two: %f" % (dstype, epe, time_tile, epe_shared, time_shared, diff))
+        results[f"{dstype}_tile"] = epe
+        results[f"{dstype}_shared_backbone"] = epe_shared
+
+    return results
+
+
+@torch.no_grad()
+def validate_sintel_warm_start(model, sigma=0.05, tile_batch=1, pair_batch=1, shared_backbone=False, iters=None, warm_start=True):
+    """ Latency / EPE table of cold-started decoding against warm starts with fewer decoder iterations
+        on the Sintel (train) split, pairs of each scene are processed in order.
+    """
+    depth = model.memory_decoder.depth
+    runs = [(False, depth)] + [(True, it) for it in ([iters] if iters else sorted({depth, 8, 6, 4}, reverse=True))]
+
+    model.eval()
+    results = {}
+    for dstype in ['final', "clean"]:
+        val_dataset = datasets.MpiSintel(split='training', dstype=dstype)
+
+        print(f"Validation ({dstype})")
+        print("| %-10s | %5s | %8s | %10s |" % ("init", "iters", "EPE", "ms / pair"))
+        for warm, run_iters in runs:
+            epe_list = []
+            flow_prev, sequence_prev = None, None
+            elapsed = 0
+
+            for val_id in range(len(val_dataset)):
+                image1, image2, flow_gt, _ = val_dataset[val_id]
+                image1, image2 = image1[None].cuda(), image2[None].cuda()
+                plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
+
+                torch.cuda.synchronize()
+                start = time.time()
+
+                flow_init = None
+                sequence = val_dataset.extra_info[val_id][0]
+                if warm and sequence == sequence_prev:
+                    flow_init = warm_start_init(flow_prev, plan)
+                sequence_prev = sequence
+
+                flow_pre = forward_tiles(model, image1, image2, plan, sigma, tile_batch, shared_backbone, flow_init, run_iters)
+                flow_prev = flow_pre
+
+                torch.cuda.synchronize()
+                elapsed += time.time() - start
+
+                epe = torch.sum((flow_pre[0].cpu() - flow_gt)**2, dim=0).sqrt()
+                epe_list.append(epe.view(-1).numpy())
+
+            epe = np.mean(np.concatenate(epe_list))
+            ms = 1000 * elapsed / len(val_dataset)
+            print("| %-10s | %5d | %8.4f | %10.1f |" % ("warm" if warm else "cold", run_iters, epe, ms))
+            results[f"{dstype}_{'warm' if warm else 'cold'}_{run_iters}"] = (epe, ms)
+
+    return results
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', help='load model')
     parser.add_argument('--eval', help='eval benchmark')
     parser.add_argument('--small', action='store_true', help='use small model')
+    parser.add_argument('--tile_batch', type=int, default=1, help='number of tiles stacked into one forward pass')
+    parser.add_argument('--pair_batch', type=int, default=1, help='number of same-sized image pairs tiled together')
+    parser.add_argument('--shared_backbone', action='store_true', help='encode full frames once and crop features per tile')
+    parser.add_argument('--iters', type=int, default=None, help='decoder iterations, defaults to decoder_depth')
+    parser.add_argument('--warm_start', action='store_true', help='initialize each Sintel pair with the forward-splatted flow of the previous pair')
+    parser.add_argument('--freeze_tol', type=float, default=None, help='stop refining pixels whose flow update falls below this (1/8 px)')
     args = parser.parse_args()
 
+    if args.warm_start and args.eval not in ('sintel_submission', 'sintel_warm_start'):
+        parser.error("--warm_start is only supported with --eval sintel_submission or sintel_warm_start")
+
     exp_func = None
 
     if args.eval == 'sintel_submission':
@@ -442,9 +436,17 @@ if __name__ == '__main__':
     elif args.eval == 'things_validation':
         exp_func = validate_things
         cfg = get_submission_cfg()
+    elif args.eval == 'sintel_shared_backbone_parity':
+        exp_func = validate_sintel_shared_backbone
+        cfg = get_submission_cfg()
+    elif args.eval == 'sintel_warm_start':
+        exp_func = validate_sintel_warm_start
+        cfg = get_submission_cfg()
     else:
         print(f"EROOR: {args.eval} is not valid")
     cfg.update(vars(args))
+    if args.freeze_tol is not None:
+        cfg.percostformer3.freeze_tol = args.freeze_tol
 
     print(cfg)
     model = torch.nn.DataParallel(build_flowformer(cfg))
@@ -453,4 +455,17 @@ if __name__ == '__main__':
     model.cuda()
     model.eval()
 
-    exp_func(model.module)
+    # memory_decoder.freeze_stats covers one forward, summed over the evaluation here
+    freeze_stats = {'pixel_iters': 0, 'skipped': 0}
+    def add_freeze_stats(decoder, inputs, output):
+        for key in freeze_stats:
+            freeze_stats[key] += decoder.freeze_stats[key]
+    model.module.memory_decoder.register_forward_hook(add_freeze_stats)
+
+    kwargs = dict(tile_batch=args.tile_batch, pair_batch=args.pair_batch, shared_backbone=args.shared_backbone, iters=args.iters)
+    if args.warm_start:
+        kwargs['warm_start'] = True
+    exp_func(model.module, **kwargs)
+
+    if freeze_stats['pixel_iters'] > 0:
+        print("convergence freezing skipped %d / %d pixel-iterations (%.1f%%)" % (freeze_stats['skipped'], freeze_stats['pixel_iters'], 100 * freeze_stats['skipped'] / freeze_stats['pixel_iters']))
@@ -5,13 +5,7 @@ import numpy as np
 from PIL import Image
 import imageio
 import argparse
-import argparse
-import os
-import time
-import numpy as np
-import torch
-import torch.nn.functional as F
-import matplotlib.pyplot as plt
+import re
 from configs.submissions import get_cfg as get_submission_cfg
 from core.utils.misc import process_cfg
 # import datasets
@@ -20,30 +14,95 @@ from core.utils.utils import InputPadder
 from core.utils import flow_viz
 
 
+def load_image(image_path):
+    """ 读取一帧图像，返回 [1, 3, H, W] 的 cuda tensor """
+    image = imageio.imread(image_path)
+    return torch.from_numpy(image).permute(2, 0, 1).float().unsqueeze(0).cuda()
+
+
 @torch.no_grad()
-def compute_flow(model, image1_path, image2_path):
-    """ 计算两张图片之间的光流 """
+def compute_flow(model, image1_path, image2_path, iters=None, output_stride=1):
+    """ 计算两张图片之间的光流，output_stride 为 4 或 8 时输出 1/4 或 1/8 分辨率的光流 (单位为该分辨率的像素) """
 
     # **获取已处理的完整视频文件夹**
     # processed_videos = set(os.listdir(output_root))
-    image1 = imageio.imread(image1_path)
-    image2 = imageio.imread(image2_path)
+    image1 = load_image(image1_path)
+    image2 = load_image(image2_path)
 
-    image1 = torch.from_numpy(image1).permute(2, 0, 1).float().unsqueeze(0).cuda()
-    image2 = torch.from_numpy(image2).permute(2, 0, 1).float().unsqueeze(0).cuda()
-
-    padder = InputPadder(image1.shape)
+    padder = InputPadder(image1.shape, mode='sintel' if output_stride == 1 else 'downreplicate')
     image1, image2 = padder.pad(image1, image2)
 
-    flow_pre, _ = model(image1, image2)
-    flow_pre = padder.unpad(flow_pre[0]).cpu().numpy()
+    flow_pre, _ = model(image1, image2, iters=iters, output_stride=output_stride)
+    flow_pre = padder.unpad(flow_pre[0], output_stride).cpu().numpy()
 
     return flow_pre
 
 
 @torch.no_grad()
-def process_videos(input_root, output_root, model):
-    """ 遍历输入文件夹，处理所有的视频和pair文件夹 """
+def compute_sequence_flow(model, frame_paths, frame_batch=4, warm_start=False, iters=None, output_stride=1):
+    """ 依次计算连续帧 (t, t+1) 之间的光流，每帧只读取和编码一次
+
+        warm_start  -   用上一对的 1/8 光流 (forward_interpolate) 初始化当前对
+        iters       -   decoder 迭代次数，默认 decoder_depth
+        output_stride - 输出光流的分辨率 (1, 4, 8)
+    """
+    padder = None
+
+    def frames():
+        nonlocal padder
+        for frame_path in frame_paths:
+            image = load_image(frame_path)
+            if padder is None:
+                padder = InputPadder(image.shape, mode='sintel' if output_stride == 1 else 'downreplicate')
+            yield padder.pad(image)[0]
+
+    for flow_pre, _ in model.forward_sequence(frames(), frame_batch, warm_start, iters, output_stride):
+        yield padder.unpad(flow_pre[0], output_stride).cpu().numpy()
+
+
+def pair_index(pair_folder):
+    """ pair 文件夹名末尾的编号，例如 xxx_pair_00004 -> 4，没有编号时返回 None """
+    match = re.search(r'(\d+)$', pair_folder)
+    return int(match.group(1)) if match else None
+
+
+def pair_sequences(video_path):
+    """ 把按顺序排列的 pair 文件夹拼接成连续帧序列，缺帧或编号不连续 (缺少某个 pair) 都会断开序列 """
+    sequence = []
+    last_index = None
+    for pair_folder in sorted(os.listdir(video_path)):
+        pair_path = os.path.join(video_path, pair_folder)
+        if not os.path.isdir(pair_path):
+            continue
+
+        frame1_path = os.path.join(pair_path, "frame1.png")
+        frame2_path = os.path.join(pair_path, "frame2.png")
+        if not os.path.exists(frame1_path) or not os.path.exists(frame2_path):
+            print(f"Missing frames in {pair_path}, skipping.")
+            if sequence:
+                yield sequence
+            sequence = []
+            continue
+
+        index = pair_index(pair_folder)
+        if sequence and index is not None and last_index is not None and index != last_index + 1:
+            yield sequence
+            sequence = []
+        last_index = index
+        sequence.append(pair_folder)
+    if sequence:
+        yield sequence
+
+
+@torch.no_grad()
+def process_videos(input_root, output_root, model, sequence=False, frame_batch=4, warm_start=False, iters=None, output_stride=1):
+    """ 遍历输入文件夹，处理所有的视频和pair文件夹
+
+        sequence    -   相邻 pair 文件夹共享帧 (pair i 的 frame2 即 pair i+1 的 frame1)，
+                        按连续帧序列处理，每帧只编码一次，frame_batch 帧一起过编码器
+        warm_start  -   序列模式下用上一对的光流初始化当前对，配合较小的 iters 使用
+        output_stride - 保存 1 (原分辨率)、1/4 或 1/8 分辨率的光流，低分辨率时跳过 convex upsampling
+    """
     cnt = 0
     # **获取已处理的完整视频文件夹**
     processed_videos = set(os.listdir(output_root))
@@ -65,6 +124,17 @@ def process_videos(input_root, output_root, model):
         output_video_path = os.path.join(output_root, video_folder)
         os.makedirs(output_video_path, exist_ok=True)
 
+        if sequence:
+            for pair_folders in pair_sequences(video_path):
+                frame_paths = [os.path.join(video_path, pair_folders[0], "frame1.png")]
+                frame_paths += [os.path.join(video_path, pair_folder, "frame2.png") for pair_folder in pair_folders]
+
+                flows = compute_sequence_flow(model, frame_paths, frame_batch, warm_start, iters, output_stride)
+                for pair_folder, flow in zip(pair_folders, flows):
+                    np.save(os.path.join(output_video_path, f"{pair_folder}.npy"), flow)
+            print(cnt)
+            continue
+
         for pair_folder in sorted(os.listdir(video_path)):
             pair_path = os.path.join(video_path, pair_folder)
             if not os.path.isdir(pair_path):
@@ -76,7 +146,7 @@ def process_videos(input_root, output_root, model):
                 print(f"Missing frames in {pair_path}, skipping.")
                 continue
 
-            flow = compute_flow(model, frame1_path, frame2_path)
+            flow = compute_flow(model, frame1_path, frame2_path, iters, output_stride)
 
             # 保存 .npy 文件
             npy_output = os.path.join(output_video_path, f"{pair_folder}.npy")
@@ -99,16 +169,24 @@ if __name__ == "__main__":
     parser.add_argument('--model', required=True, help='Path to trained model file')
     parser.add_argument('--input', required=True, help='Path to input root directory (tennis_pairs)')
     parser.add_argument('--output', required=True, help='Path to output root directory (tennis_flow)')
+    parser.add_argument('--sequence', action='store_true', help='chain consecutive pair folders and encode each frame once')
+    parser.add_argument('--frame_batch', type=int, default=4, help='number of frames encoded at once in sequence mode')
+    parser.add_argument('--warm_start', action='store_true', help='initialize each pair with the flow of the previous pair (implies --sequence)')
+    parser.add_argument('--iters', type=int, default=None, help='decoder iterations, defaults to decoder_depth')
+    parser.add_argument('--output_stride', type=int, default=1, choices=[1, 4, 8], help='save flow at full, 1/4 or 1/8 resolution')
+    parser.add_argument('--freeze_tol', type=float, default=None, help='stop refining pixels whose flow update falls below this (1/8 px)')
     args = parser.parse_args()
 
     # 加载模型
     # cfg = None
     cfg = get_submission_cfg()
     cfg.update(vars(args))  # 把 argparse 解析的参数加进去
+    if args.freeze_tol is not None:
+        cfg.percostformer3.freeze_tol = args.freeze_tol
     model = torch.nn.DataParallel(build_flowformer(cfg))
     model.load_state_dict(torch.load(args.model))
     model.cuda()
     model.eval()
 
     # 处理所有视频
-    process_videos(args.input, args.output, model)
+    process_videos(args.input, args.output, model.module, args.sequence or args.warm_start, args.frame_batch, args.warm_start, args.iters, args.output_stride)
@@ -0,0 +1,155 @@
+import pytest
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer import build_flowformer
+from core.FlowFormer.PerCostFormer3.attention import BroadMultiHeadAttention, MultiHeadAttention, set_attention_backend
+from core.FlowFormer.PerCostFormer3.twins import LocallyGroupedAttnRPEContext, GlobalSubSampleAttnRPEContext
+from core.FlowFormer.PerCostFormer3.gma import Attention, Aggregate
+from core.FlowFormer.PerCostFormer3.NA import natten_qkrpb, natten_av, selfattentionlayer_nat
+from benchmark_neighborhood_attention import dense_reference
+
+
+def cases():
+    """ name -> (module, call) for the attention modules at small shapes of the model, 1/8 resolution 11 x 13 """
+    cfg = get_cfg().percostformer3
+    dim, latent, heads, H, W = cfg.cost_latent_dim, cfg.cost_latent_token_num, 8, 11, 13
+
+    # latent tokens shared by the batch attending to the patches of every cost map
+    broad = BroadMultiHeadAttention(dim, heads)
+    latents, patches = torch.randn(1, latent, dim), torch.randn(6, 4, dim)
+    yield 'BroadMultiHeadAttention', broad, lambda: broad(latents, patches, patches)
+
+    multi = MultiHeadAttention(dim, heads)
+    query, memory = torch.randn(6, 1, dim), torch.randn(6, latent, dim)
+    yield 'MultiHeadAttention', multi, lambda: multi(query, memory, memory)
+
+    tokens = torch.randn(2*latent, 5, dim)
+    yield 'MultiHeadAttention.forward_tokens', multi, lambda: multi.forward_tokens(tokens, tokens, tokens, latent)
+
+    x = torch.randn(latent, H*W, dim)
+    context = torch.randn(1, cfg.encoder_latent_dim, H, W)
+    local = LocallyGroupedAttnRPEContext(dim, heads, ws=7, vert_c_dim=cfg.vert_c_dim, encoder_latent_dim=cfg.encoder_latent_dim)
+    yield 'LocallyGroupedAttnRPEContext', local, lambda: local(x, (H, W), context)
+    glob = GlobalSubSampleAttnRPEContext(dim, heads, sr_ratio=4, vert_c_dim=cfg.vert_c_dim, encoder_latent_dim=cfg.encoder_latent_dim)
+    yield 'GlobalSubSampleAttnRPEContext', glob, lambda: glob(x, (H, W), context)
+
+    attention, aggregate = Attention(args=cfg, dim=128, heads=1, max_pos_size=160, dim_head=128), Aggregate(args=cfg, dim=128, dim_head=128, heads=1)
+    aggregate.gamma.data.fill_(1.)
+    fmap, motion = torch.randn(1, 128, H, W), torch.randn(1, 128, H, W)
+    yield 'GMA Attention + Aggregate', torch.nn.ModuleList([attention, aggregate]), lambda: aggregate(attention(fmap), motion)
+
+
+@pytest.mark.parametrize('name, module, call', list(cases()), ids=lambda case: case if isinstance(case, str) else '')
+def test_sdpa_matches_einsum(name, module, call):
+    torch.manual_seed(0)
+    module.eval()
+    with torch.no_grad():
+        set_attention_backend(module, 'einsum')
+        ref = call()
+        set_attention_backend(module, 'sdpa')
+        out = call()
+
+    assert out.shape == ref.shape
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-5)
+
+
+def build(backend):
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False
+    cfg.percostformer3.attention_backend = backend
+    return build_flowformer(cfg)
+
+
+def test_backend_is_per_model():
+    einsum_model = build('einsum')
+    sdpa_model = build('sdpa')
+
+    backends = lambda model: {module.backend for module in model.modules() if hasattr(module, 'backend')}
+    assert backends(einsum_model) == {'einsum'}
+    assert backends(sdpa_model) == {'sdpa'}
+
+
+@pytest.mark.parametrize('size, tile', [((11, 11), 16), ((19, 23), 16), ((19, 23), 5), ((12, 40), 7)])
+def test_neighborhood_attention_matches_masked_attention(size, tile):
+    """ The pytorch NA kernels against masked full attention, values and gradients, at 1/8 sizes of at least 11 """
+    torch.manual_seed(0)
+    shape = (2, 4, *size, 16)
+    query, key, value = (torch.randn(shape, dtype=torch.float64, requires_grad=True) for _ in range(3))
+    rpb = torch.randn(4, 21, 21, dtype=torch.float64, requires_grad=True)
+
+    out = natten_av(natten_qkrpb(query, key, rpb, tile).softmax(dim=-1), value, tile)
+    ref = dense_reference(query, key, value, rpb)
+    torch.testing.assert_close(out, ref, rtol=1e-10, atol=1e-10)
+
+    grad = torch.randn_like(out)
+    grads = torch.autograd.grad((out * grad).sum(), [query, key, value, rpb])
+    grads_ref = torch.autograd.grad((ref * grad).sum(), [query, key, value, rpb])
+    for g, r in zip(grads, grads_ref):
+        torch.testing.assert_close(g, r, rtol=1e-10, atol=1e-10)
+
+
+def test_neighborhood_attention_minimum_size():
+    cfg = get_cfg().percostformer3
+    layer = selfattentionlayer_nat(cfg).eval()
+    call = lambda H, W: layer(torch.randn(2, H*W, cfg.cost_latent_dim), (H, W), torch.randn(1, cfg.encoder_latent_dim, H, W))
+
+    with torch.no_grad():
+        assert call(11, 11).shape == (2, 11*11, cfg.cost_latent_dim)
+        # 64 x 96 frames are 8 x 12 at 1/8
+        with pytest.raises(AssertionError, match='at least 11 x 11'):
+            call(8, 12)
+
+
+def test_forward_NA_vertical_encoder():
+    """ The smallest frame the 11 x 11 neighborhoods fit into at 1/8 """
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False
+    cfg.percostformer3.vertical_encoder_attn = 'NA'
+    torch.manual_seed(0)
+    model = build_flowformer(cfg).eval()
+    with torch.no_grad():
+        flow, _ = model(255 * torch.rand(1, 3, 88, 104), 255 * torch.rand(1, 3, 88, 104))
+
+    assert flow.shape == (1, 2, 88, 104) and torch.isfinite(flow).all()
+
+
+def test_gma_chunk_forward_matches_unchunked():
+    image1, image2 = 255 * torch.rand(1, 3, 64, 96), 255 * torch.rand(1, 3, 64, 96)
+    flows = []
+    for gma_chunk in (-1, 17):
+        cfg = get_cfg()
+        cfg.percostformer3.pretrain = False
+        cfg.percostformer3.gma_chunk = gma_chunk
+        torch.manual_seed(0)
+        with torch.no_grad():
+            flows.append(build_flowformer(cfg).eval()(image1, image2)[0])
+
+    torch.testing.assert_close(flows[1], flows[0], rtol=1e-5, atol=1e-5)
+
+
+def test_gma_chunk_gradients_match_unchunked():
+    """ With grad enabled the chunks are checkpointed, the recomputed backward gives the same gradients """
+    cfg = get_cfg().percostformer3
+    torch.manual_seed(0)
+    attention, aggregate = Attention(args=cfg, dim=128, heads=1, max_pos_size=160, dim_head=128), Aggregate(args=cfg, dim=128, dim_head=128, heads=1)
+    aggregate.gamma.data.fill_(1.)
+    modules = torch.nn.ModuleList([attention, aggregate]).train()
+    fmap, motion = torch.randn(1, 128, 11, 13), torch.randn(1, 128, 11, 13)
+    grad_out = torch.randn(1, 128, 11, 13)
+
+    results = []
+    for gma_chunk in (-1, 17):
+        cfg.gma_chunk = gma_chunk
+        inputs = [fmap.clone().requires_grad_(), motion.clone().requires_grad_()]
+        out = aggregate(attention(inputs[0]), inputs[1])
+        grads = torch.autograd.grad((out * grad_out).sum(), inputs + list(modules.parameters()), allow_unused=True)
+        results.append((out, grads))
+
+    (out, grads), (out_chunked, grads_chunked) = results
+    torch.testing.assert_close(out_chunked, out, rtol=1e-5, atol=1e-5)
+    assert grads[0] is not None and grads[0].abs().sum() > 0
+    for g, r in zip(grads_chunked, grads):
+        assert (g is None) == (r is None)
+        if r is not None:
+            torch.testing.assert_close(g, r, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,266 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer import build_flowformer
+from core.FlowFormer.PerCostFormer3 import transformer
+from core.FlowFormer.PerCostFormer3.cost_maps import FeatureCostMaps, TopKCostMaps, CompactCostMaps
+from core.utils.utils import bilinear_lookup, window_delta, window_lookup, coords_grid
+
+
+def build(**options):
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False
+    for key, value in options.items():
+        cfg.percostformer3[key] = value
+    torch.manual_seed(0)
+    return build_flowformer(cfg).eval()
+
+
+@pytest.mark.parametrize('options', [{}, {'r_16': 9}])
+def test_forward(options):
+    model = build(**options)
+    image1 = 255 * torch.rand(1, 3, 64, 96)
+    image2 = 255 * torch.rand(1, 3, 64, 96)
+    with torch.no_grad():
+        flow_up, flow_low = model(image1, image2)
+
+    assert flow_up.shape == (1, 2, 64, 96) and flow_low.shape == (1, 2, 8, 12)
+    assert torch.isfinite(flow_up).all()
+
+
+def test_forward_anytime_deadline(monkeypatch):
+    """ The first deadline check already uses a measured iteration time, the call does not overrun by one iteration """
+    model = build()
+    image1 = 255 * torch.rand(1, 3, 64, 96)
+    image2 = 255 * torch.rand(1, 3, 64, 96)
+
+    # a clock advancing one second per reading: the encoders end at 1, the first iteration is ready
+    # at 2 and takes a measured second, the deadline is checked at 3
+    def run(deadline):
+        clock = itertools.count()
+        monkeypatch.setattr(transformer, 'time', SimpleNamespace(time=lambda: float(next(clock))))
+        with torch.no_grad():
+            return [e for _, _, e in model.forward_anytime(image1, image2, deadline=deadline, iters=3)]
+
+    assert run(None) == [2., 3., 4.]
+    # 3 + 1 > 3.5, the second iteration would finish late
+    assert run(3.5) == [2.]
+    assert run(4.5) == [2., 4.]
+
+@pytest.mark.parametrize('options, output_stride', [({}, 1), ({}, 4), ({}, 8), ({'r_16': 9}, 1)])
+def test_forward_anytime_matches_forward(options, output_stride):
+    model = build(**options)
+    image1 = 255 * torch.rand(1, 3, 64, 96)
+    image2 = 255 * torch.rand(1, 3, 64, 96)
+    with torch.no_grad():
+        flow_up, flow_low = model(image1, image2, iters=3, output_stride=output_stride)
+        *_, (flow_up_anytime, flow_low_anytime, _) = model.forward_anytime(image1, image2, iters=3, output_stride=output_stride)
+
+    torch.testing.assert_close(flow_low_anytime, flow_low, rtol=0, atol=0)
+    torch.testing.assert_close(flow_up_anytime, flow_up, rtol=1e-5, atol=1e-5)
+
+
+def test_forward_anytime_quater_refine():
+    model = build()
+    model.cfg.quater_refine = True
+    with pytest.raises(NotImplementedError):
+        next(model.forward_anytime(torch.zeros(1, 3, 64, 96), torch.zeros(1, 3, 64, 96)))
+
+
+def test_freeze_stats_per_forward():
+    model = build(freeze_tol=0.05)
+    image1 = 255 * torch.rand(1, 3, 64, 96)
+    image2 = 255 * torch.rand(1, 3, 64, 96)
+    with torch.no_grad():
+        model(image1, image2)
+        first = dict(model.memory_decoder.freeze_stats)
+        model(image1, image2)
+
+    assert first['pixel_iters'] > 0
+    assert model.memory_decoder.freeze_stats == first
+
+
+def pair(seed=1, size=(64, 96)):
+    torch.manual_seed(seed)
+    return 255 * torch.rand(1, 3, *size), 255 * torch.rand(1, 3, *size)
+
+
+@pytest.mark.parametrize('options', [{'cost_chunk': 37}, {'cost_chunk': 37, 'factorized_embed': True}])
+def test_cost_chunk_matches_dense(options):
+    image1, image2 = pair()
+    with torch.no_grad():
+        ref, _ = build()(image1, image2)
+        out, _ = build(**options)(image1, image2)
+
+    torch.testing.assert_close(out, ref, rtol=1e-5, atol=1e-5)      # 8e-6 measured
+
+
+def test_cost_chunk_keeps_no_dense_cost_maps():
+    """ The decoder lookups of cost_chunk are recomputed from the features, linear in the frame size """
+    model = build(cost_chunk=37)
+    image1, image2 = pair()
+    data = {}
+    with torch.no_grad():
+        context, feat_s, feat_t = model.encode_images(image1, image2)
+        model.memory_encoder.forward_features(feat_s, feat_t, data, context)
+
+    assert isinstance(data['cost_maps'], FeatureCostMaps)
+    assert data['cost_maps'].nbytes() == (feat_s.numel() + feat_t.numel()) * 4
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='peak memory is measured with torch.cuda.max_memory_allocated')
+def test_cost_chunk_peak_memory():
+    image1, image2 = [x.cuda() for x in pair(size=(384, 768))]
+    peaks = []
+    for options in ({}, {'cost_chunk': 1024}):
+        model = build(**options).cuda()
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        with torch.no_grad():
+            model(image1, image2)
+        torch.cuda.synchronize()
+        peaks.append(torch.cuda.max_memory_allocated())
+        del model
+
+    dense, chunked = peaks
+    # dense mode keeps the float32 cost maps of the whole frame for the decoder, 85 MB per cost head at
+    # 384x768, the chunks of cost_chunk are a fifth of that
+    heads = get_cfg().percostformer3.cost_heads_num
+    assert chunked < dense - 0.5 * heads * 4 * (48*96)**2
+
+
+@pytest.mark.parametrize('options', [{}, {'cost_chunk': 37}])
+def test_topk_all_target_pixels_matches_dense(options):
+    """ TopKCostMaps keeping all H2*W2 responses looks up the dense cost maps """
+    image1, image2 = pair()
+    with torch.no_grad():
+        ref, _ = build()(image1, image2)
+        out, _ = build(cost_topk=8*12, **options)(image1, image2)
+
+    torch.testing.assert_close(out, ref, rtol=1e-5, atol=1e-5)      # 6e-6 measured
+
+
+def test_topk_lookup():
+    """ Dropped target pixels read as the smallest kept response of their row, the kept ones exactly """
+    torch.manual_seed(0)
+    maps = torch.randn(30, 2, 9, 11)
+    stored = TopKCostMaps(30, 2, (9, 11), k=20)
+    stored[torch.arange(30)] = maps
+
+    floor = maps.flatten(2).topk(20, dim=-1).values[..., -1:, None]
+    expected = torch.maximum(maps, floor)
+    rows = torch.arange(30)
+    coords = torch.rand(30, 1, 2) * torch.tensor([11., 9.]) + window_delta(4, 'cpu')
+    torch.testing.assert_close(stored.lookup(rows, coords), bilinear_lookup(expected, rows, coords), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('offset', [(0, 0), (3, 2)])
+def test_corr_local_matches_dense(offset):
+    """ The cost_radius windows are the crops of the dense cost maps centred on each source pixel """
+    encoder, r = build().memory_encoder, 3
+    torch.manual_seed(0)
+    fmap1, fmap2 = torch.randn(2, 256, 5, 7, dtype=torch.float64), torch.randn(2, 256, 9, 12, dtype=torch.float64)
+    ox, oy = offset
+
+    local = encoder.corr_local(fmap1, fmap2, r, offset)
+    dense = torch.nn.functional.pad(encoder.corr(fmap1, fmap2), (r, r, r, r))
+    for y in range(5):
+        for x in range(7):
+            window = dense[:, :, y, x, oy+y:oy+y+2*r+1, ox+x:ox+x+2*r+1]
+            torch.testing.assert_close(local[:, :, y, x], window, rtol=1e-12, atol=1e-12)
+
+
+def test_cost_radius_lookup_matches_dense():
+    """ The decoder lookups in the windows equal those in the dense cost maps for flows within cost_radius - 4 """
+    encoder, r = build().memory_encoder, 8
+    torch.manual_seed(0)
+    fmap1, fmap2 = torch.randn(1, 256, 6, 8, dtype=torch.float64), torch.randn(1, 256, 6, 8, dtype=torch.float64)
+    dense = encoder.corr(fmap1, fmap2).permute(0, 2, 3, 1, 4, 5).reshape(48, 1, 6, 8)
+    local = encoder.corr_local(fmap1, fmap2, r).permute(0, 2, 3, 1, 4, 5).reshape(48, 1, 2*r+1, 2*r+1)
+
+    coords0 = coords_grid(1, 6, 8).permute(0, 2, 3, 1).reshape(48, 2).double()
+    coords1 = coords0 + 8 * torch.rand(48, 2, dtype=torch.float64) - 4
+    rows = torch.arange(48)
+    torch.testing.assert_close(window_lookup(local, rows, coords1 - coords0 + r, 4), window_lookup(dense, rows, coords1, 4), rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('cost_dtype, tolerance', [('float16', 5e-3), ('bfloat16', 2e-2), ('int8', 1e-1)])
+def test_cost_dtype_close_to_dense(cost_dtype, tolerance):
+    """ Max flow difference to float32 cost maps on flows up to 7.5 px: 1.9e-3 (float16), 9.5e-3 (bfloat16), 4.6e-2 (int8) measured """
+    image1, image2 = pair()
+    with torch.no_grad():
+        ref, _ = build()(image1, image2)
+        out, _ = build(cost_dtype=cost_dtype)(image1, image2)
+
+    assert (out - ref).abs().max().item() < tolerance
+
+
+def test_int8_cost_maps_rounding():
+    """ int8 cost maps are off by at most half a quantization step, amax / 254 per row and cost head """
+    torch.manual_seed(0)
+    maps = 10 * torch.randn(30, 2, 9, 11)
+    stored = CompactCostMaps(30, 2, (9, 11), 'int8')
+    stored[torch.arange(30)] = maps
+
+    step = maps.abs().amax(dim=(2, 3), keepdim=True) / 127
+    assert ((stored.maps * stored.scale[:, :, None, None] - maps).abs() <= step / 2 + 1e-6).all()
+
+
+def test_local_corr_matches_dense():
+    image1, image2 = pair()
+    with torch.no_grad():
+        ref, _ = build()(image1, image2)
+        out, _ = build(local_corr=True)(image1, image2)
+
+    torch.testing.assert_close(out, ref, rtol=1e-5, atol=1e-5)      # 6e-6 measured
+
+
+def test_feature_cost_maps_lookup():
+    """ FeatureCostMaps windows recomputed from the features equal lookups in the dense cost maps """
+    encoder = build().memory_encoder
+    torch.manual_seed(0)
+    fmap1, fmap2 = torch.randn(2, 256, 5, 7, dtype=torch.float64), torch.randn(2, 256, 6, 9, dtype=torch.float64)
+    dense = encoder.corr(fmap1, fmap2).permute(0, 2, 3, 1, 4, 5).reshape(70, 1, 6, 9)
+    stored = FeatureCostMaps(fmap1, fmap2, heads=1, chunk=16)
+
+    rows = torch.randperm(70)[:40]
+    coords = torch.rand(40, 1, 2, dtype=torch.float64) * torch.tensor([9., 6.], dtype=torch.float64) + window_delta(4, 'cpu').double()
+    torch.testing.assert_close(stored.lookup(rows, coords), bilinear_lookup(dense, rows, coords), rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('options', [{}, {'local_corr': True}, {'cost_radius': 4}, {'cost_chunk': 37}])
+def test_roi_full_frame_box_matches_forward(options):
+    model = build(**options)
+    image1, image2 = pair()
+    with torch.no_grad():
+        ref, ref_low = model(image1, image2)
+        (flow, flow_low, region), = model.forward_roi(image1, image2, [(0, 0, 96, 64)], dilation=0)
+
+    assert region == (0, 0, 96, 64)
+    torch.testing.assert_close(flow_low, ref_low, rtol=0, atol=0)
+    torch.testing.assert_close(flow, ref, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize('options', [{}, {'cost_radius': 4}])
+def test_roi_cost_maps_match_full_frame(options):
+    """ Inside a box the region matches its source pixels against the target frame like the full frame does """
+    model = build(**options)
+    image1, image2 = pair()
+    with torch.no_grad():
+        context, feat_s, feat_t = model.encode_images(image1, image2)
+        full = {}
+        model.memory_encoder.forward_features(feat_s, feat_t, full, context)
+
+        (_, _, (x0, y0, x1, y1)), = model.forward_roi(image1, image2, [(20, 12, 60, 40)], dilation=8)
+        x0, y0, x1, y1 = x0 // 8, y0 // 8, x1 // 8, y1 // 8
+        crop = lambda x: x[:, :, y0:y1, x0:x1]
+        roi = {}
+        model.memory_encoder.forward_features(crop(feat_s), feat_t, roi, crop(context), offset=(x0, y0))
+
+    rows = torch.arange(8*12).view(8, 12)[y0:y1, x0:x1].flatten()
+    assert len(rows) < 8*12
+    torch.testing.assert_close(roi['cost_maps'], full['cost_maps'][rows], rtol=1e-5, atol=1e-4)
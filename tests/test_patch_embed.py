@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from configs.submissions import get_cfg
+from core.FlowFormer.PerCostFormer3.encoder import PatchEmbed
+
+
+@pytest.mark.parametrize('use_rpe', [False, True])
+def test_factorized_matches_cost_maps(use_rpe):
+    """ forward_factorized on the features equals PatchEmbed of the cost maps they span """
+    cfg = get_cfg().percostformer3
+    cfg.use_rpe = use_rpe
+    torch.manual_seed(1234)
+    patch_embed = PatchEmbed(in_chans=cfg.cost_heads_num, patch_size=cfg.patch_size, embed_dim=cfg.cost_latent_input_dim, pe=cfg.pe, cfg=cfg).eval()
+
+    H, W, heads = 13, 21, cfg.cost_heads_num
+    fmap1 = torch.randn(1, 256, H, W) / 16
+    fmap2 = torch.randn(1, 256, H, W) / 16
+    rows = torch.arange(40, 120)
+    f1 = fmap1.view(heads, -1, H*W).permute(2, 0, 1)[rows]
+
+    with torch.no_grad():
+        cost_maps = torch.einsum('nhd, hdj -> nhj', f1, fmap2.view(heads, -1, H*W)).view(len(rows), heads, H, W)
+        ref, size = patch_embed(cost_maps, rows=rows)
+        out, size_f = patch_embed.forward_factorized(f1, patch_embed.project_target(fmap2)[0], (H, W), rows=rows)
+
+    assert size == size_f
+    torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,20 @@
+import torch
+
+from configs.pretrain_config import get_cfg
+from core.FlowFormer import build_flowformer
+
+
+def test_pretrain_forward():
+    """ One MAE pretraining forward and backward on a small frame, as in pretrain_FlowFormer_maemask.py """
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False
+    cfg.percostformer3.pic_size = [64, 96, 64, 96]
+    torch.manual_seed(0)
+    model = build_flowformer(cfg).train()
+
+    image1 = 255 * torch.rand(1, 3, 64, 96)
+    image2 = 255 * torch.rand(1, 3, 64, 96)
+    loss = model(image1, image2)
+
+    assert loss.dim() == 0 and torch.isfinite(loss)
+    loss.backward()
@@ -0,0 +1,155 @@
+import itertools
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from configs.submissions import get_cfg
+from core.FlowFormer import build_flowformer
+from core.utils.tiling import plan_tiles, forward_tiles, _plan_stitcher
+
+class ConstantFlow(torch.nn.Module):
+    """ Stands in for FlowFormer, predicts the same flow for every pixel of every tile """
+    def __init__(self, flow=(1.5, -2.25)):
+        super().__init__()
+        self.flow = flow
+
+    def forward(self, image1, image2, flow_init=None, iters=None):
+        N, _, H, W = image1.shape
+        flow = image1.new_tensor(self.flow).view(1, 2, 1, 1).expand(N, 2, H, W)
+        return flow.clone(), flow[:, :, ::8, ::8] / 8
+
+
+class PositionFlow(torch.nn.Module):
+    """ Stands in for FlowFormer, predicts the first two channels of image1 as flow, i.e. a flow that
+        differs at every pixel, so a tile stitched at the wrong offset does not match the full frame
+    """
+    def forward(self, image1, image2, flow_init=None, iters=None):
+        flow = image1[:, :2]
+        return flow, F.avg_pool2d(flow, 8)
+
+    def encode_images(self, image1, image2):
+        low = F.avg_pool2d(image1[:, :2], 8)
+        return low, low, F.avg_pool2d(image2[:, :2], 8)
+
+    def forward_features(self, context, feat_s, feat_t, flow_init=None, iters=None):
+        return F.interpolate(feat_s, scale_factor=8, mode='nearest'), feat_s
+
+
+# Sintel, KITTI 2012/2015 variants, HD and odd sizes
+SHAPES = [(436, 1024), (375, 1242), (370, 1226), (376, 1241), (374, 1238), (480, 854), (1080, 1920), (301, 517)]
+MAX_SIZES = [(432, 960), (288, 960)]
+
+
+@pytest.mark.parametrize('shape, max_size', list(itertools.product(SHAPES, MAX_SIZES)))
+def test_plan_guarantees(shape, max_size, min_overlap=20, multiple=8, max_stretch=0.05):
+    plan = plan_tiles(shape, max_size, min_overlap=min_overlap, multiple=multiple, max_stretch=max_stretch)
+    (H, W), (th, tw) = plan.image_shape, plan.patch_size
+
+    assert H % multiple == 0 and W % multiple == 0
+    assert shape[0] <= H < shape[0] + multiple and shape[1] <= W < shape[1] + multiple
+
+    # tiles are multiples of 8, not stretched beyond max_stretch, not smaller than the training crop unless the frame is
+    assert th % multiple == 0 and tw % multiple == 0
+    assert th <= max_size[0] * (1 + max_stretch) and tw <= max_size[1] * (1 + max_stretch)
+    assert th >= min(max_size[0], H) and tw >= min(max_size[1], W)
+
+    hs, ws = sorted({h for h, _ in plan.hws}), sorted({w for _, w in plan.hws})
+    assert set(plan.hws) == set(itertools.product(hs, ws))
+    assert all(h % multiple == 0 and 0 <= h and h + th <= H for h in hs)
+    assert all(w % multiple == 0 and 0 <= w and w + tw <= W for w in ws)
+
+    # neighbouring tiles overlap by at least min_overlap
+    assert all(b - a <= th - min_overlap for a, b in zip(hs, hs[1:]))
+    assert all(b - a <= tw - min_overlap for a, b in zip(ws, ws[1:]))
+
+    # every pixel of the padded frame is covered
+    covered = torch.zeros(H, W, dtype=torch.bool)
+    for h, w in plan.hws:
+        covered[h:h+th, w:w+tw] = True
+    assert covered.all()
+
+
+def test_plan_single_tile():
+    plan = plan_tiles((370, 900), (432, 960))
+    assert plan.image_shape == plan.patch_size == (376, 904) and plan.hws == ((0, 0),)
+
+
+@pytest.mark.parametrize('shape', [(436, 1024), (375, 1242), (130, 250)])
+def test_stitch_weights_sum_to_one(shape):
+    plan = plan_tiles(shape, (64, 128) if shape[0] < 300 else (288, 960))
+    assert len(plan.hws) > 1
+
+    stitcher = _plan_stitcher(plan, 0.05)
+    stitcher.reset(1, channels=1)
+    total = torch.zeros(plan.image_shape)
+    for idx, (h, w) in enumerate(plan.hws):
+        total[h:h+plan.patch_size[0], w:w+plan.patch_size[1]] += stitcher.weight(idx)
+
+    torch.testing.assert_close(total, torch.ones_like(total), rtol=1e-5, atol=1e-5)
+
+
+def test_constant_flow_stitches_to_constant():
+    image1, image2 = torch.rand(2, 3, 130, 250), torch.rand(2, 3, 130, 250)
+    plan = plan_tiles(image1.shape[-2:], (64, 128))
+    assert len(plan.hws) > 1
+
+    flow = forward_tiles(ConstantFlow(), image1, image2, plan)
+
+    assert flow.shape == (2, 2, 130, 250)
+    torch.testing.assert_close(flow, torch.tensor([1.5, -2.25]).view(1, 2, 1, 1).expand_as(flow), rtol=1e-5, atol=1e-5)
+
+
+def test_forward_tiles_returns_fresh_tensor():
+    image1, image2 = torch.rand(1, 3, 130, 250), torch.rand(1, 3, 130, 250)
+    plan = plan_tiles(image1.shape[-2:], (64, 128))
+
+    first = forward_tiles(ConstantFlow((1., 1.)), image1, image2, plan)
+    out = torch.empty(1, 2, 130, 250)
+    second = forward_tiles(ConstantFlow((3., 3.)), image1, image2, plan, out=out)
+
+    assert second is out
+    torch.testing.assert_close(first, torch.ones_like(first), rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(second, 3 * torch.ones_like(second), rtol=1e-5, atol=1e-5)
+
+
+def test_tile_crops_align_with_the_frame():
+    image1, image2 = torch.rand(2, 3, 130, 250), torch.rand(2, 3, 130, 250)
+    plan = plan_tiles(image1.shape[-2:], (64, 128))
+    assert len(plan.hws) > 1
+
+    flow = forward_tiles(PositionFlow(), image1, image2, plan)
+    torch.testing.assert_close(flow, image1[:, :2], rtol=1e-5, atol=1e-5)
+
+
+def test_shared_backbone_crops_align_with_the_frame():
+    image1, image2 = torch.rand(2, 3, 130, 250), torch.rand(2, 3, 130, 250)
+    plan = plan_tiles(image1.shape[-2:], (64, 128))
+    assert len(plan.hws) > 1
+
+    # the encoders see the replicate padded frame, each tile decodes its 1/8 crop of the full frame features
+    H, W = plan.image_shape
+    padded = F.pad(image1, (0, W - 250, 0, H - 130), mode='replicate')
+    expected = F.interpolate(F.avg_pool2d(padded[:, :2], 8), scale_factor=8, mode='nearest')[:, :, :130, :250]
+
+    flow = forward_tiles(PositionFlow(), image1, image2, plan, shared_backbone=True)
+    torch.testing.assert_close(flow, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('shared_backbone', [False, True])
+def test_tile_batch_matches_single_tiles(shared_backbone):
+    """ Tiles of different pairs stacked into one forward pass give the flow of one tile at a time """
+    cfg = get_cfg()
+    cfg.percostformer3.pretrain = False
+    torch.manual_seed(0)
+    model = build_flowformer(cfg).eval()
+
+    image1, image2 = 255 * torch.rand(2, 3, 80, 150), 255 * torch.rand(2, 3, 80, 150)
+    plan = plan_tiles(image1.shape[-2:], (48, 96))
+    assert len(plan.hws) > 1
+
+    with torch.no_grad():
+        ref = forward_tiles(model, image1, image2, plan, tile_batch=1, shared_backbone=shared_backbone)
+        for tile_batch in (3, 2 * len(plan.hws)):
+            flow = forward_tiles(model, image1, image2, plan, tile_batch=tile_batch, shared_backbone=shared_backbone)
+            torch.testing.assert_close(flow, ref, rtol=1e-5, atol=5e-5)     # batched float32 roundoff, 9e-6 measured
@@ -0,0 +1,88 @@
+import sys
+import threading
+
+import pytest
+import torch
+
+from core.utils import utils
+from core.utils.utils import forward_interpolate, forward_interpolate_griddata, bilinear_sampler, bilinear_lookup, window_delta, window_lookup
+from benchmark_forward_interpolate import synthetic_flow
+from benchmark_window_lookup import grid_sample_lookup
+
+
+@pytest.mark.parametrize('kind', ['object', 'noise'])
+def test_forward_interpolate_matches_griddata(kind):
+    torch.manual_seed(1234)
+    flow = synthetic_flow(55, 128, kind)
+    ref = forward_interpolate_griddata(flow)
+    out = forward_interpolate(flow)
+
+    # ties between equally near splatted points may be broken differently than by the KD-tree
+    agree = ((out - ref).abs().sum(dim=0) < 1e-5).float().mean().item()
+    assert agree > 0.995
+    assert (out - ref).abs().mean().item() < 0.02
+
+
+def test_forward_interpolate_batch():
+    torch.manual_seed(1234)
+    flows = torch.stack([synthetic_flow(23, 31, 'noise') for _ in range(3)])
+    single = torch.stack([forward_interpolate(flow) for flow in flows])
+    torch.testing.assert_close(forward_interpolate(flows), single, rtol=0, atol=0)
+
+
+def test_window_lookup_matches_grid_sample():
+    torch.manual_seed(1234)
+    H, W, r = 11, 17, 4
+    cost_maps = torch.randn(H*W, 2, H, W)
+    # centroids inside, on the border and outside of the maps
+    centroid = torch.rand(H*W, 2) * torch.tensor([W + 8., H + 8.]) - 4
+    rows = torch.randperm(H*W)[:H*W // 4]
+
+    ref = grid_sample_lookup(cost_maps, centroid, r)
+    torch.testing.assert_close(window_lookup(cost_maps, None, centroid, r), ref, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(window_lookup(cost_maps, rows, centroid[rows], r), ref[rows], rtol=1e-5, atol=1e-5)
+
+    coords = centroid[rows, None] + window_delta(r)
+    lookup = bilinear_lookup(cost_maps, rows, coords)
+    torch.testing.assert_close(lookup, bilinear_sampler(cost_maps[rows], coords[:, None]).squeeze(2), rtol=1e-5, atol=1e-5)
+
+
+def test_cached_threads():
+    """ DataParallel replicas call cached concurrently, with more keys than CACHE_SIZE forcing evictions """
+    errors = []
+
+    def worker(seed):
+        try:
+            for i in range(20000):
+                key = ('test_cached_threads', (seed * 7 + i) % (2 * utils.CACHE_SIZE))
+                value = utils.cached(key, lambda: torch.tensor(key[1]))
+                assert value.item() == key[1]
+        except Exception as e:
+            errors.append(e)
+
+    # switch threads as often as possible to hit the interleavings
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert not errors
+    assert len(utils._cache) <= utils.CACHE_SIZE
+
+
+def test_clear_cache_by_device():
+    utils.cached_coords_grid(5, 7, 'cpu')
+    utils.cached(('test_clear_cache_by_device', torch.device('meta')), lambda: torch.empty(3, device='meta'))
+
+    utils.clear_cache('meta')
+    assert not any(torch.device('meta') in key for key in utils._cache)
+    assert ('coords_grid', 5, 7, torch.device('cpu')) in utils._cache
+
+    utils.clear_cache()
+    assert not utils._cache
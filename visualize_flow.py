@@ -22,80 +22,22 @@ import os.path as osp
 from core.FlowFormer import build_flowformer
 
 from utils.utils import InputPadder, forward_interpolate
+from utils.tiling import plan_tiles, forward_tiles, downsample_flow
 import itertools
+import warnings
 
 TRAIN_SIZE = [432, 960]
 
 
-def compute_grid_indices(image_shape, patch_size=TRAIN_SIZE, min_overlap=20):
-  if min_overlap >= TRAIN_SIZE[0] or min_overlap >= TRAIN_SIZE[1]:
-    raise ValueError(
-        f"Overlap should be less than size of patch (got {min_overlap}"
-        f"for patch size {patch_size}).")
-  if image_shape[0] == TRAIN_SIZE[0]:
-    hs = list(range(0, image_shape[0], TRAIN_SIZE[0]))
-  else:
-    hs = list(range(0, image_shape[0], TRAIN_SIZE[0] - min_overlap))
-  if image_shape[1] == TRAIN_SIZE[1]:
-    ws = list(range(0, image_shape[1], TRAIN_SIZE[1]))
-  else:
-    ws = list(range(0, image_shape[1], TRAIN_SIZE[1] - min_overlap))
-
-  # Make sure the final patch is flush with the image boundary
-  hs[-1] = image_shape[0] - patch_size[0]
-  ws[-1] = image_shape[1] - patch_size[1]
-  return [(h, w) for h in hs for w in ws]
-
-def compute_weight(hws, image_shape, patch_size=TRAIN_SIZE, sigma=1.0, wtype='gaussian'):
-    patch_num = len(hws)
-    h, w = torch.meshgrid(torch.arange(patch_size[0]), torch.arange(patch_size[1]))
-    h, w = h / float(patch_size[0]), w / float(patch_size[1])
-    c_h, c_w = 0.5, 0.5 
-    h, w = h - c_h, w - c_w
-    weights_hw = (h ** 2 + w ** 2) ** 0.5 / sigma
-    denorm = 1 / (sigma * math.sqrt(2 * math.pi))
-    weights_hw = denorm * torch.exp(-0.5 * (weights_hw) ** 2)
-
-    weights = torch.zeros(1, patch_num, *image_shape)
-    for idx, (h, w) in enumerate(hws):
-        weights[:, idx, h:h+patch_size[0], w:w+patch_size[1]] = weights_hw
-    weights = weights.cuda()
-    patch_weights = []
-    for idx, (h, w) in enumerate(hws):
-        patch_weights.append(weights[:, idx:idx+1, h:h+patch_size[0], w:w+patch_size[1]])
-
-    return patch_weights
-
-def compute_flow(model, image1, image2, weights=None):
+def compute_flow(model, image1, image2):
     print(f"computing flow...")
 
-    image_size = image1.shape[1:]
-
     image1, image2 = image1[None].cuda(), image2[None].cuda()
 
-    hws = compute_grid_indices(image_size)
-    if weights is None:     # no tile
-        padder = InputPadder(image1.shape)
-        image1, image2 = padder.pad(image1, image2)
-
-        flow_pre, _ = model(image1, image2)
-
-        flow_pre = padder.unpad(flow_pre)
-        flow = flow_pre[0].permute(1, 2, 0).cpu().numpy()
-    else:                   # tile
-        flows = 0
-        flow_count = 0
-
-        for idx, (h, w) in enumerate(hws):
-            image1_tile = image1[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]
-            image2_tile = image2[:, :, h:h+TRAIN_SIZE[0], w:w+TRAIN_SIZE[1]]    
-            flow_pre, _ = model(image1_tile, image2_tile)
-            padding = (w, image_size[1]-w-TRAIN_SIZE[1], h, image_size[0]-h-TRAIN_SIZE[0], 0, 0)
-            flows += F.pad(flow_pre * weights[idx], padding)
-            flow_count += F.pad(weights[idx], padding)
-
-        flow_pre = flows / flow_count
-        flow = flow_pre[0].permute(1, 2, 0).cpu().numpy()
+    # a single untiled pass if the frame fits into TRAIN_SIZE, gaussian blended tiles otherwise
+    plan = plan_tiles(image1.shape[-2:], TRAIN_SIZE)
+    flow_pre = forward_tiles(model, image1, image2, plan)
+    flow = flow_pre[0].permute(1, 2, 0).cpu().numpy()
 
     return flow
 
@@ -113,22 +55,17 @@ def compute_adaptive_image_size(image_size):
 
     return image_size
 
-def prepare_image(root_dir, viz_root_dir, fn1, fn2, keep_size):
-    print(f"preparing image...")
-    print(f"root dir = {root_dir}, fn = {fn1}")
-
-    image1 = frame_utils.read_gen(osp.join(root_dir, fn1))
-    image2 = frame_utils.read_gen(osp.join(root_dir, fn2))
-    image1 = np.array(image1).astype(np.uint8)[..., :3]
-    image2 = np.array(image2).astype(np.uint8)[..., :3]
+def prepare_frame(root_dir, fn, keep_size):
+    image = frame_utils.read_gen(osp.join(root_dir, fn))
+    image = np.array(image).astype(np.uint8)[..., :3]
     if not keep_size:
-        dsize = compute_adaptive_image_size(image1.shape[0:2])
-        image1 = cv2.resize(image1, dsize=dsize, interpolation=cv2.INTER_CUBIC)
-        image2 = cv2.resize(image2, dsize=dsize, interpolation=cv2.INTER_CUBIC)
-    image1 = torch.from_numpy(image1).permute(2, 0, 1).float()
-    image2 = torch.from_numpy(image2).permute(2, 0, 1).float()
+        dsize = compute_adaptive_image_size(image.shape[0:2])
+        image = cv2.resize(image, dsize=dsize, interpolation=cv2.INTER_CUBIC)
+    image = torch.from_numpy(image).permute(2, 0, 1).float()
 
+    return image
 
+def prepare_viz_fn(viz_root_dir, fn1):
     dirname = osp.dirname(fn1)
     filename = osp.splitext(osp.basename(fn1))[0]
 
@@ -138,6 +75,16 @@ def prepare_image(root_dir, viz_root_dir, fn1, fn2, keep_size):
 
     viz_fn = osp.join(viz_dir, filename + '.png')
 
+    return viz_fn
+
+def prepare_image(root_dir, viz_root_dir, fn1, fn2, keep_size):
+    print(f"preparing image...")
+    print(f"root dir = {root_dir}, fn = {fn1}")
+
+    image1 = prepare_frame(root_dir, fn1, keep_size)
+    image2 = prepare_frame(root_dir, fn2, keep_size)
+    viz_fn = prepare_viz_fn(viz_root_dir, fn1)
+
     return image1, image2, viz_fn
 
 def build_model():
@@ -152,16 +99,61 @@ def build_model():
     return model
 
 def visualize_flow(root_dir, viz_root_dir, model, img_pairs, keep_size):
-    weights = None
     for img_pair in img_pairs:
         fn1, fn2 = img_pair
         print(f"processing {fn1}, {fn2}...")
 
         image1, image2, viz_fn = prepare_image(root_dir, viz_root_dir, fn1, fn2, keep_size)
-        flow = compute_flow(model, image1, image2, weights)
+        flow = compute_flow(model, image1, image2)
         flow_img = flow_viz.flow_to_image(flow)
         cv2.imwrite(viz_fn, flow_img[:, :, [2,1,0]])
 
+def visualize_sequence(root_dir, viz_root_dir, model, img_pairs, keep_size, frame_batch=4, warm_start=False, iters=None):
+    """ img_pairs are consecutive (t, t+1) pairs of one sequence, each frame is read and encoded once.
+        With warm_start each pair is initialized with the forward-splatted flow of the previous pair.
+    """
+    frame_fns = [img_pairs[0][0]] + [fn2 for _, fn2 in img_pairs]
+    first = prepare_frame(root_dir, frame_fns[0], keep_size)
+    plan = plan_tiles(first.shape[-2:], TRAIN_SIZE)
+    if len(plan.hws) > 1:
+        return visualize_sequence_tiles(root_dir, viz_root_dir, model, img_pairs, keep_size, plan, first, frame_batch, warm_start, iters)
+
+    padder = InputPadder(first[None].shape)
+
+    def frames():
+        yield padder.pad(first[None].cuda())[0]
+        for fn in frame_fns[1:]:
+            print(f"processing {fn}...")
+            yield padder.pad(prepare_frame(root_dir, fn, keep_size)[None].cuda())[0]
+
+    for (fn1, _), (flow_pre, _) in zip(img_pairs, model.module.forward_sequence(frames(), frame_batch, warm_start, iters)):
+        flow = padder.unpad(flow_pre[0]).permute(1, 2, 0).cpu().numpy()
+        flow_img = flow_viz.flow_to_image(flow)
+        cv2.imwrite(prepare_viz_fn(viz_root_dir, fn1), flow_img[:, :, [2,1,0]])
+
+def visualize_sequence_tiles(root_dir, viz_root_dir, model, img_pairs, keep_size, plan, first, frame_batch=4, warm_start=False, iters=None):
+    """ visualize_sequence for frames that need tiling: each frame is still read once, the pairs are
+        run one at a time through forward_tiles. With warm_start each pair is initialized with the
+        forward-splatted 1/8 flow of the previous stitched flow.
+    """
+    if frame_batch > 1:
+        warnings.warn(f"frames of {list(first.shape[-2:])} need tiling, pairs are tiled one at a time and frame_batch={frame_batch} is not used")
+
+    image1 = first[None].cuda()
+    flow_prev = None
+    for fn1, fn2 in img_pairs:
+        print(f"processing {fn2}...")
+        image2 = prepare_frame(root_dir, fn2, keep_size)[None].cuda()
+
+        flow_init = None
+        if warm_start and flow_prev is not None:
+            flow_init = forward_interpolate(downsample_flow(flow_prev, plan))
+
+        flow_prev = forward_tiles(model, image1, image2, plan, flow_init=flow_init, iters=iters)
+        flow_img = flow_viz.flow_to_image(flow_prev[0].permute(1, 2, 0).cpu().numpy())
+        cv2.imwrite(prepare_viz_fn(viz_root_dir, fn1), flow_img[:, :, [2,1,0]])
+        image1 = image2
+
 def process_sintel(sintel_dir):
     img_pairs = []
     for scene in os.listdir(sintel_dir):
@@ -193,6 +185,9 @@ if __name__ == '__main__':
     parser.add_argument('--end_idx', type=int, default=1200)    # ending index of the image sequence
     parser.add_argument('--viz_root_dir', default='viz_results')
     parser.add_argument('--keep_size', action='store_true')     # keep the image size, or the image will be adaptively resized.
+    parser.add_argument('--frame_batch', type=int, default=4)  # number of frames encoded at once with --eval_type seq
+    parser.add_argument('--warm_start', action='store_true')   # warm start each pair from the previous one with --eval_type seq
+    parser.add_argument('--iters', type=int, default=None)     # decoder iterations with --eval_type seq, defaults to decoder_depth
 
     args = parser.parse_args()
 
@@ -206,4 +201,7 @@ if __name__ == '__main__':
     elif args.eval_type == 'seq':
         img_pairs = generate_pairs(args.seq_dir, args.start_idx, args.end_idx)
     with torch.no_grad():
-        visualize_flow(root_dir, viz_root_dir, model, img_pairs, args.keep_size)
\ No newline at end of file
+        if args.eval_type == 'seq':
+            visualize_sequence(root_dir, viz_root_dir, model, img_pairs, args.keep_size, args.frame_batch, args.warm_start, args.iters)
+        else:
+            visualize_flow(root_dir, viz_root_dir, model, img_pairs, args.keep_size)
\ No newline at end of file